@@ -0,0 +1,776 @@
+"""
+asyncio implementation of the client and the server on top of
+loop.create_datagram_endpoint, one event loop drives any number of connections.
+
+The client side is a stream:
+    reader, writer = await open_connection(host, port)
+    writer.write(b"data")
+    await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+The server side hands the in order bytes of every connection to a callback:
+    async def handle(reader, addr):
+        data = await reader.read()
+    server = await start_server(handle, host, port)
+
+The wire format, the state machine of the server and the window, congestion control
+and retransmission timeout of the sender are the ones of utils.py, server.py and client.py.
+"""
+import argparse
+import asyncio
+
+import client
+import congestion
+import metrics
+import server
+import utils
+from utils import States
+
+# seconds the client stays in TIME_WAIT before its socket is closed
+TIME_WAIT = 30.0
+
+# drain() blocks while the writer has more than this many bytes not yet acknowledged
+WRITE_HIGH_WATER = 64 * 1024
+
+# acknowledged segments are dropped from the send queue once this many piled up
+TRIM_THRESHOLD = 1024
+
+
+class _Segment:
+    """
+    A data segment of the send queue.
+    """
+
+    __slots__ = ("seq_num", "chunk", "sent_at", "retransmitted", "acked", "timer")
+
+    def __init__(self, seq_num, chunk):
+        # sequence number of the last byte of the segment
+        self.seq_num = seq_num
+        self.chunk = chunk
+        self.sent_at = 0.0
+        # resent segments give ambiguous round trip times (Karn's rule)
+        self.retransmitted = False
+        self.acked = False
+        # retransmission timer of the segment under selective repeat
+        self.timer = None
+
+
+class ClientProtocol(client.Sender, asyncio.DatagramProtocol):
+    """
+    The sending side of a connection. Retransmissions are driven by loop.call_later,
+    a single timer under Go-Back-N and one timer per segment under Selective Repeat.
+    """
+
+    def __init__(
+        self,
+        window=client.WINDOW_SIZE,
+        mode=client.GO_BACK_N,
+        congestion_control=None,
+        mss=client.MSS,
+        nodelay=False,
+    ):
+        """
+        Initialize the connection state.
+        :param window: number of segments in flight, see client.Sender
+        :param mode: retransmission strategy, client.GO_BACK_N or client.SELECTIVE_REPEAT
+        :param congestion_control: name of a congestion control algorithm, or None
+        :param mss: maximum segment size to ask for
+        :param nodelay: send partial segments at once instead of holding them back
+            while data is in flight (Nagle's algorithm, TCP_NODELAY)
+        """
+        super().__init__(window, mode, congestion_control, mss)
+        self.nodelay = nodelay
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.client_state = States.CLOSED
+
+        self.next_seq_num = 0
+        self.last_received_seq = -1
+        # sequence number of the last byte queued by write()
+        self.write_seq_num = 0
+
+        # the send queue, base is the oldest unacknowledged segment
+        # and next_index the next segment to send
+        self.segments = []
+        self.base = 0
+        self.next_index = 0
+        # unacknowledged bytes, drain() waits on this
+        self.buffered = 0
+        # selective repeat acks a segment with its sequence number + 1
+        self.unacked = {}
+
+        # the timer of the handshake, the FIN or the Go-Back-N window
+        self.timer = None
+        self.closing = False
+        self.fin_seq_num = None
+        self.fin_received = False
+        self.final_ack = None
+
+        # the server sends no data, its FIN is the end of the stream
+        self.reader = asyncio.StreamReader()
+        self.established = self.loop.create_future()
+        self.closed = self.loop.create_future()
+        self.drain_waiters = []
+
+    # asyncio.DatagramProtocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._send_syn()
+
+    def datagram_received(self, data, addr):
+        if not utils.checksum_ok(data):
+            self.metrics.counters[metrics.CORRUPTED] += 1
+            return
+        header = utils.bits_to_header(data)
+        self.metrics.counters[metrics.ACKS_RECEIVED] += 1
+        if header.seq_num > self.last_received_seq:
+            self.last_received_seq = header.seq_num
+
+        match self.client_state:
+            case States.SYN_SENT:
+                if header.syn == 1 and header.ack == 1:
+                    self._on_synack(header)
+            case States.ESTABLISHED:
+                if header.ack == 1:
+                    self._on_ack(header)
+                    self._fill_window()
+            case States.FIN_WAIT_1 | States.FIN_WAIT_2:
+                if header.fin == 1:
+                    self.fin_received = True
+                if (
+                    self.client_state is States.FIN_WAIT_1
+                    and header.ack == 1
+                    and header.syn == 0
+                    and header.ack_num == self.fin_seq_num + 1
+                ):
+                    self._cancel_timer()
+                    self._update_state(States.FIN_WAIT_2)
+                if self.client_state is States.FIN_WAIT_2 and self.fin_received:
+                    self._on_fin(header)
+            case States.TIME_WAIT:
+                # our final ack was lost, the server sent its FIN again
+                if header.fin == 1:
+                    self.transport.sendto(self.final_ack.bits())
+
+    def error_received(self, exc):
+        # nothing is listening yet, retransmissions keep trying
+        if utils.DEBUG:
+            utils.debug("aio.error", error=exc)
+
+    def connection_lost(self, exc):
+        self._cancel_timer()
+        for segment in self.segments[self.base : self.next_index]:
+            if segment.timer:
+                segment.timer.cancel()
+        error = exc or ConnectionResetError("connection lost")
+        for future in (self.established, self.closed, *self.drain_waiters):
+            if not future.done():
+                future.set_exception(error)
+        self.reader.feed_eof()
+
+    # stream API, used by StreamWriter
+
+    def write(self, data):
+        """
+        Queue data, it is sent as the window allows.
+        :param data: bytes to send
+        :return: None
+        """
+        if self.closing:
+            raise ConnectionError("write after close")
+        self._queue(data)
+        if self.client_state is States.ESTABLISHED:
+            self._fill_window()
+
+    async def drain(self):
+        """
+        Wait until the unacknowledged data is below WRITE_HIGH_WATER.
+        :return: None
+        """
+        if self.buffered <= WRITE_HIGH_WATER:
+            return
+        waiter = self.loop.create_future()
+        self.drain_waiters.append(waiter)
+        await waiter
+
+    def close(self):
+        """
+        Start the teardown once everything queued is acknowledged.
+        :return: None
+        """
+        self.closing = True
+        if self.client_state is States.ESTABLISHED and self.base == len(self.segments):
+            self._send_fin()
+
+    # handshake and teardown
+
+    def _send_syn(self):
+        if self.client_state is States.CLOSED:
+            self.next_seq_num = utils.rand_int()
+            self._update_state(States.SYN_SENT)
+        else:
+            # the SYN timed out, the server never saw it
+            self._backoff_rto()
+
+        # selective repeat and the segment size are requested in the SYN
+        syn_header = utils.Header(
+            self.next_seq_num,
+            0,
+            syn=1,
+            ack=0,
+            sr=self.mode == client.SELECTIVE_REPEAT,
+            mss=self.mss,
+        )
+        if utils.DEBUG:
+            utils.debug("client.syn", seq=syn_header.seq_num, ack=syn_header.ack_num)
+        self.transport.sendto(syn_header.bits())
+        self.syn_sent_at = self.loop.time()
+        self.timer = self.loop.call_later(self.rto, self._send_syn)
+
+    def _on_synack(self, header):
+        self._cancel_timer()
+        self.rwnd = header.window
+        self._update_rtt(self.loop.time() - self.syn_sent_at)
+        self._negotiate_mss(header)
+
+        ack_header = utils.Header(
+            self.next_seq_num + 1, self.last_received_seq + 1, syn=0, ack=1
+        )
+        if utils.DEBUG:
+            utils.debug("client.handshake_ack", seq=ack_header.seq_num, ack=ack_header.ack_num)
+        self.transport.sendto(ack_header.bits())
+
+        # the SYN and the handshake ack each consume a sequence number, data queued
+        # before the handshake completed is cut again to the negotiated segment size
+        self.next_seq_num += 2
+        self.write_seq_num = self.next_seq_num
+        queued = b"".join(segment.chunk for segment in self.segments)
+        self.segments = []
+        self.buffered = 0
+        self._queue(queued)
+
+        self._update_state(States.ESTABLISHED)
+        self.established.set_result(None)
+        self._fill_window()
+        if self.closing:
+            self.close()
+
+    def _send_fin(self):
+        if self.fin_seq_num is None:
+            self.fin_seq_num = self.next_seq_num
+            self._update_state(States.FIN_WAIT_1)
+        else:
+            self._backoff_rto()
+
+        fin_header = utils.Header(
+            self.fin_seq_num, self.last_received_seq, syn=1, ack=0, fin=1
+        )
+        if utils.DEBUG:
+            utils.debug("client.fin", seq=fin_header.seq_num, ack=fin_header.ack_num)
+        self.transport.sendto(fin_header.bits())
+        self.timer = self.loop.call_later(self.rto, self._send_fin)
+
+    def _on_fin(self, header):
+        self.final_ack = utils.Header(
+            self.fin_seq_num + 1, header.seq_num + 1, syn=0, ack=1
+        )
+        if utils.DEBUG:
+            utils.debug(
+                "client.final_ack", seq=self.final_ack.seq_num, ack=self.final_ack.ack_num
+            )
+        self.transport.sendto(self.final_ack.bits())
+
+        self._update_state(States.TIME_WAIT)
+        self.reader.feed_eof()
+        self.closed.set_result(None)
+        self.loop.call_later(TIME_WAIT, self.transport.close)
+
+    # data transfer
+
+    def _queue(self, data):
+        """
+        Cut data into segments at the end of the send queue. The data is copied,
+        the caller may reuse its buffer once write() returns.
+        :param data: bytes-like object
+        :return: None
+        """
+        data = memoryview(data).cast("B")
+        self.buffered += len(data)
+
+        # small writes are coalesced, the last segment is filled up as long as it was not sent
+        if self.next_index < len(self.segments):
+            segment = self.segments[-1]
+            fill = min(self.mss - len(segment.chunk), len(data))
+            if fill > 0:
+                segment.chunk += data[:fill]
+                segment.seq_num += fill
+                self.write_seq_num += fill
+                data = data[fill:]
+
+        for i in range(0, len(data), self.mss):
+            chunk = bytes(data[i : i + self.mss])
+            self.write_seq_num += len(chunk)
+            self.segments.append(_Segment(self.write_seq_num, chunk))
+
+    def _fill_window(self):
+        if self.client_state is not States.ESTABLISHED:
+            return
+        while (
+            self.next_index < len(self.segments)
+            and self.next_index < self.base + self._window()
+            and self._usable(self.segments[self.next_index].seq_num)
+            and self._nagle_allows(self.segments[self.next_index])
+        ):
+            if self.persist_timeout is not None:
+                # the window opened, the persist timer is not needed anymore
+                self._cancel_timer()
+                self.persist_timeout = None
+            self._send_segment(
+                self.segments[self.next_index],
+                push=self.next_index in (self.base, len(self.segments) - 1),
+            )
+            self.next_index += 1
+
+        if (
+            self.base == self.next_index < len(self.segments)
+            and self.persist_timeout is None
+        ):
+            # nothing in flight and the receive window has no room for the next
+            # segment, no ack will open it so the persist timer probes for it
+            self.persist_timeout = self.rto
+            self.timer = self.loop.call_later(self.persist_timeout, self._probe_window)
+
+    def _nagle_allows(self, segment):
+        """
+        Nagle's algorithm, a partial segment is held back while data is in flight,
+        the writes until its ack are coalesced into it.
+        :param segment: the next segment to send
+        :return: True if the segment may be sent now
+        """
+        return (
+            self.nodelay
+            or len(segment.chunk) == self.mss
+            or self.base == self.next_index
+        )
+
+    def _probe_window(self):
+        """
+        The persist timer expired, send a window probe, a segment without payload.
+        The timer doubles with every probe up to client.MAX_RTO.
+        :return: None
+        """
+        if utils.DEBUG:
+            utils.debug("client.window_probe", rwnd=self.rwnd)
+        header = utils.Header(
+            self.next_seq_num, self.last_received_seq + 1, syn=0, ack=0
+        )
+        self.transport.sendto(header.bits())
+        self.window_probes += 1
+        self.persist_timeout = min(self.persist_timeout * 2, client.MAX_RTO)
+        self.timer = self.loop.call_later(self.persist_timeout, self._probe_window)
+
+    def _send_segment(self, segment, push=False):
+        # a pushed segment is alone in flight or the last one queued, the server acks
+        # it without delay
+        header = utils.Header(
+            segment.seq_num, self.last_received_seq + 1, syn=0, ack=0, psh=push
+        )
+        if utils.DEBUG:
+            utils.debug(
+                "client.segment", seq=header.seq_num, size=len(segment.chunk), push=push
+            )
+        self.transport.sendto(header.bits(segment.chunk) + segment.chunk)
+        segment.sent_at = self.loop.time()
+        counters = self.metrics.counters
+        counters[metrics.SEGMENTS_SENT] += 1
+        counters[metrics.BYTES_SENT] += len(segment.chunk)
+
+        if self.mode == client.SELECTIVE_REPEAT:
+            self.unacked[segment.seq_num + 1] = segment
+            segment.timer = self.loop.call_later(
+                self.rto, self._on_segment_timeout, segment
+            )
+        elif self.timer is None:
+            self.timer = self.loop.call_later(self.rto, self._on_window_timeout)
+
+    def _on_window_timeout(self):
+        """
+        The Go-Back-N timer expired, go back to the oldest unacknowledged segment.
+        :return: None
+        """
+        self.timer = None
+        in_flight = self.next_index - self.base
+        if utils.DEBUG:
+            utils.debug("client.timeout", resent=in_flight)
+        self.timeout_retransmits += in_flight
+        self._backoff_rto()
+        if self.congestion_control:
+            self.congestion_control.on_timeout(in_flight, self.loop.time())
+        for segment in self.segments[self.base : self.next_index]:
+            segment.retransmitted = True
+        self.next_index = self.base
+        self._fill_window()
+
+    def _on_segment_timeout(self, segment):
+        """
+        The timer of a segment expired under Selective Repeat, resend only that segment.
+        :param segment: the segment
+        :return: None
+        """
+        if utils.DEBUG:
+            utils.debug("client.timeout", seq=segment.seq_num)
+        self.timeout_retransmits += 1
+        # back off once per loss episode, when the head of the window times out
+        if segment is self.segments[self.base]:
+            self._backoff_rto()
+            if self.congestion_control:
+                self.congestion_control.on_timeout(
+                    self.next_index - self.base, self.loop.time()
+                )
+        segment.retransmitted = True
+        self._send_segment(segment)
+
+    def _on_ack(self, header):
+        # acks of data acknowledged already carry a stale receive window
+        if header.ack_num >= self.next_seq_num + 1:
+            self.rwnd = header.window
+
+        if self.mode == client.SELECTIVE_REPEAT:
+            # acks are individual, only mark the segment the ack belongs to
+            segment = self.unacked.pop(header.ack_num, None)
+            if segment is None:
+                return
+            segment.acked = True
+            segment.timer.cancel()
+            newest = segment
+            acked = 1
+            while self.base < self.next_index and self.segments[self.base].acked:
+                self._advance()
+        else:
+            # acks are cumulative, every segment below the ack number has been received
+            acked = 0
+            while (
+                self.base < self.next_index
+                and header.ack_num > self.segments[self.base].seq_num
+            ):
+                newest = self.segments[self.base]
+                self._advance()
+                acked += 1
+            if not acked:
+                return
+            # restart the timer for the remaining segments in flight
+            self._cancel_timer()
+            if self.base < self.next_index:
+                self.timer = self.loop.call_later(self.rto, self._on_window_timeout)
+
+        # the ack was triggered by the newest segment it covers
+        if not newest.retransmitted:
+            self._update_rtt(self.loop.time() - newest.sent_at)
+        else:
+            self._reset_rto()
+        if self.congestion_control:
+            self.congestion_control.on_ack(acked, self.loop.time(), self.srtt)
+
+        if self.base >= TRIM_THRESHOLD:
+            del self.segments[: self.base]
+            self.next_index -= self.base
+            self.base = 0
+
+        while self.drain_waiters and self.buffered <= WRITE_HIGH_WATER:
+            waiter = self.drain_waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+
+        if self.closing and self.base == len(self.segments):
+            self._send_fin()
+
+    def _advance(self):
+        """
+        Slide the window past the oldest segment, it has been acknowledged.
+        :return: None
+        """
+        segment = self.segments[self.base]
+        # update the next sequence number past the acknowledged segment
+        self.next_seq_num = segment.seq_num
+        self.buffered -= len(segment.chunk)
+        self.base += 1
+
+    def _cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _update_state(self, new_state):
+        if utils.INFO:
+            utils.info("client.state", old=self.client_state, new=new_state)
+        self.metrics.transition(new_state, self.clock())
+        self.client_state = new_state
+
+
+class StreamWriter:
+    """
+    Write side of a connection opened with open_connection().
+    """
+
+    def __init__(self, protocol):
+        self._protocol = protocol
+
+    @property
+    def protocol(self):
+        return self._protocol
+
+    def write(self, data):
+        self._protocol.write(data)
+
+    async def drain(self):
+        await self._protocol.drain()
+
+    def close(self):
+        self._protocol.close()
+
+    def is_closing(self):
+        return self._protocol.closing
+
+    async def wait_closed(self):
+        """
+        Wait until the server acknowledged everything and both FINs were exchanged.
+        :return: None
+        """
+        await self._protocol.closed
+
+
+async def open_connection(
+    host=client.UDP_IP,
+    port=client.UDP_PORT,
+    window=client.WINDOW_SIZE,
+    mode=client.GO_BACK_N,
+    congestion_control=None,
+    mss=client.MSS,
+    nodelay=False,
+):
+    """
+    Open a connection and complete the handshake.
+    :param host: ip of the server, or of the channel in front of it
+    :param port: port of the server
+    :param window: number of segments in flight, see client.Sender
+    :param mode: retransmission strategy, client.GO_BACK_N or client.SELECTIVE_REPEAT
+    :param congestion_control: name of a congestion control algorithm, or None
+    :param mss: maximum segment size to ask for
+    :param nodelay: send small writes at once instead of coalescing them
+    :return: (asyncio.StreamReader, StreamWriter)
+    """
+    loop = asyncio.get_running_loop()
+    _, protocol = await loop.create_datagram_endpoint(
+        lambda: ClientProtocol(window, mode, congestion_control, mss, nodelay),
+        remote_addr=(host, port),
+    )
+    await protocol.established
+    return protocol.reader, StreamWriter(protocol)
+
+
+class _ReaderTransport:
+    """
+    Stands in for the transport of the StreamReader of a server connection, for its
+    flow control. The reader pauses it once it buffers more than twice its limit and
+    resumes it once the application read it down to the limit. While it is paused the
+    bytes stay in the receive buffer of the connection and its window closes.
+    """
+
+    def __init__(self, protocol, addr):
+        """
+        :param protocol: the ServerProtocol
+        :param addr: (ip, port) of the client
+        """
+        self.protocol = protocol
+        self.addr = addr
+        self.paused = False
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+        connection = self.protocol.server.connections.get(self.addr)
+        if connection is not None and connection.buffer:
+            self.protocol._on_data(self.addr, connection)
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    """
+    Drives server.Server from the event loop. The bytes every connection receives in
+    order are read from its receive buffer and fed to an asyncio.StreamReader as they
+    arrive, as long as the application keeps up with the reader.
+    """
+
+    def __init__(self, client_connected_cb=None):
+        """
+        :param client_connected_cb: called with (reader, addr) for every new
+            connection, may be a coroutine function
+        """
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.client_connected_cb = client_connected_cb
+        self.server = server.Server(
+            sock=None, on_message=self._on_message, on_data=self._on_data
+        )
+        # addr -> reader, and the _ReaderTransport pausing it
+        self.readers = {}
+        self.reader_transports = {}
+        self.evict_timer = None
+        # fires when the earliest held back ack is due
+        self.ack_timer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.evict_timer = self.loop.call_later(server.EVICT_INTERVAL, self._evict)
+
+    def datagram_received(self, data, addr):
+        for resp_header in self.server.handle_datagram(data, addr, self.loop.time()):
+            self.transport.sendto(resp_header.bits(), addr)
+        self._schedule_acks()
+
+        connection = self.server.connections.get(addr)
+        if connection is None:
+            return
+        if addr not in self.readers:
+            reader = self.readers[addr] = asyncio.StreamReader()
+            transport = self.reader_transports[addr] = _ReaderTransport(self, addr)
+            reader.set_transport(transport)
+            if self.client_connected_cb:
+                result = self.client_connected_cb(reader, addr)
+                if asyncio.iscoroutine(result):
+                    self.loop.create_task(result)
+
+        # the client FIN was received, nothing else will be added to the message
+        if connection.server_state is States.LAST_ACK:
+            self._on_message(addr, connection.read())
+
+    def connection_lost(self, exc):
+        if self.evict_timer:
+            self.evict_timer.cancel()
+        if self.ack_timer:
+            self.ack_timer.cancel()
+        for reader in self.readers.values():
+            reader.feed_eof()
+        self.readers.clear()
+        self.reader_transports.clear()
+
+    def close(self):
+        self.transport.close()
+
+    def _schedule_acks(self):
+        deadline = self.server.next_ack_deadline()
+        if deadline is not None and self.ack_timer is None:
+            self.ack_timer = self.loop.call_at(deadline, self._send_delayed_acks)
+
+    def _send_delayed_acks(self):
+        self.ack_timer = None
+        for addr, resp_header in self.server.delayed_acks(self.loop.time()):
+            self.transport.sendto(resp_header.bits(), addr)
+        self._schedule_acks()
+
+    def _on_data(self, addr, connection):
+        # a paused reader leaves the bytes in the receive buffer, the window the
+        # client is advertised shrinks until the application catches up
+        reader = self.readers.get(addr)
+        if reader is not None and not self.reader_transports[addr].paused:
+            reader.feed_data(connection.read())
+
+    def _on_message(self, addr, message):
+        # the connection closed, the rest of its message ends the stream
+        reader = self.readers.pop(addr, None)
+        self.reader_transports.pop(addr, None)
+        if reader is not None:
+            if message:
+                reader.feed_data(message)
+            reader.feed_eof()
+
+    def _evict(self):
+        self.server.evict(self.loop.time())
+        for addr in [addr for addr in self.readers if addr not in self.server.connections]:
+            reader = self.readers.pop(addr)
+            del self.reader_transports[addr]
+            reader.set_exception(ConnectionResetError(f"{addr} evicted"))
+        self.evict_timer = self.loop.call_later(server.EVICT_INTERVAL, self._evict)
+
+
+async def start_server(client_connected_cb, host=server.UDP_IP, port=server.UDP_PORT):
+    """
+    Serve connections on a UDP socket.
+    :param client_connected_cb: called with (reader, addr) for every new connection
+    :param host: ip to bind
+    :param port: port to bind
+    :return: ServerProtocol, close() stops serving
+    """
+    loop = asyncio.get_running_loop()
+    _, protocol = await loop.create_datagram_endpoint(
+        lambda: ServerProtocol(client_connected_cb), local_addr=(host, port)
+    )
+    return protocol
+
+
+async def _serve(host, port):
+    async def handle(reader, addr):
+        message = await reader.read()
+        if utils.INFO:
+            utils.info("server.message", addr=addr, size=len(message))
+
+    await start_server(handle, host, port)
+    await asyncio.Future()
+
+
+async def _send(host, port, connections, **kwargs):
+    async def send():
+        reader, writer = await open_connection(host, port, **kwargs)
+        writer.write(b"This message is to be received in pieces")
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+
+    await asyncio.gather(*(send() for _ in range(connections)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("role", choices=["server", "client"])
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=1,
+        help="number of concurrent connections of the client",
+    )
+    parser.add_argument("--window", type=int, default=client.WINDOW_SIZE)
+    parser.add_argument(
+        "--mode",
+        choices=[client.GO_BACK_N, client.SELECTIVE_REPEAT],
+        default=client.GO_BACK_N,
+    )
+    parser.add_argument(
+        "--congestion-control", choices=sorted(congestion.ALGORITHMS)
+    )
+    parser.add_argument("--mss", type=int, default=client.MSS)
+    parser.add_argument(
+        "--log-level",
+        choices=sorted(utils.LOG_LEVELS),
+        default="warning",
+        help="log state changes (info) or every segment (debug)",
+    )
+    args = parser.parse_args()
+    utils.set_log_level(args.log_level)
+
+    if args.role == "server":
+        asyncio.run(_serve(server.UDP_IP, server.UDP_PORT))
+    else:
+        asyncio.run(
+            _send(
+                client.UDP_IP,
+                client.UDP_PORT,
+                args.connections,
+                window=args.window,
+                mode=args.mode,
+                congestion_control=args.congestion_control,
+                mss=args.mss,
+            )
+        )
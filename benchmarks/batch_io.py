@@ -0,0 +1,179 @@
+"""
+System calls per datagram and datagrams per second of the server's receive loop,
+the batched loop of Server.serve_forever against the previous one that received a
+single datagram per pass with a socket timeout.
+
+A load generator process sends in order data segments over the loopback as fast
+as it can. The system calls are counted by the socket and the selector the server
+is given: with a socket timeout CPython polls before every send and receive, and
+every settimeout() switches the blocking mode with an ioctl.
+
+Run from the root of the project:
+    python -m benchmarks.batch_io --duration 5
+"""
+import argparse
+import multiprocessing
+import selectors
+import socket
+import time
+
+import server
+from benchmarks import reuseport
+
+# connections of the load generator
+CONNECTIONS = 64
+
+# seconds every loop is measured
+DURATION = 5.0
+
+
+class CountingSocket(socket.socket):
+    """
+    A UDP socket counting the system calls of the methods the server uses.
+    """
+
+    def __init__(self):
+        super().__init__(socket.AF_INET, socket.SOCK_DGRAM)
+        self.syscalls = 0
+
+    def _count(self):
+        # a socket with a timeout polls before the call
+        self.syscalls += 2 if self.gettimeout() else 1
+
+    def settimeout(self, timeout):
+        self.syscalls += 1
+        super().settimeout(timeout)
+
+    def setblocking(self, flag):
+        self.syscalls += 1
+        super().setblocking(flag)
+
+    def recvfrom_into(self, *args):
+        self._count()
+        return super().recvfrom_into(*args)
+
+    def sendto(self, *args):
+        self._count()
+        return super().sendto(*args)
+
+    def sendmsg(self, *args):
+        self._count()
+        return super().sendmsg(*args)
+
+
+class CountingSelector(selectors.DefaultSelector):
+    """
+    A selector counting its waits.
+    """
+
+    syscalls = 0
+
+    def select(self, timeout=None):
+        self.syscalls += 1
+        return super().select(timeout)
+
+
+def serve_per_datagram(srv, until):
+    """
+    The previous loop of the server, one datagram per pass with a socket timeout.
+    :param srv: server.Server on a CountingSocket
+    :param until: time.monotonic() to stop at
+    :return: system calls made besides the ones of the socket
+    """
+    while (now := time.monotonic()) < until:
+        deadline = min(srv.next_eviction, until)
+        if srv.ack_deadlines:
+            deadline = min(deadline, srv.next_ack_deadline())
+        if deadline > now:
+            srv.sock.settimeout(deadline - now)
+            try:
+                srv.receive()
+            except socket.timeout:
+                pass
+            now = time.monotonic()
+
+        for addr, resp_header in srv.delayed_acks(now):
+            srv.sock.sendto(resp_header.bits(), addr)
+
+        if now >= srv.next_eviction:
+            srv.evict(now)
+            srv.next_eviction = now + server.EVICT_INTERVAL
+    return 0
+
+
+def serve_batched(srv, until):
+    """
+    The loop of Server.serve_forever, the socket is drained in one pass per wait.
+    :param srv: server.Server on a CountingSocket
+    :param until: time.monotonic() to stop at
+    :return: system calls made besides the ones of the socket
+    """
+    srv.sock.setblocking(False)
+    with CountingSelector() as selector:
+        selector.register(srv.sock, selectors.EVENT_READ)
+        while time.monotonic() < until:
+            # wake up at the end even without traffic
+            srv.next_eviction = min(srv.next_eviction, until)
+            srv.poll(selector)
+    return selector.syscalls
+
+
+def bench(serve, connections, duration):
+    """
+    Measure one loop of the server.
+    :param serve: serve_per_datagram or serve_batched
+    :param connections: connections of the load generator
+    :param duration: seconds to measure
+    :return: dict of the datagrams handled per second and the system calls per datagram
+    """
+    sock = CountingSocket()
+    sock.bind((server.UDP_IP, 0))
+    srv = server.Server(sock)
+
+    start = multiprocessing.Event()
+    sent = multiprocessing.Value("Q", 0)
+    generator = multiprocessing.Process(
+        target=reuseport.generate,
+        args=(sock.getsockname(), connections, start, duration, sent),
+        daemon=True,
+    )
+    generator.start()
+
+    # the handshakes are not measured
+    deadline = time.monotonic() + reuseport.TIMEOUT
+    while srv.stats["opened"] < connections and time.monotonic() < deadline:
+        serve(srv, time.monotonic() + 0.1)
+    datagrams = srv.stats["datagrams"]
+    sock.syscalls = 0
+
+    start.set()
+    syscalls = serve(srv, time.monotonic() + duration)
+    generator.join()
+    sock.close()
+
+    handled = srv.stats["datagrams"] - datagrams
+    return {
+        "sent": sent.value / duration,
+        "handled": handled / duration,
+        "syscalls": (sock.syscalls + syscalls) / max(handled, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="System calls per datagram and datagrams per second of the batched and the previous receive loop."
+    )
+    parser.add_argument("--connections", type=int, default=CONNECTIONS)
+    parser.add_argument("--duration", type=float, default=DURATION)
+    args = parser.parse_args()
+
+    print(f"{'loop':<14} {'handled/s':>10} {'sent/s':>10} {'syscalls/datagram':>18}")
+    for name, serve in (("per datagram", serve_per_datagram), ("batched", serve_batched)):
+        result = bench(serve, args.connections, args.duration)
+        print(
+            f"{name:<14} {result['handled']:>10.0f} {result['sent']:>10.0f} {result['syscalls']:>18.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Benchmark of the multi-connection server, how fast N simultaneous clients
+complete their handshake and how much memory the server keeps per connection.
+
+Run from the root of the project:
+    python -m benchmarks.connections --clients 1000
+"""
+import argparse
+import multiprocessing
+import socket
+import time
+import tracemalloc
+
+import metrics
+import server
+import utils
+
+# number of simultaneous clients
+CLIENTS = 1000
+
+# seconds to wait for a SYNACK before the handshake is counted as failed
+TIMEOUT = 5.0
+
+
+def _serve(port_queue):
+    """
+    Run a server on an ephemeral port, the port is reported through the queue.
+    :param port_queue: multiprocessing queue the bound port is put on
+    :return: None
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    sock.bind((server.UDP_IP, 0))
+    port_queue.put(sock.getsockname()[1])
+    server.Server(sock).serve_forever()
+
+
+def bench_rate(clients):
+    """
+    Open the clients at once against a server in another process. Every client
+    sends its SYN, then every client waits for its SYNACK and completes the
+    handshake with an ACK.
+    :param clients: number of clients
+    :return: dict with the connections opened and the connections per second
+    """
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(port_queue,), daemon=True)
+    process.start()
+    address = (server.UDP_IP, port_queue.get())
+
+    socks = []
+    try:
+        for _ in range(clients):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(TIMEOUT)
+            socks.append(sock)
+
+        start = time.perf_counter()
+        seq_nums = []
+        for sock in socks:
+            seq_num = utils.rand_int()
+            seq_nums.append(seq_num)
+            sock.sendto(utils.Header(seq_num, 0, syn=1, ack=0).bits(), address)
+
+        opened = 0
+        for sock, seq_num in zip(socks, seq_nums):
+            try:
+                data, _ = sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            synack = utils.bits_to_header(data)
+            sock.sendto(
+                utils.Header(seq_num + 1, synack.seq_num + 1, syn=0, ack=1).bits(),
+                address,
+            )
+            opened += 1
+        elapsed = time.perf_counter() - start
+    finally:
+        for sock in socks:
+            sock.close()
+        process.terminate()
+        process.join()
+
+    return {"opened": opened, "per_second": opened / elapsed}
+
+
+def bench_memory(clients):
+    """
+    Measure the memory the connection table holds for established connections,
+    datagrams are fed to the server directly so only its own allocations count.
+    :param clients: number of clients
+    :return: bytes per connection
+    """
+    srv = server.Server(sock=None)
+    now = time.monotonic()
+    addrs = [("10.0.0.1", 1024 + i) for i in range(clients)]
+    syns = [utils.Header(1000, 0, syn=1, ack=0).bits() for _ in addrs]
+    acks = []
+
+    tracemalloc.start()
+    for addr, syn in zip(addrs, syns):
+        (synack,) = srv.handle_datagram(syn, addr, now)
+        acks.append(utils.Header(1001, synack.seq_num + 1, syn=0, ack=1).bits())
+    del synack
+    for addr, ack in zip(addrs, acks):
+        srv.handle_datagram(ack, addr, now)
+    # only count what the server allocated, the connections and their counters,
+    # the datagrams are the benchmark's own
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(True, server.__file__), tracemalloc.Filter(True, metrics.__file__)]
+    )
+    tracemalloc.stop()
+    allocated = sum(stat.size for stat in snapshot.statistics("filename"))
+
+    assert all(
+        connection.server_state is utils.States.ESTABLISHED
+        for connection in srv.connections.values()
+    )
+    return allocated / clients
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Handshake time and memory per connection of the server with N simultaneous clients."
+    )
+    parser.add_argument("--clients", type=int, default=CLIENTS)
+    args = parser.parse_args()
+
+    rate = bench_rate(args.clients)
+    memory = bench_memory(args.clients)
+
+    print(f"{'clients':<22} {args.clients:>10}")
+    print(f"{'opened':<22} {rate['opened']:>10}")
+    print(f"{'connections/s':<22} {rate['per_second']:>10.0f}")
+    print(f"{'bytes/connection':<22} {memory:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
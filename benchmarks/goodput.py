@@ -0,0 +1,75 @@
+"""
+Goodput against segment size. The same binary payload is sent over loopback with
+every segment size, the payload bytes delivered per second are reported along
+with the share of every datagram that is payload.
+
+Run from the root of the project:
+    python -m benchmarks.goodput --size 1 --window 64
+"""
+import argparse
+import os
+import socket
+import threading
+import time
+
+import client
+import server
+import utils
+
+# segment sizes measured, from the original 12 bytes up to the largest one
+SEGMENT_SIZES = (12, 64, 256, 512, 1024, utils.MAX_MSS)
+
+MB = 1024 * 1024
+
+
+def bench(srv, data, mss, window):
+    """
+    Send the data with one segment size.
+    :param srv: running server.Server
+    :param data: payload
+    :param mss: segment size to ask for
+    :param window: segments in flight
+    :return: seconds the transfer took
+    """
+    sender = client.Client(window=window, mss=mss, address=srv.sock.getsockname())
+    assert sender.mss == mss
+
+    start = time.perf_counter()
+    sender.send_reliable_message(data)
+    elapsed = time.perf_counter() - start
+
+    connection = srv.connections[(server.UDP_IP, sender.sock.getsockname()[1])]
+    assert connection.message == data
+    # the teardown is not measured, the server evicts the connection
+    sender.sock.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Goodput and payload share of every datagram against the segment size, over the loopback."
+    )
+    parser.add_argument("--size", type=float, default=1, help="MB sent per segment size")
+    parser.add_argument("--window", type=int, default=64)
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    sock.bind((server.UDP_IP, 0))
+    srv = server.Server(sock)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+
+    data = os.urandom(int(args.size * MB))
+
+    print(f"{'mss':>6} {'payload %':>10} {'seconds':>8} {'goodput MB/s':>13}")
+    for mss in SEGMENT_SIZES:
+        elapsed = bench(srv, data, mss, args.window)
+        efficiency = mss / (mss + utils.HEADER_SIZE)
+        print(
+            f"{mss:>6} {efficiency * 100:>10.1f} {elapsed:>8.2f} "
+            f"{len(data) / MB / elapsed:>13.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Micro-benchmark of the header codec, encode and decode cost per packet
+for the packed binary format and the original ascii format.
+
+Run from the root of the project:
+    python -m benchmarks.header_codec
+"""
+import timeit
+
+import utils
+
+# number of packets encoded/decoded per measurement
+NUMBER = 100_000
+# measurements taken, the fastest one is reported
+REPEAT = 5
+
+PAYLOAD = b"x" * 12
+
+
+def _per_packet(stmt):
+    """
+    Time a statement and return the best cost of a single call in nanoseconds.
+    :param stmt: callable to time
+    :return: nanoseconds per call
+    """
+    return min(timeit.repeat(stmt, number=NUMBER, repeat=REPEAT)) / NUMBER * 1e9
+
+
+def bench(ascii_header):
+    """
+    Measure encode and decode of a data segment in one wire format.
+    :param ascii_header: use the ascii compatibility format
+    :return: dict with the header size and the per packet costs
+    """
+    utils.ASCII_HEADER = ascii_header
+    header = utils.Header(1234, 5678, syn=0, ack=1)
+    data = header.bits(PAYLOAD) + PAYLOAD
+
+    def decode():
+        utils.checksum_ok(data)
+        utils.bits_to_header(data)
+        utils.get_body_from_data(data)
+
+    return {
+        "header_bytes": utils.header_size(),
+        "encode_ns": _per_packet(lambda: header.bits(PAYLOAD)),
+        "decode_ns": _per_packet(decode),
+    }
+
+
+def main():
+    results = {"binary": bench(False), "ascii": bench(True)}
+    utils.ASCII_HEADER = False
+
+    print(f"{'format':<8} {'bytes':>6} {'encode ns':>10} {'decode ns':>10}")
+    for name, result in results.items():
+        print(
+            f"{name:<8} {result['header_bytes']:>6} "
+            f"{result['encode_ns']:>10.0f} {result['decode_ns']:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
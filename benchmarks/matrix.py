@@ -0,0 +1,316 @@
+"""
+Transfer benchmark over a matrix of message sizes, drop probabilities, channel delays
+and windows, with a regression check against a stored baseline.
+
+Every cell is run in the deterministic simulation of sim.py with a few seeds. Apart
+from the CPU time the metrics are in virtual time, they only change when the
+protocol does. The results are written as JSON, a previous result can be given as
+the baseline and the run fails if any cell got worse by more than the tolerance. The
+CPU time is reported against the baseline but not checked, the baseline may come
+from another machine.
+
+Run from the root of the project:
+    python -m benchmarks.matrix --output results.json --baseline benchmarks/baseline.json
+"""
+import argparse
+import collections
+import itertools
+import json
+import random
+import sys
+import time
+
+import channel
+import client
+import server
+import sim
+import utils
+
+# the matrix measured by default, the channel's sleep_factor and queue are kept
+SIZES = (1000, 20000)
+P_DROPS = (0.0, 0.1, 0.3)
+SLEEP_VS = (0.01, 0.05)
+WINDOWS = (1, 16)
+
+# runs per cell, with seeds 0 .. SEEDS - 1
+SEEDS = 3
+
+# metrics where a higher value is better, the others are better lower
+HIGHER_IS_BETTER = {"goodput"}
+
+# relative change tolerated by the regression check. The CPU time depends on the
+# machine and its load, not only on the protocol, so it is left out of the check
+TOLERANCE = 0.05
+
+MB = 1024 * 1024
+
+
+class TracedSimulation(sim.Simulation):
+    """
+    A simulation that records when every data segment was first sent, how often
+    segments were resent, and when each segment was delivered in order at the server.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # first transmission time of every segment by sequence number, and the
+        # sequence numbers in the order they were first sent
+        self.first_sent = {}
+        self.in_flight = collections.deque()
+        self.retransmissions = 0
+        # seconds from the first transmission to the in order delivery of every segment
+        self.latencies = []
+
+    def send(self, sock, data):
+        header = utils.bits_to_header(data)
+        if len(data) > utils.header_length(data) and not header.syn and not header.fin:
+            if header.seq_num in self.first_sent:
+                self.retransmissions += 1
+            else:
+                self.first_sent[header.seq_num] = self.now
+                self.in_flight.append(header.seq_num)
+        super().send(sock, data)
+
+    def deliver(self, flow, data):
+        super().deliver(flow, data)
+        connection = self.server.connections.get(flow.addr)
+        if connection is None:
+            return
+        while self.in_flight and self.in_flight[0] <= connection.last_received_seq_num:
+            seq_num = self.in_flight.popleft()
+            self.latencies.append(self.now - self.first_sent[seq_num])
+
+
+def _percentile(values, q):
+    """
+    Nearest rank percentile.
+    :param values: sorted list of numbers
+    :param q: percentile between 0 and 100
+    :return: the percentile, None for an empty list
+    """
+    if not values:
+        return None
+    rank = max(int(round(q / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def bench(size, p_drop, sleep_v, window, seeds=SEEDS, ack_delay=server.ACK_DELAY, **kwargs):
+    """
+    Run one cell of the matrix.
+    :param size: message size in bytes
+    :param p_drop: drop probability in both directions
+    :param sleep_v: smallest delay of the channel in seconds
+    :param window: window of the client
+    :param seeds: number of runs
+    :param ack_delay: seconds the server may hold back an ack
+    :param kwargs: further arguments of client.Client (mode, congestion_control, mss)
+    :return: dict of the metrics
+    """
+    profile = channel.Profile(p_drop_client=p_drop, p_drop_server=p_drop, sleep_v=sleep_v)
+
+    handshakes = []
+    transfers = []
+    latencies = []
+    retransmissions = 0
+    wire_bytes = 0
+    segments = 0
+    acks = 0
+    fast_retransmits = 0
+    timeout_retransmits = 0
+    delivered = 0
+    failed = 0
+    cpu = 0.0
+    for seed in range(seeds):
+        message = random.Random(seed).randbytes(size)
+        start = time.process_time()
+        try:
+            simulation = TracedSimulation(profile, seed, ack_delay=ack_delay)
+            sender = simulation.client(window=window, **kwargs)
+            handshake = simulation.now
+            sender.send_reliable_message(message)
+            transfer = simulation.now - handshake
+            sender.terminate()
+        except sim.SimulationTimeout:
+            failed += 1
+            continue
+        finally:
+            cpu += time.process_time() - start
+
+        handshakes.append(handshake)
+        transfers.append(transfer)
+        latencies.extend(simulation.latencies)
+        retransmissions += simulation.retransmissions
+        wire_bytes += sum(
+            link.stats["bytes"]
+            for link in (simulation.channel.to_server, simulation.channel.to_client)
+        )
+        segments += len(simulation.first_sent) + simulation.retransmissions
+        acks += simulation.channel.to_client.stats["received"]
+        fast_retransmits += sender.fast_retransmits
+        timeout_retransmits += sender.timeout_retransmits
+        delivered += size
+
+    latencies.sort()
+    return {
+        "size": size,
+        "p_drop": p_drop,
+        "sleep_v": sleep_v,
+        "window": window,
+        "runs": seeds,
+        "failed": failed,
+        # bytes per second of virtual time between the handshake and the last ack
+        "goodput": delivered / sum(transfers) if transfers else None,
+        "handshake_latency": sum(handshakes) / len(handshakes) if handshakes else None,
+        "latency_p50": _percentile(latencies, 50),
+        "latency_p99": _percentile(latencies, 99),
+        "retransmissions_per_byte": retransmissions / delivered if delivered else None,
+        # datagram bytes sent in both directions, headers and retransmissions included
+        "wire_bytes_per_byte": wire_bytes / delivered if delivered else None,
+        # datagrams the server sent per data segment the client sent, resent ones included
+        "acks_per_segment": acks / segments if segments else None,
+        # segments the client resent after duplicate acks and after a timeout, over all runs
+        "fast_retransmits": fast_retransmits,
+        "timeout_retransmits": timeout_retransmits,
+        "cpu_seconds": cpu,
+        "cpu_seconds_per_mb": cpu / (size * seeds / MB),
+    }
+
+
+def _key(result):
+    return result["size"], result["p_drop"], result["sleep_v"], result["window"]
+
+
+def _cpu_seconds_per_mb(results):
+    """
+    :param results: list of dicts returned by bench()
+    :return: CPU seconds per MB sent over all the cells
+    """
+    sent = sum(result["size"] * result["runs"] for result in results)
+    return sum(result["cpu_seconds"] for result in results) / (sent / MB)
+
+
+def cpu_change(results, baseline):
+    """
+    The CPU time of the cells both runs have, for information only.
+    :param results: list of dicts returned by bench()
+    :param baseline: list of dicts returned by bench() on a previous commit
+    :return: (baseline, current) CPU seconds per MB, None without common cells
+    """
+    previous = {_key(result): result for result in baseline}
+    common = [result for result in results if _key(result) in previous]
+    if not common:
+        return None
+    return _cpu_seconds_per_mb([previous[_key(result)] for result in common]), _cpu_seconds_per_mb(common)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compare the protocol metrics of the results with a baseline cell by cell.
+    :param results: list of dicts returned by bench()
+    :param baseline: list of dicts returned by bench() on a previous commit
+    :param tolerance: relative change tolerated for the protocol metrics
+    :return: list of regressions, human readable
+    """
+    previous = {_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(_key(result))
+        if before is None:
+            continue
+        if result["failed"] > before["failed"]:
+            regressions.append(f"{_key(result)} failed {before['failed']} -> {result['failed']}")
+
+        for metric in (
+            "goodput",
+            "handshake_latency",
+            "latency_p50",
+            "latency_p99",
+            "retransmissions_per_byte",
+            "wire_bytes_per_byte",
+            "acks_per_segment",
+        ):
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append(
+                    f"{_key(result)} {metric} {old:.6g} -> {new:.6g} ({change * 100:+.1f}% worse)"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transfers over a matrix of sizes, drop probabilities, delays and windows, checked against a baseline."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--p-drops", type=float, nargs="+", default=P_DROPS)
+    parser.add_argument("--sleep-vs", type=float, nargs="+", default=SLEEP_VS)
+    parser.add_argument("--windows", type=int, nargs="+", default=WINDOWS)
+    parser.add_argument("--seeds", type=int, default=SEEDS, help="runs per cell")
+    parser.add_argument(
+        "--mode", choices=[client.GO_BACK_N, client.SELECTIVE_REPEAT, client.SACK], default=client.GO_BACK_N
+    )
+    parser.add_argument("--mss", type=int, default=client.MSS)
+    parser.add_argument("--ack-delay", type=float, default=server.ACK_DELAY)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    results = []
+    for size, p_drop, sleep_v, window in itertools.product(
+        args.sizes, args.p_drops, args.sleep_vs, args.windows
+    ):
+        result = bench(
+            size, p_drop, sleep_v, window, args.seeds, args.ack_delay, mode=args.mode, mss=args.mss
+        )
+        results.append(result)
+        print(
+            f"size {size:>7} p_drop {p_drop:<5} sleep_v {sleep_v:<5} window {window:>3}: "
+            f"{result['goodput'] or 0:>10.1f} B/s, handshake {result['handshake_latency'] or 0:.3f}s, "
+            f"p50 {result['latency_p50'] or 0:.3f}s, p99 {result['latency_p99'] or 0:.3f}s, "
+            f"{result['retransmissions_per_byte'] or 0:.4f} rtx/B, "
+            f"{result['acks_per_segment'] or 0:.2f} acks/seg, "
+            f"{result['cpu_seconds_per_mb']:.2f} cpu s/MB, {result['failed']} failed",
+            file=sys.stderr,
+        )
+
+    document = {
+        "config": {"seeds": args.seeds, "mode": args.mode, "mss": args.mss, "ack_delay": args.ack_delay},
+        "cpu_seconds_per_mb": _cpu_seconds_per_mb(results),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2)
+    else:
+        json.dump(document, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != document["config"]:
+            print("the baseline was run with", baseline["config"], file=sys.stderr)
+        cpu = cpu_change(results, baseline["results"])
+        if cpu:
+            old, new = cpu
+            print(
+                f"cpu_seconds_per_mb {old:.6g} -> {new:.6g} ({(new - old) / old * 100:+.1f}%), "
+                "not checked, it depends on the machine",
+                file=sys.stderr,
+            )
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression, file=sys.stderr)
+        if regressions:
+            raise SystemExit(1)
+        print("no regression against", args.baseline, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Allocation benchmark of the receive path. A transfer is sent over a loopback socket
+and received by the server's pooled recvfrom_into path, and by the previous path
+that allocated a bytes object per datagram and concatenated the message.
+
+The previous path is quadratic in the size of the message, it is measured on a
+smaller transfer.
+
+Run from the root of the project:
+    python -m benchmarks.receive_path --size 100 --legacy-size 4
+"""
+import argparse
+import socket
+import time
+import tracemalloc
+
+import buffers
+import server
+import utils
+
+# payload bytes per datagram, the largest segment size that can be negotiated
+SEGMENT = utils.MAX_MSS
+
+# the acks piling up at the sender are thrown away every BATCH datagrams
+BATCH = 32
+
+MB = 1024 * 1024
+
+
+def _open():
+    """
+    Open the receiving and the sending socket.
+    :return: (receiving socket, sending socket)
+    """
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    receiver.bind((server.UDP_IP, 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind((server.UDP_IP, 0))
+    sender.setblocking(False)
+    return receiver, sender
+
+
+def _send(sender, receiver, receive, size):
+    """
+    Send size bytes in SEGMENT sized datagrams and call receive once per datagram.
+    The datagram is built in place so the sender allocates nothing.
+    :param sender: sending socket
+    :param receiver: receiving socket
+    :param receive: called with no argument to receive one datagram
+    :param size: bytes to transfer
+    :return: None
+    """
+    address = receiver.getsockname()
+    datagram = bytearray(utils.HEADER_SIZE + SEGMENT)
+    view = memoryview(datagram)
+    scratch = bytearray(buffers.RECV_BUFFER_SIZE)
+
+    # the SYN and the handshake ack consumed sequence numbers 0 and 1
+    seq_num = 2
+    sent = 0
+    while sent < size:
+        for _ in range(BATCH):
+            if sent >= size:
+                break
+            length = min(SEGMENT, size - sent)
+            seq_num += length
+            utils.HEADER_STRUCT.pack_into(datagram, 0, seq_num, 0, 0, 0)
+            segment = view[: utils.HEADER_SIZE + length]
+            utils.CHECKSUM_STRUCT.pack_into(datagram, utils.CHECKSUM_OFFSET, utils.checksum(segment))
+            sender.sendto(segment, address)
+            receive()
+            sent += length
+
+        # throw the acks away, they would otherwise fill the socket buffer
+        try:
+            while True:
+                sender.recv_into(scratch)
+        except BlockingIOError:
+            pass
+
+
+def _measure(transfer):
+    """
+    Run a transfer under tracemalloc.
+    :param transfer: callable running the transfer
+    :return: (seconds, peak traced bytes)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    transfer()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_pooled(size):
+    """
+    Receive through Server.receive, recvfrom_into a pooled buffer and append to
+    the bytearray of the connection.
+    :param size: bytes to transfer
+    :return: (seconds, peak traced bytes)
+    """
+    receiver, sender = _open()
+    srv = server.Server(receiver)
+    handshake = [
+        utils.Header(0, 0, syn=1, ack=0, mss=SEGMENT).bits(),
+        utils.Header(1, 1, syn=0, ack=1).bits(),
+    ]
+    for datagram in handshake:
+        sender.sendto(datagram, receiver.getsockname())
+        srv.receive()
+
+    elapsed, peak = _measure(lambda: _send(sender, receiver, srv.receive, size))
+
+    (connection,) = srv.connections.values()
+    assert len(connection.message) == size
+    receiver.close()
+    sender.close()
+    return elapsed, peak
+
+
+def bench_legacy(size):
+    """
+    Receive the way the server used to, recvfrom allocates the datagram, the body
+    is copied out of it and the message is grown by concatenation.
+    :param size: bytes to transfer
+    :return: (seconds, peak traced bytes)
+    """
+    receiver, sender = _open()
+    message = b""
+
+    def receive():
+        nonlocal message
+        data, addr = receiver.recvfrom(buffers.RECV_BUFFER_SIZE)
+        header = utils.bits_to_header(data)
+        message += bytes(data[utils.HEADER_SIZE :])
+        receiver.sendto(utils.Header(0, header.seq_num + 1, syn=1, ack=1).bits(), addr)
+
+    elapsed, peak = _measure(lambda: _send(sender, receiver, receive, size))
+
+    assert len(message) == size
+    receiver.close()
+    sender.close()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Allocations of the pooled receive path against the previous per-datagram bytes path."
+    )
+    parser.add_argument("--size", type=int, default=100, help="MB received pooled")
+    parser.add_argument(
+        "--legacy-size", type=int, default=4, help="MB received the previous way"
+    )
+    args = parser.parse_args()
+
+    results = {
+        "pooled": (args.size * MB, *bench_pooled(args.size * MB)),
+        "legacy": (args.legacy_size * MB, *bench_legacy(args.legacy_size * MB)),
+    }
+
+    print(f"{'path':<8} {'MB':>6} {'seconds':>8} {'MB/s':>8} {'peak MB':>8} {'peak/size':>10}")
+    for name, (size, elapsed, peak) in results.items():
+        print(
+            f"{name:<8} {size / MB:>6.0f} {elapsed:>8.2f} {size / MB / elapsed:>8.1f} "
+            f"{peak / MB:>8.1f} {peak / size:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Load test of the multi-process server, datagrams per second handled by 1 to N
+SO_REUSEPORT workers on the loopback.
+
+Load generator processes open connections and send in order data segments as fast
+as they can, without waiting for acks, so the workers are the bottleneck as long
+as the generators have cores of their own. The datagrams every worker handled are
+taken from the shared counters of workers.Workers.
+
+Run from the root of the project:
+    python -m benchmarks.reuseport --workers 1 2 4 --generators 4
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import time
+
+import server
+import utils
+import workers
+
+# connections per generator process, their ports spread them over the workers
+CONNECTIONS = 64
+
+# seconds every step of the load test runs
+DURATION = 5.0
+
+# payload of every data segment, the default segment size of a client without the MSS option
+PAYLOAD = b"x" * utils.DEFAULT_MSS
+
+# seconds to wait for a SYNACK before the connection is left out
+TIMEOUT = 2.0
+
+
+def generate(address, connections, start, duration, sent):
+    """
+    Open connections, then send data segments round robin over them until the
+    duration is over.
+    :param address: (ip, port) of the workers
+    :param connections: number of connections
+    :param start: multiprocessing event set once every generator completed its handshakes
+    :param duration: seconds to send for
+    :param sent: shared counter the datagrams sent are added to
+    :return: None
+    """
+    socks = []
+    seq_nums = []
+    for _ in range(connections):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(TIMEOUT)
+        seq_num = utils.rand_int()
+        sock.sendto(utils.Header(seq_num, 0, syn=1, ack=0).bits(), address)
+        socks.append(sock)
+        seq_nums.append(seq_num)
+
+    established = []
+    for sock, seq_num in zip(socks, seq_nums):
+        try:
+            data, _ = sock.recvfrom(utils.max_header_size())
+        except socket.timeout:
+            continue
+        synack = utils.bits_to_header(data)
+        sock.sendto(utils.Header(seq_num + 1, synack.seq_num + 1, syn=0, ack=1).bits(), address)
+        # the acks are never read, once the receive buffer is full the kernel drops them
+        sock.setblocking(False)
+        # the first data segment starts after the SYN and the handshake ack
+        established.append([sock, seq_num + 2])
+
+    start.wait()
+    count = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        for connection in established:
+            connection[1] += len(PAYLOAD)
+            header = utils.Header(connection[1], 0, syn=0, ack=0)
+            try:
+                connection[0].sendto(header.bits(PAYLOAD) + PAYLOAD, address)
+            except BlockingIOError:
+                continue
+            count += 1
+
+    with sent.get_lock():
+        sent.value += count
+    for sock in socks:
+        sock.close()
+
+
+def bench(worker_count, generators, connections, duration):
+    """
+    Run one step of the load test.
+    :param worker_count: number of worker processes
+    :param generators: number of load generator processes
+    :param connections: connections per generator
+    :param duration: seconds to send for
+    :return: dict of the datagrams sent and handled per second and the share of every worker
+    """
+    with workers.Workers(worker_count, (server.UDP_IP, 0)) as servers:
+        start = multiprocessing.Event()
+        sent = multiprocessing.Value("Q", 0)
+        processes = [
+            multiprocessing.Process(
+                target=generate,
+                args=(servers.address, connections, start, duration, sent),
+                daemon=True,
+            )
+            for _ in range(generators)
+        ]
+        for process in processes:
+            process.start()
+
+        # the handshakes are not measured, wait until the workers published them
+        deadline = time.perf_counter() + TIMEOUT + server.EVICT_INTERVAL
+        while (
+            servers.stats()["opened"] < generators * connections
+            and time.perf_counter() < deadline
+        ):
+            time.sleep(0.1)
+        time.sleep(server.EVICT_INTERVAL)
+        before = servers.worker_stats()
+
+        start.set()
+        for process in processes:
+            process.join()
+        # the counters are published at the next eviction check
+        time.sleep(server.EVICT_INTERVAL * 1.5)
+        after = servers.worker_stats()
+
+    handled = [b["datagrams"] - a["datagrams"] for a, b in zip(before, after)]
+    return {
+        "sent": sent.value / duration,
+        "handled": sum(handled) / duration,
+        "shares": [count / max(sum(handled), 1) for count in handled],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Datagrams per second handled by 1 to N SO_REUSEPORT workers on the loopback."
+    )
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=sorted({1, 2, os.cpu_count()}), help="worker counts measured"
+    )
+    parser.add_argument("--generators", type=int, default=2, help="load generator processes")
+    parser.add_argument("--connections", type=int, default=CONNECTIONS, help="connections per generator")
+    parser.add_argument("--duration", type=float, default=DURATION)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cores, {args.generators} generators x {args.connections} connections")
+    baseline = None
+    for worker_count in args.workers:
+        result = bench(worker_count, args.generators, args.connections, args.duration)
+        baseline = baseline or result["handled"]
+        shares = " ".join(f"{share:.0%}" for share in result["shares"])
+        print(
+            f"workers {worker_count:>3}: {result['handled']:>10.0f} datagrams/s handled "
+            f"({result['handled'] / baseline:.2f}x), {result['sent']:>10.0f} sent/s, shares {shares}"
+        )
+
+
+if __name__ == "__main__":
+    main()
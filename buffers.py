@@ -0,0 +1,109 @@
+"""
+Preallocated receive buffers and batched datagram I/O.
+
+Datagrams are read with recvfrom_into into a bytearray taken from a pool and parsed
+through a memoryview of it, so receiving allocates nothing per datagram. The buffer
+goes back to the pool once the datagram has been handled, anything kept beyond that
+(an out of order segment, a datagram queued by the channel) has to be copied or has
+to hold on to the buffer until it is done with it.
+
+A non-blocking socket is drained in one pass once the selector reports it readable,
+and segments are sent with sendmsg, the header and the payload are gathered by the
+kernel instead of being concatenated first.
+"""
+import socket
+
+import utils
+
+# largest datagram that can be received, anything longer is truncated
+RECV_BUFFER_SIZE = utils.MAX_DATAGRAM_SIZE
+
+# datagrams received in one pass over a socket before the timers get their turn
+RECV_BATCH = 64
+
+# sendmsg is missing on some platforms (Windows), the datagram is then concatenated
+HAVE_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+# buffers allocated up front, the pool grows past this when they are all in use
+POOL_SIZE = 64
+
+
+class BufferPool:
+    """
+    A free list of equally sized bytearrays.
+    """
+
+    def __init__(self, size=RECV_BUFFER_SIZE, count=POOL_SIZE):
+        """
+        Allocate the buffers.
+        :param size: size of every buffer in bytes
+        :param count: number of buffers allocated up front and kept when released
+        """
+        self.size = size
+        self.count = count
+        self._free = [bytearray(size) for _ in range(count)]
+
+    def acquire(self):
+        """
+        Take a buffer from the pool, a new one is allocated if the pool is empty.
+        :return: bytearray of self.size bytes
+        """
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        """
+        Give a buffer back to the pool, no memoryview of it may be used afterwards.
+        :param buffer: a buffer returned by acquire()
+        :return: None
+        """
+        if len(self._free) < self.count:
+            self._free.append(buffer)
+
+    def recvfrom(self, sock):
+        """
+        Receive a datagram into a buffer of the pool.
+        :param sock: UDP socket
+        :return: (buffer, memoryview of the datagram in the buffer, address), the
+            buffer has to be released once the datagram has been handled
+        """
+        buffer = self.acquire()
+        try:
+            nbytes, addr = sock.recvfrom_into(buffer)
+        except BaseException:
+            self.release(buffer)
+            raise
+        return buffer, memoryview(buffer)[:nbytes], addr
+
+    def recv_batch(self, sock, limit=RECV_BATCH):
+        """
+        Receive the datagrams waiting on a non-blocking socket, each into a buffer
+        of the pool.
+        :param sock: non-blocking UDP socket
+        :param limit: most datagrams received in one pass
+        :return: generator of (buffer, memoryview of the datagram, address), it ends
+            once the socket is drained. Every buffer has to be released
+        """
+        for _ in range(limit):
+            try:
+                yield self.recvfrom(sock)
+            except (BlockingIOError, ConnectionRefusedError):
+                # drained, or the error of a datagram we sent to a closed port
+                return
+
+
+def sendto(sock, header, payload, address):
+    """
+    Send a segment, the header and the payload are gathered by sendmsg.
+    :param sock: UDP socket, or an object with its methods in simulations
+    :param header: encoded header
+    :param payload: bytes-like payload, a view of the message
+    :param address: (ip, port) of the receiver
+    :return: number of bytes sent
+    """
+    if not payload:
+        return sock.sendto(header, address)
+    if HAVE_SENDMSG:
+        return sock.sendmsg((header, payload), (), 0, address)
+    return sock.sendto(header + payload, address)
@@ -0,0 +1,472 @@
+"""
+Packet traces of the client, the server and the channel, and the tools reading them.
+
+A Recorder appends every datagram a program sends, receives or drops to a ring
+buffer file of fixed size slots, memory-mapped so recording is a copy into the page
+cache. The kernel writes the pages back on its own and a background thread syncs the
+file every FLUSH_INTERVAL seconds. Once the ring is full the oldest packets are
+overwritten.
+
+    python server.py --trace server.trace
+    python client.py --trace client.trace
+    python capture.py summary client.trace server.trace
+    python capture.py pcap client.trace server.trace --output rdt.pcap
+
+A slot holds a record header, the time, the kind and the endpoints, and the first
+snaplen bytes of the datagram, the header of the segment by default. The timestamps
+are wall clock times, so the traces of several programs interleave in one timeline.
+The pcap export uses LINKTYPE_USER0, every packet starts with the record header
+without its timestamp (PSEUDO_HEADER) followed by the captured datagram.
+"""
+import argparse
+import bisect
+import collections
+import csv
+import functools
+import heapq
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+
+import metrics
+import utils
+
+# what happened to a datagram, from the point of view of the program recording it
+SENT = 0
+RECEIVED = 1
+DROPPED = 2
+KINDS = {SENT: "sent", RECEIVED: "received", DROPPED: "dropped"}
+
+# magic, version, flags, snaplen, slots, packets recorded so far. The count
+# is written after the slot of a packet, a reader never sees a half written one
+FILE_MAGIC = b"RDTR"
+# version 2: the segment headers carry a checksum, see utils.HEADER_STRUCT
+FILE_VERSION = 2
+FILE_HEADER = struct.Struct("!4sHHIIQ")
+COUNT_OFFSET = FILE_HEADER.size - 8
+# flag of a trace whose headers are in the ascii wire format (utils.ASCII_HEADER)
+FLAG_ASCII = 1
+
+# time, kind, source ip and port, destination ip and port, length of the datagram
+RECORD = struct.Struct("!dBx4sH4sHH")
+# the record without its time, the link layer header of the pcap export
+PSEUDO_HEADER = struct.Struct("!Bx4sH4sHH")
+
+# slots of the ring buffer, the file takes slots * (RECORD.size + snaplen) bytes
+SLOTS = 65536
+
+# seconds between the syncs of the file by the background thread
+FLUSH_INTERVAL = 1.0
+
+# pcap global header and packet header, little endian (LINKTYPE_USER0 = 147)
+PCAP_HEADER = struct.Struct("<IHHiIII")
+PCAP_PACKET = struct.Struct("<IIII")
+PCAP_MAGIC = 0xA1B2C3D4
+LINKTYPE_USER0 = 147
+
+# a recorded datagram, src and dst are (ip, port), data the captured bytes
+Packet = collections.namedtuple("Packet", "time kind src dst length data")
+
+
+@functools.lru_cache(maxsize=1024)
+def _pack_address(address):
+    if address is None:
+        return bytes(4), 0
+    return socket.inet_aton(address[0]), address[1]
+
+
+def _unpack_address(ip, port):
+    return socket.inet_ntoa(ip), port
+
+
+class Recorder:
+    """
+    Appends datagrams to a ring buffer trace file.
+    """
+
+    def __init__(self, path, slots=SLOTS, snaplen=None, clock=time.time):
+        """
+        Create the trace file, an existing one is overwritten.
+        :param path: file to record to
+        :param slots: packets kept, the oldest are overwritten beyond that
+        :param snaplen: bytes captured of every datagram, the largest header by default.
+            Anything shorter could cut a header
+        :param clock: returns the current time in seconds
+        """
+        if snaplen is None:
+            snaplen = utils.max_header_size()
+        elif snaplen < utils.max_header_size():
+            raise ValueError(f"snaplen must hold a header of {utils.max_header_size()} bytes, got {snaplen}")
+        self.slots = slots
+        self.snaplen = snaplen
+        self.slot_size = RECORD.size + self.snaplen
+        self.clock = clock
+        self.count = 0
+
+        size = FILE_HEADER.size + slots * self.slot_size
+        self.file = open(path, "w+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        FILE_HEADER.pack_into(
+            self.map,
+            0,
+            FILE_MAGIC,
+            FILE_VERSION,
+            FLAG_ASCII if utils.ASCII_HEADER else 0,
+            self.snaplen,
+            slots,
+            0,
+        )
+
+        # msync blocks, the sender does not wait for it
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_forever, name="trace-flush", daemon=True)
+        self.flusher.start()
+
+    def record(self, kind, src, dst, data, payload=b""):
+        """
+        Append a datagram, the oldest one is overwritten once the ring is full.
+        :param kind: SENT, RECEIVED or DROPPED
+        :param src: (ip, port) the datagram came from, None if unknown
+        :param dst: (ip, port) the datagram went to, None if unknown
+        :param data: the datagram, or its header when the payload is given apart
+        :param payload: payload following data, sent with sendmsg
+        :return: None
+        """
+        offset = FILE_HEADER.size + self.count % self.slots * self.slot_size
+        length = len(data) + len(payload)
+        RECORD.pack_into(
+            self.map, offset, self.clock(), kind, *_pack_address(src), *_pack_address(dst), length
+        )
+        offset += RECORD.size
+        head = min(len(data), self.snaplen)
+        self.map[offset : offset + head] = data[:head]
+        if payload and head < self.snaplen:
+            tail = min(len(payload), self.snaplen - head)
+            self.map[offset + head : offset + head + tail] = payload[:tail]
+        self.count += 1
+        struct.pack_into("!Q", self.map, COUNT_OFFSET, self.count)
+
+    def flush(self):
+        """
+        Write the trace back to the file.
+        :return: None
+        """
+        self.map.flush()
+
+    def close(self):
+        """
+        Stop recording, the file is synced and closed.
+        :return: None
+        """
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.flusher.join()
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _flush_forever(self):
+        while not self.closed.wait(FLUSH_INTERVAL):
+            self.map.flush()
+
+
+def read(path):
+    """
+    Read the packets of a trace file, oldest first.
+    :param path: file written by a Recorder
+    :return: list of Packet
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, flags, snaplen, slots, count = FILE_HEADER.unpack_from(data)
+    if magic != FILE_MAGIC or version != FILE_VERSION:
+        raise ValueError(f"{path} is not a trace file")
+    if bool(flags & FLAG_ASCII) != utils.ASCII_HEADER:
+        raise ValueError(f"{path} was recorded with ASCII_HEADER={bool(flags & FLAG_ASCII)}")
+
+    slot_size = RECORD.size + snaplen
+    packets = []
+    for i in range(max(count - slots, 0), count):
+        offset = FILE_HEADER.size + i % slots * slot_size
+        when, kind, src_ip, src_port, dst_ip, dst_port, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        packets.append(
+            Packet(
+                when,
+                kind,
+                _unpack_address(src_ip, src_port),
+                _unpack_address(dst_ip, dst_port),
+                length,
+                data[offset : offset + min(length, snaplen)],
+            )
+        )
+    return packets
+
+
+def read_all(paths):
+    """
+    Merge the packets of several trace files in time order.
+    :param paths: files written by Recorders
+    :return: list of (path, Packet)
+    """
+    return list(
+        heapq.merge(
+            *([(path, packet) for packet in read(path)] for path in paths),
+            key=lambda item: item[1].time,
+        )
+    )
+
+
+def connection_key(packet):
+    """
+    :param packet: Packet
+    :return: (local, peer) addresses of the connection the packet belongs to, seen
+        from the program that recorded it
+    """
+    if packet.kind == SENT:
+        return packet.src, packet.dst
+    return packet.dst, packet.src
+
+
+def segments(packets):
+    """
+    Decode the headers of the packets.
+    :param packets: iterable of Packet
+    :return: list of (Packet, utils.Header, payload length)
+    """
+    decoded = []
+    for packet in packets:
+        header = utils.bits_to_header(packet.data)
+        decoded.append((packet, header, packet.length - utils.header_length(packet.data)))
+    return decoded
+
+
+def by_connection(packets):
+    """
+    :param packets: iterable of Packet
+    :return: dict of the decoded segments of every connection, keyed by connection_key()
+    """
+    connections = collections.defaultdict(list)
+    for segment in segments(packets):
+        connections[connection_key(segment[0])].append(segment)
+    return connections
+
+
+def retransmissions(segments):
+    """
+    Find the data segments sent more than once. An episode starts with the first
+    segment sent again and ends once a segment is sent for the first time.
+    :param segments: decoded segments of a connection, see segments()
+    :return: list of (start time, end time, segments resent) per episode
+    """
+    sent = set()
+    episodes = []
+    episode = None
+    for packet, header, size in segments:
+        if packet.kind != SENT or size <= 0 or header.syn:
+            continue
+        if header.seq_num in sent:
+            if episode is None:
+                episode = [packet.time, packet.time, 0]
+                episodes.append(episode)
+            episode[1] = packet.time
+            episode[2] += 1
+        else:
+            sent.add(header.seq_num)
+            episode = None
+    return [tuple(episode) for episode in episodes]
+
+
+def rtt_samples(segments):
+    """
+    Round trip times of the data segments, from a segment sent to the first ack
+    covering it. As in the sender, segments sent more than once give no sample
+    (Karn's rule) and an ack gives one sample, of the newest segment it covers.
+    :param segments: decoded segments of a connection, see segments()
+    :return: list of (time of the ack, round trip time)
+    """
+    # selective repeat acks a segment with its sequence number + 1, the others are cumulative
+    selective_repeat = False
+    # sequence numbers of the segments in flight in order, and when they were sent,
+    # None for the ones sent more than once
+    in_flight = []
+    sent_at = {}
+    samples = []
+    for packet, header, size in segments:
+        if packet.kind == SENT:
+            if header.syn and not header.ack:
+                selective_repeat = bool(header.sr)
+            if size <= 0 or header.syn:
+                continue
+            if header.seq_num in sent_at:
+                sent_at[header.seq_num] = None
+            else:
+                sent_at[header.seq_num] = packet.time
+                bisect.insort(in_flight, header.seq_num)
+        elif packet.kind == RECEIVED and header.ack:
+            if selective_repeat:
+                covered = [header.ack_num - 1] if header.ack_num - 1 in sent_at else []
+            else:
+                covered = in_flight[: bisect.bisect_left(in_flight, header.ack_num)]
+            if not covered:
+                continue
+            newest = sent_at[covered[-1]]
+            if newest is not None:
+                samples.append((packet.time, packet.time - newest))
+            for seq_num in covered:
+                del sent_at[seq_num]
+                in_flight.remove(seq_num)
+    return samples
+
+
+def timeline(items):
+    """
+    :param items: list of (path, Packet), see read_all()
+    :return: list of lines, one per packet
+    """
+    lines = []
+    for path, packet in items:
+        header = utils.bits_to_header(packet.data)
+        flags = "".join(
+            name for name, bit in (("S", header.syn), ("A", header.ack), ("F", header.fin), ("P", header.psh)) if bit
+        )
+        size = packet.length - utils.header_length(packet.data)
+        lines.append(
+            f"{packet.time:.6f} {os.path.basename(path)} {KINDS[packet.kind]:<8} "
+            f"{utils.logfmt_value(packet.src)} > {utils.logfmt_value(packet.dst)} "
+            f"[{flags or '.'}] seq={header.seq_num} ack={header.ack_num} win={header.window} len={size}"
+        )
+    return lines
+
+
+def summary(items):
+    """
+    :param items: list of (path, Packet), see read_all()
+    :return: dict of the statistics of every connection, keyed by "path local > peer"
+    """
+    connections = collections.defaultdict(list)
+    for path, packet in items:
+        connections[path, connection_key(packet)].append(packet)
+
+    result = {}
+    for (path, (local, peer)), packets in connections.items():
+        decoded = segments(packets)
+        kinds = collections.Counter(KINDS[packet.kind] for packet in packets)
+        histogram = metrics.Histogram()
+        for _, sample in rtt_samples(decoded):
+            histogram.observe(sample)
+        episodes = retransmissions(decoded)
+        result[f"{os.path.basename(path)} {utils.logfmt_value(local)} > {utils.logfmt_value(peer)}"] = {
+            "start": packets[0].time,
+            "end": packets[-1].time,
+            "packets": dict(kinds),
+            "bytes": sum(packet.length for packet in packets),
+            "retransmission_episodes": len(episodes),
+            "retransmitted": sum(episode[2] for episode in episodes),
+            "rtt": histogram.snapshot(),
+        }
+    return result
+
+
+def write_csv(items, path):
+    """
+    Write the sequence and ack numbers of every packet as csv, for plotting.
+    :param items: list of (path, Packet), see read_all()
+    :param path: destination file
+    :return: None
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["time", "trace", "kind", "src", "dst", "seq", "ack", "window", "length"])
+        for trace, packet in items:
+            header = utils.bits_to_header(packet.data)
+            writer.writerow(
+                [
+                    f"{packet.time:.6f}",
+                    os.path.basename(trace),
+                    KINDS[packet.kind],
+                    utils.logfmt_value(packet.src),
+                    utils.logfmt_value(packet.dst),
+                    header.seq_num,
+                    header.ack_num,
+                    header.window,
+                    packet.length - utils.header_length(packet.data),
+                ]
+            )
+
+
+def write_pcap(items, path):
+    """
+    Export packets to a pcap file with the link type LINKTYPE_USER0, every packet is
+    the PSEUDO_HEADER followed by the captured bytes of the datagram.
+    :param items: list of (path, Packet), see read_all()
+    :param path: destination file
+    :return: None
+    """
+    snaplen = max((len(packet.data) for _, packet in items), default=0) + PSEUDO_HEADER.size
+    with open(path, "wb") as f:
+        f.write(PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, snaplen, LINKTYPE_USER0))
+        for _, packet in items:
+            pseudo = PSEUDO_HEADER.pack(
+                packet.kind, *_pack_address(packet.src), *_pack_address(packet.dst), packet.length
+            )
+            seconds, fraction = divmod(packet.time, 1)
+            f.write(
+                PCAP_PACKET.pack(
+                    int(seconds),
+                    int(fraction * 1e6),
+                    len(pseudo) + len(packet.data),
+                    len(pseudo) + packet.length,
+                )
+            )
+            f.write(pseudo)
+            f.write(packet.data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("summary", help="packets, retransmissions and round trip times per connection")
+    command.add_argument("traces", nargs="+")
+    command = commands.add_parser("timeline", help="every packet of the traces in time order")
+    command.add_argument("traces", nargs="+")
+    command = commands.add_parser("csv", help="sequence and ack numbers over time, for plotting")
+    command.add_argument("traces", nargs="+")
+    command.add_argument("--output", required=True)
+    command = commands.add_parser("pcap", help="export to pcap, link type LINKTYPE_USER0")
+    command.add_argument("traces", nargs="+")
+    command.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    items = read_all(args.traces)
+    match args.command:
+        case "summary":
+            for name, stats in summary(items).items():
+                rtt = stats["rtt"]
+                mean = rtt["sum"] / rtt["count"] if rtt["count"] else 0.0
+                print(
+                    f"{name}: {stats['end'] - stats['start']:.3f}s, {stats['packets']}, {stats['bytes']} bytes, "
+                    f"{stats['retransmitted']} resent in {stats['retransmission_episodes']} episodes, "
+                    f"{rtt['count']} rtt samples, mean {mean * 1000:.1f} ms"
+                )
+        case "timeline":
+            print("\n".join(timeline(items)))
+        case "csv":
+            write_csv(items, args.output)
+        case "pcap":
+            write_pcap(items, args.output)
+
+
+if __name__ == "__main__":
+    main()
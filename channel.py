@@ -1,220 +1,623 @@
-from multiprocessing import Value
-from threading import Timer
-import threading
-from utils import States
-import multiprocessing
-import random
-import socket
-import time
-import utils
-
-UDP_IP = "127.0.0.1"
-UDP_PORT_CHANNEL = 5007
-UDP_PORT_SERVER = 5008
-
-# order of execution starting scripts: (1) channel, (2) server, then (3) client
-# so in 3 terminals, do the following in order:
-# terminal 1: python channel.py
-# terminal 2: python server.py
-# terminal 3: python client.py
-
-# this is a bidirectional channel sitting between client and server
-# client talks to channel, then channel to server
-# phrased another way, the channel is the "server" for the client
-# server talks to channel, then channel to client
-# phrased another way, the server is the "server" for the channel
-
-# channel binds to UDP_PORT_CHANNEL to listen to client
-# server binds to UDP_PORT_SERVER to listen to channel
-# responses go back to auto-generated ports at client and channel
-
-# in your client, you need to use UDP_PORT_CHANNEL
-# e.g., set UDP_PORT = 5007
-
-# in your server, you need to use UDP_PORT_SERVER
-# e.g., set UDP_PORT = 5008
-
-# assumptions / guarantees:
-# the implementation is not fully concurrency safe and depends upon 
-# eventual resends, otherwise it may fail or hang
-
-# the channel should not drop the initial 3-way handshake or 4-way teardown messages
-# the channel assumes the header has a fin field with the fin bit, checking naming in utils.py
-# the channel may delay and drop any other messages (client->server msgs and server->client acks)
-
-# the channel does NOT buffer messages in the current form, so it 
-# likely will only work with stop-and-wait for client/server
-# because it does not buffer messages, this also means the channel will NOT
-# reorder messages
-
-# however, because a dropped ack can result in the client resending a message, 
-# it can result in duplicated messages at the server due to these resends (so 
-# same payload can be received by server twice), so the 
-# server should handle duplications, which can be done based on 
-# the sequence numbers and keeping track at the server what data 
-# has been received so far
-
-# TODO: buffering could be added, probably using queue.LifoQueue for no reordering,
-# and maybe queue.PriorityQueue with reordering, where the priority of incoming 
-# messages is used to represent any (say random) reordering
-
-# socket for client <-> channel communication
-sock_client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
-sock_client.bind((UDP_IP, UDP_PORT_CHANNEL))
-
-# socket for channel <-> server communication
-sock_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
-
-# timeouts to prevent socket recvs from potentially hanging
-sock_client.settimeout(6.0)
-sock_server.settimeout(6.0)
-
-# small sleep: to reduce latency (can speed testing), set as small as possible (~0.05)
-# to test higher latency channels, try ~0.25
-sleep_v = 0.25
-
-# max delay as multiple of sleep_v; do not set too high, otherwise can cause timeouts
-# if you see client/server timeouts, may need to adjust timeouts in your client/server
-# recommended client timeout: ~3s with these default parameters
-# the total max channel delay is set as the product sleep_v * sleep_factor
-# with sleep_v = 0.05, factor can be up to ~20
-# with sleep_v = 0.25, factor can be up to ~4
-sleep_factor = 4
-
-# used to terminate threads if needed (on ctrl+c, etc.)
-event_terminate = threading.Event()
-
-# messages can be dropped from client to server AND from server to client
-# probability is uniformly distributed in range 0.0 to 1.0
-# for initial testing, suggest using a small value (0.01, so ~1% messages dropped)
-# for final testing, suggest using a large value (0.5, so ~50% messages dropped)
-# untested, but 0.0 should be an ideal channel (no drops) but with delays
-p_drop_server = 0.5 # (roughly) probability to drop an ack from server
-p_drop_client = 0.5 # (roughly) probability to drop a message from client
-
-round = 0 # used for some startup synchronization
-event_wait_send = threading.Event() # used for some recurring synchronization ordering sends/recvs
-teardown_started = False # flag used to not drop messages once teardown has started
-round_startup = 2 # number of rounds of communication to wait before dropping messages (so connection is established)
-addr_client = [] # client address information, used so channel can send back to client
-
-# client listener/sender, forwards client messages to server
-def chan_client():
-	global sock_client, sock_server, event_wait_send, addr_client, teardown_started, round
-	while True:
-		if event_terminate.is_set():
-			break
-	
-		print('waiting on client')
-		
-		try:
-			data_client, addr_client = sock_client.recvfrom(1024)
-		except socket.timeout:
-			# this was not needed on python 3.8+
-			# on python 3.7.x, this exception is needed to prevent hangs
-			# probably a concurrency bug or relationship of timeout values
-			# in client/server implementations
-			# for this case, the message truly is lost, but 
-			# if client/server implement reliable transfer 
-			# (e.g., stop and wait), should be okay (was in our solution
-			# at least tested with 50% message/ack loss probability 
-			# with success)
-			# the same exception has been added on the server channel for the 
-			# same reasoning
-			#
-			# note: these timeouts can occur if enough msgs/acks are dropped in a row
-			# but if client/server resend is working properly, should not matter
-			print('EXCEPTION: client channel timeout, message lost')
-			continue
-		
-		header = utils.bits_to_header(data_client)
-		
-		channel_wait = random.uniform(sleep_v,sleep_factor * sleep_v)
-		time.sleep(channel_wait)
-		print("channel delaying client->server for ", channel_wait, "s")
-
-		if header.fin == 1:
-			teardown_started = True
-
-		# drop messages randomly, after connection established
-		# avoid dropping connection establishment and teardown messages
-		if round >= round_startup and \
-		  (header.ack == 0 and header.syn == 0 and header.fin == 0) and \
-		  random.uniform(0.0,1.0) <= p_drop_client and \
-		  not teardown_started:
-			
-			print("DROPPING MESSAGE FROM CLIENT")
-			continue
-
-		print('channel forwarding to server')
-		sock_server.sendto(data_client, (UDP_IP, UDP_PORT_SERVER))
-		time.sleep(sleep_v)
-		
-		# notify that server has sent without dropping, needed for ordering sends/receives, otherwise can hang
-		event_wait_send.set()
-
-# server listener/sender, forwards server messages to client
-def chan_server():
-	global sock_client, sock_server, event_wait_send, addr_client, round, teardown_started
-	while True:
-		if event_terminate.is_set():
-			break
-
-		print('waiting on server response (can hang if server does not resend)')
-		
-		# primitive synchronization
-		# need to wait until initial client message sent
-		# to server, otherwise socket from server 
-		# is not valid (so sock_server.recvfrom will error)
-		event_wait_send.wait()
-		
-		event_wait_send.clear()
-
-		try:
-			data_server, addr_server = sock_server.recvfrom(1024)
-		except socket.timeout:
-			print('EXCEPTION: server channel timeout, message lost')
-			continue
-		
-		header = utils.bits_to_header(data_server)
-
-		# drop messages randomly
-		# avoids dropping connection establishment and teardown messages
-		if round >= round_startup and \
-		  (header.ack == 1 and header.syn == 0 and header.fin == 0) and \
-		  random.uniform(0.0,1.0) <= p_drop_server and \
-		  not teardown_started:
-			print("DROPPING ACK FROM SERVER")
-			continue
-		
-		print('channel forwarding to client')
-
-		channel_wait = random.uniform(sleep_v, sleep_factor * sleep_v)
-		time.sleep(channel_wait)
-		print("channel delaying server->client for ", channel_wait, "s")
-
-		sock_client.sendto(data_server, (UDP_IP, addr_client[1]))
-		time.sleep(sleep_v)
-		round = round + 1
-
-t_client = threading.Thread(target=chan_client)
-t_server = threading.Thread(target=chan_server)
-
-t_client.start()
-time.sleep(2)
-t_server.start()
-
-# main loop for keeping client/server threads running and termination handling
-while True:
-	try:
-		time.sleep(5)
-		print("round: ", round, "ongoing, waiting 5s (threads sampled faster)")
-		print() # newline
-
-		if not t_client.is_alive() or not t_server.is_alive():
-			print("shutting down channel, client/server threads not running")
-			event_terminate.set()
-			break
-	except:
-		event_terminate.set()
-		break
+import argparse
+import heapq
+import random
+import selectors
+import socket
+import time
+from collections import deque
+import buffers
+import capture
+import metrics
+import utils
+
+UDP_IP = "127.0.0.1"
+UDP_PORT_CHANNEL = 5007
+UDP_PORT_SERVER = 5008
+
+# order of execution starting scripts: (1) channel, (2) server, then (3) client
+# so in 3 terminals, do the following in order:
+# terminal 1: python channel.py
+# terminal 2: python server.py
+# terminal 3: python client.py
+
+# this is a bidirectional channel sitting between client and server
+# client talks to channel, then channel to server
+# phrased another way, the channel is the "server" for the client
+# server talks to channel, then channel to client
+# phrased another way, the server is the "server" for the channel
+
+# channel binds to UDP_PORT_CHANNEL to listen to clients
+# every client gets its own socket towards UDP_PORT_SERVER, so the server
+# still tells the clients apart by address
+# responses go back to auto-generated ports at client and channel
+
+# in your client, you need to use UDP_PORT_CHANNEL
+# e.g., set UDP_PORT = 5007
+
+# in your server, you need to use UDP_PORT_SERVER
+# e.g., set UDP_PORT = 5008
+
+# the channel emulates a network path in each direction (see Link):
+# datagrams wait in a bounded bottleneck queue drained at a configurable
+# bandwidth (token bucket), the queue drops at its tail or early (RED),
+# every datagram then gets a random propagation delay and may be dropped,
+# duplicated or reordered. A single thread receives from every socket and
+# delivers the datagrams from a heap keyed by delivery time, nothing sleeps
+# per datagram so pipelined senders are not serialized
+
+# the channel should not drop the initial 3-way handshake or 4-way teardown messages
+# the channel assumes the header has a fin field with the fin bit, checking naming in utils.py
+# the channel may delay and drop any other messages (client->server msgs and server->client acks)
+# the queue limit applies to every datagram, a full queue can drop anything
+
+# because a dropped ack can result in the client resending a message,
+# it can result in duplicated messages at the server due to these resends (so
+# same payload can be received by server twice), so the
+# server should handle duplications, which can be done based on
+# the sequence numbers and keeping track at the server what data
+# has been received so far
+
+# small sleep: to reduce latency (can speed testing), set as small as possible (~0.05)
+# to test higher latency channels, try ~0.25
+sleep_v = 0.25
+
+# max delay as multiple of sleep_v; do not set too high, otherwise can cause timeouts
+# if you see client/server timeouts, may need to adjust timeouts in your client/server
+# recommended client timeout: ~3s with these default parameters
+# the total max channel delay is set as the product sleep_v * sleep_factor
+# with sleep_v = 0.05, factor can be up to ~20
+# with sleep_v = 0.25, factor can be up to ~4
+sleep_factor = 4
+
+# messages can be dropped from client to server AND from server to client
+# probability is uniformly distributed in range 0.0 to 1.0
+# for initial testing, suggest using a small value (0.01, so ~1% messages dropped)
+# for final testing, suggest using a large value (0.5, so ~50% messages dropped)
+# untested, but 0.0 should be an ideal channel (no drops) but with delays
+p_drop_server = 0.5 # (roughly) probability to drop an ack from server
+p_drop_client = 0.5 # (roughly) probability to drop a message from client
+
+round_startup = 2 # number of rounds of communication to wait before dropping messages (so connection is established)
+
+# queue management of the bottleneck queue
+TAIL_DROP = "taildrop"
+RED = "red"
+
+# datagrams received from the sockets at most per pass of the event loop
+RECV_BATCH = 64
+
+# seconds between the metrics snapshots written by run_channel
+METRICS_INTERVAL = 1.0
+
+# flows without a datagram in either direction for this many seconds are evicted,
+# and their socket towards the server closed. Longer than the largest retransmission
+# timeout of a client, a client backing off after repeated losses is not idle
+IDLE_TIMEOUT = 600.0
+
+# flows whose teardown started are evicted sooner, once a client in TIME_WAIT
+# (30s) can no longer answer a resent FIN of the server
+CLOSED_TIMEOUT = 60.0
+
+# seconds between the checks for flows to evict
+EVICT_INTERVAL = 1.0
+
+
+class Profile:
+	"""
+	Parameters of the emulated path, applied to both directions.
+	"""
+
+	def __init__(self, p_drop_client=p_drop_client, p_drop_server=p_drop_server, sleep_v=sleep_v,
+			sleep_factor=sleep_factor, bandwidth=None, burst=16 * 1024, queue_limit=1000, aqm=TAIL_DROP,
+			red_min=0.25, red_max=0.75, red_p=0.1, red_weight=0.002,
+			reorder=False, p_duplicate=0.0, p_corrupt=0.0):
+		"""
+		:param p_drop_client: probability to drop a message from the client
+		:param p_drop_server: probability to drop an ack from the server
+		:param sleep_v: smallest propagation delay in seconds
+		:param sleep_factor: largest propagation delay as multiple of sleep_v
+		:param bandwidth: bytes per second of the bottleneck, None is unlimited
+		:param burst: bytes that can go through at once after the bottleneck was idle
+		:param queue_limit: datagrams the bottleneck queue holds
+		:param aqm: TAIL_DROP drops when the queue is full, RED drops early with a
+			probability rising with the average queue length
+		:param red_min: RED starts dropping above this average fill of the queue
+		:param red_max: RED drops everything above this average fill of the queue
+		:param red_p: RED drop probability when the average fill reaches red_max
+		:param red_weight: weight of a new sample in the RED average queue length
+		:param reorder: deliver datagrams in the order of their random delays,
+			otherwise a datagram never overtakes an earlier one
+		:param p_duplicate: probability to deliver a datagram twice
+		:param p_corrupt: probability to flip a random bit of a droppable datagram,
+			the receiver drops it for its bad checksum
+		"""
+		self.p_drop_client = p_drop_client
+		self.p_drop_server = p_drop_server
+		self.sleep_v = sleep_v
+		self.sleep_factor = sleep_factor
+		self.bandwidth = bandwidth
+		self.burst = burst
+		self.queue_limit = queue_limit
+		self.aqm = aqm
+		self.red_min = red_min
+		self.red_max = red_max
+		self.red_p = red_p
+		self.red_weight = red_weight
+		self.reorder = reorder
+		self.p_duplicate = p_duplicate
+		self.p_corrupt = p_corrupt
+
+
+# named profiles, selected with --profile
+PROFILES = {
+	# the original channel, slow and very lossy
+	"default": dict(),
+	"lossless": dict(p_drop_client=0.0, p_drop_server=0.0, sleep_v=0.01, sleep_factor=2),
+	"lan": dict(p_drop_client=0.001, p_drop_server=0.001, sleep_v=0.0005, sleep_factor=2, bandwidth=12_500_000),
+	"wan": dict(p_drop_client=0.01, p_drop_server=0.01, sleep_v=0.04, sleep_factor=1.5, bandwidth=1_250_000, queue_limit=100, aqm=RED),
+	"lossy": dict(p_drop_client=0.1, p_drop_server=0.1, sleep_v=0.05, sleep_factor=4, reorder=True, p_duplicate=0.01),
+}
+
+
+def flip_bit(data, rng=random):
+	"""
+	Flip a random bit of a datagram.
+	:param data: the datagram, a writable buffer is changed in place
+	:param rng: random number generator
+	:return: the corrupted datagram, a copy if data is read-only
+	"""
+	bit = rng.randrange(8 * len(data))
+	view = memoryview(data)
+	if view.readonly:
+		copy = bytearray(data)
+		copy[bit >> 3] ^= 1 << (bit & 7)
+		return bytes(copy)
+	view[bit >> 3] ^= 1 << (bit & 7)
+	return data
+
+
+class Link:
+	"""
+	One direction of the path. A datagram waits in the bottleneck queue until the token
+	bucket lets it through, then travels for a random propagation delay. Datagrams in
+	flight are kept in a heap keyed by delivery time.
+	"""
+
+	def __init__(self, name, p_drop, drop_message, profile, rng=random):
+		"""
+		:param name: used in the log lines, "client->server" or "server->client"
+		:param p_drop: probability to drop a droppable datagram
+		:param drop_message: logged at the info level when a datagram is dropped at
+			random, None drops silently
+		:param profile: Profile of the path
+		:param rng: random number generator, seeded for reproducible runs
+		"""
+		self.name = name
+		self.p_drop = p_drop
+		self.drop_message = drop_message
+		self.profile = profile
+		self.rng = rng
+
+		# makes the copy of an item that is delivered twice, items that
+		# hold on to a buffer have to be copied
+		self.duplicate = lambda item: item
+		# flips a bit of the datagram of an item, set by the owner of the items
+		self.corrupt = lambda item: item
+
+		# token bucket of the bottleneck, a negative level is the backlog of the queue
+		self.tokens = profile.burst
+		self.tokens_at = 0.0
+		# departure times of the datagrams in the bottleneck queue
+		self.backlog = deque()
+		# average queue length for RED
+		self.average = 0.0
+
+		# datagrams in flight, (delivery time, counter, item)
+		self.heap = []
+		self.counter = 0
+		# delivery time of the latest datagram, to keep the order without reordering
+		self.last_delivery = 0.0
+
+		# counters, reported when the channel stops
+		self.stats = dict(received=0, bytes=0, dropped=0, queue_dropped=0, duplicated=0, corrupted=0, delivered=0)
+
+	def push(self, now, item, size, droppable):
+		"""
+		Take a datagram.
+		:param now: current time in seconds
+		:param item: what pop() returns once the datagram is delivered
+		:param size: size of the datagram in bytes
+		:param droppable: the datagram may be dropped or corrupted at random
+		:return: list of the items that will be delivered, empty if the datagram was
+			dropped, two entries (the item and self.duplicate(item)) if it was duplicated
+		"""
+		self.stats["received"] += 1
+		self.stats["bytes"] += size
+
+		if droppable and self.rng.uniform(0.0, 1.0) < self.p_drop:
+			if utils.INFO and self.drop_message:
+				utils.info("channel.drop", link=self.name, reason=self.drop_message)
+			self.stats["dropped"] += 1
+			return []
+
+		departure = self._enqueue(now, size)
+		if departure is None:
+			if utils.INFO:
+				utils.info("channel.drop", link=self.name, reason="queue full")
+			self.stats["queue_dropped"] += 1
+			return []
+
+		if droppable and self.profile.p_corrupt and self.rng.uniform(0.0, 1.0) < self.profile.p_corrupt:
+			if utils.DEBUG:
+				utils.debug("channel.corrupt", link=self.name)
+			self.stats["corrupted"] += 1
+			item = self.corrupt(item)
+
+		items = [item]
+		if self.profile.p_duplicate and self.rng.uniform(0.0, 1.0) < self.profile.p_duplicate:
+			self.stats["duplicated"] += 1
+			items.append(self.duplicate(item))
+
+		for item in items:
+			delay = self.rng.uniform(self.profile.sleep_v, self.profile.sleep_factor * self.profile.sleep_v)
+			delivery = departure + delay
+			if not self.profile.reorder:
+				delivery = max(delivery, self.last_delivery)
+				self.last_delivery = delivery
+			if utils.DEBUG:
+				utils.debug("channel.delay", link=self.name, delay=f"{delivery - now:.4f}")
+			self.counter += 1
+			heapq.heappush(self.heap, (delivery, self.counter, item))
+		return items
+
+	def next_delivery(self):
+		"""
+		:return: delivery time of the next datagram, None if nothing is in flight
+		"""
+		return self.heap[0][0] if self.heap else None
+
+	def pop(self, now):
+		"""
+		Take the datagrams whose delivery time has come.
+		:param now: current time in seconds
+		:return: list of items in delivery order
+		"""
+		due = []
+		while self.heap and self.heap[0][0] <= now:
+			due.append(heapq.heappop(self.heap)[2])
+		self.stats["delivered"] += len(due)
+		return due
+
+	def _enqueue(self, now, size):
+		"""
+		Put a datagram in the bottleneck queue.
+		:param now: current time in seconds
+		:param size: size of the datagram in bytes
+		:return: time the datagram leaves the queue, None if the queue dropped it
+		"""
+		while self.backlog and self.backlog[0] <= now:
+			self.backlog.popleft()
+
+		queued = len(self.backlog)
+		if self.profile.aqm == RED:
+			self.average += self.profile.red_weight * (queued - self.average)
+			fill = self.average / self.profile.queue_limit
+			if fill >= self.profile.red_max:
+				return None
+			if fill > self.profile.red_min:
+				p = self.profile.red_p * (fill - self.profile.red_min) / (self.profile.red_max - self.profile.red_min)
+				if self.rng.uniform(0.0, 1.0) < p:
+					return None
+		if queued >= self.profile.queue_limit:
+			return None
+
+		if self.profile.bandwidth is None:
+			return now
+
+		# refill the bucket, the datagram leaves once the tokens it takes are there
+		self.tokens = min(self.profile.burst, self.tokens + (now - self.tokens_at) * self.profile.bandwidth)
+		self.tokens_at = now
+		self.tokens -= size
+		departure = now if self.tokens >= 0 else now - self.tokens / self.profile.bandwidth
+		self.backlog.append(departure)
+		return departure
+
+
+class Flow:
+	"""
+	State of the channel for one client.
+	"""
+
+	__slots__ = ("addr", "teardown_started", "round", "upstream", "counters", "last_active", "in_flight")
+
+	def __init__(self, addr, now=0.0):
+		self.addr = addr
+		# flag used to not drop messages once teardown has started
+		self.teardown_started = False
+		# acks forwarded to the client, no message is dropped for round_startup rounds
+		self.round = 0
+		# socket towards the server, owned by the runner
+		self.upstream = None
+		# datagrams of the flow dropped in either direction, see metrics.py
+		self.counters = metrics.new_counters()
+		# when a datagram of the flow last arrived, and the datagrams of the flow
+		# waiting for delivery, a flow is only evicted once idle with nothing in flight
+		self.last_active = now
+		self.in_flight = 0
+
+
+class Channel:
+	"""
+	The channel without sockets, datagrams are handed in with the time they arrived
+	and handed out once delivered. run_channel() drives it from real sockets.
+	"""
+
+	def __init__(self, profile=None, rng=random):
+		"""
+		:param profile: Profile of the path, the module knobs by default
+		:param rng: random number generator, seeded for reproducible runs
+		"""
+		self.profile = profile or Profile()
+		self.to_server = Link("client->server", self.profile.p_drop_client,
+			"DROPPING MESSAGE FROM CLIENT", self.profile, rng)
+		self.to_client = Link("server->client", self.profile.p_drop_server,
+			"DROPPING ACK FROM SERVER", self.profile, rng)
+		for link in (self.to_server, self.to_client):
+			link.corrupt = lambda item: (item[0], flip_bit(item[1], rng))
+		# flows keyed by the address of their client
+		self.flows = {}
+		# flows evicted so far
+		self.evicted = 0
+
+	def from_client(self, now, addr, data, item=None):
+		"""
+		A datagram arrived from a client.
+		:param now: current time in seconds
+		:param addr: address of the client
+		:param data: the datagram
+		:param item: what is delivered, data by default
+		:return: (flow, list of the items that will be delivered)
+		"""
+		flow = self.flows.get(addr)
+		if flow is None:
+			flow = self.flows[addr] = Flow(addr, now)
+		flow.last_active = now
+
+		header = utils.bits_to_header(data)
+		if header.fin == 1:
+			flow.teardown_started = True
+
+		# drop messages randomly, after connection established
+		# avoid dropping connection establishment and teardown messages
+		droppable = flow.round >= round_startup and \
+			(header.ack == 0 and header.syn == 0 and header.fin == 0) and \
+			not flow.teardown_started
+
+		items = self.to_server.push(now, (flow, data if item is None else item), len(data), droppable)
+		flow.in_flight += len(items)
+		if not items:
+			flow.counters[metrics.DROPPED] += 1
+		return flow, items
+
+	def from_server(self, now, flow, data, item=None):
+		"""
+		A datagram arrived from the server for a client.
+		:param now: current time in seconds
+		:param flow: the flow of the client
+		:param data: the datagram
+		:param item: what is delivered, data by default
+		:return: list of the items that will be delivered
+		"""
+		header = utils.bits_to_header(data)
+		flow.last_active = now
+
+		# drop messages randomly
+		# avoids dropping connection establishment and teardown messages
+		droppable = flow.round >= round_startup and \
+			(header.ack == 1 and header.syn == 0 and header.fin == 0) and \
+			not flow.teardown_started
+
+		items = self.to_client.push(now, (flow, data if item is None else item), len(data), droppable)
+		flow.in_flight += len(items)
+		if items:
+			flow.round += 1
+		else:
+			flow.counters[metrics.DROPPED] += 1
+		return items
+
+	def next_delivery(self):
+		"""
+		:return: time of the next delivery in either direction, None if nothing is in flight
+		"""
+		times = [t for t in (self.to_server.next_delivery(), self.to_client.next_delivery()) if t is not None]
+		return min(times) if times else None
+
+	def deliver(self, now):
+		"""
+		Take the datagrams whose delivery time has come.
+		:param now: current time in seconds
+		:return: (list of (flow, item) for the server, list of (flow, item) for the clients)
+		"""
+		to_server, to_client = self.to_server.pop(now), self.to_client.pop(now)
+		for flow, _ in to_server:
+			flow.in_flight -= 1
+		for flow, _ in to_client:
+			flow.in_flight -= 1
+		return to_server, to_client
+
+	def evict(self, now):
+		"""
+		Forget the flows that are idle and have nothing in flight.
+		:param now: current time in seconds
+		:return: list of the evicted flows, their upstream sockets are for the caller to close
+		"""
+		evicted = [
+			flow
+			for flow in self.flows.values()
+			if not flow.in_flight
+			and now - flow.last_active > (CLOSED_TIMEOUT if flow.teardown_started else IDLE_TIMEOUT)
+		]
+		for flow in evicted:
+			if utils.INFO:
+				utils.info("channel.evict", addr=flow.addr, teardown=flow.teardown_started)
+			del self.flows[flow.addr]
+		self.evicted += len(evicted)
+		return evicted
+
+	def metrics_snapshot(self, now):
+		"""
+		:param now: current time in seconds
+		:return: dict of the counters of both links and the datagrams dropped per flow
+		"""
+		return {
+			"time": now,
+			"links": {link.name: dict(link.stats) for link in (self.to_server, self.to_client)},
+			"evicted_flows": self.evicted,
+			"flows": {
+				f"{addr[0]}:{addr[1]}": {"dropped": flow.counters[metrics.DROPPED]}
+				for addr, flow in self.flows.items()
+			},
+		}
+
+
+def run_channel(channel, listen_addr=(UDP_IP, UDP_PORT_CHANNEL), server_addr=(UDP_IP, UDP_PORT_SERVER),
+		metrics_path=None, trace=None):
+	"""
+	Relay datagrams between the clients and the server through the channel, forever.
+	:param channel: the Channel
+	:param listen_addr: address the clients send to
+	:param server_addr: address of the server
+	:param metrics_path: file the metrics_snapshot() of the channel is written to
+		every METRICS_INTERVAL seconds, None writes none
+	:param trace: capture.Recorder the datagrams received, dropped and forwarded are
+		recorded to
+	:return: None
+	"""
+	# socket for client <-> channel communication
+	sock_client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
+	sock_client.bind(listen_addr)
+	sock_client.setblocking(False)
+
+	selector = selectors.DefaultSelector()
+	selector.register(sock_client, selectors.EVENT_READ)
+
+	# datagrams are held in pooled buffers until they are delivered, a
+	# duplicate is a copy so every buffer is released exactly once
+	pool = buffers.BufferPool()
+	for link in (channel.to_server, channel.to_client):
+		link.duplicate = lambda item: (item[0], (None, bytes(item[1][1])))
+		link.corrupt = lambda item, rng=link.rng: (item[0], (item[1][0], flip_bit(item[1][1], rng)))
+
+	def release(item):
+		buffer, data = item
+		if buffer is not None:
+			pool.release(buffer)
+
+	next_metrics = time.monotonic() + METRICS_INTERVAL if metrics_path else None
+	next_eviction = time.monotonic() + EVICT_INTERVAL
+
+	while True:
+		deadlines = [t for t in (channel.next_delivery(), next_metrics, next_eviction) if t is not None]
+		timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+
+		for key, _ in selector.select(timeout):
+			sock = key.fileobj
+			for buffer, data, addr in pool.recv_batch(sock, RECV_BATCH):
+				if len(data) < utils.header_size():
+					# a stray datagram, not a segment
+					if utils.INFO:
+						utils.info("channel.drop", addr=addr, reason="short datagram", size=len(data))
+					pool.release(buffer)
+					continue
+				now = time.monotonic()
+				if sock is sock_client:
+					flow, items = channel.from_client(now, addr, data, (buffer, data))
+					if flow.upstream is None:
+						# socket for channel <-> server communication of this client
+						flow.upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
+						flow.upstream.setblocking(False)
+						flow.upstream.connect(server_addr)
+						selector.register(flow.upstream, selectors.EVENT_READ, flow)
+				else:
+					items = channel.from_server(now, key.data, data, (buffer, data))
+				if trace:
+					local = listen_addr if sock is sock_client else sock.getsockname()
+					trace.record(capture.RECEIVED, addr, local, data)
+					if not items:
+						trace.record(capture.DROPPED, addr, local, data)
+				if not items:
+					pool.release(buffer)
+
+		to_server, to_client = channel.deliver(time.monotonic())
+		for flow, item in to_server:
+			if trace:
+				trace.record(capture.SENT, flow.upstream.getsockname(), server_addr, item[1])
+			try:
+				flow.upstream.send(item[1])
+			except (BlockingIOError, ConnectionRefusedError):
+				# full socket buffer or no server yet, the datagram is lost
+				pass
+			release(item)
+		for flow, item in to_client:
+			if trace:
+				trace.record(capture.SENT, listen_addr, flow.addr, item[1])
+			try:
+				sock_client.sendto(item[1], flow.addr)
+			except BlockingIOError:
+				pass
+			release(item)
+
+		if (now := time.monotonic()) >= next_eviction:
+			for flow in channel.evict(now):
+				if flow.upstream is not None:
+					selector.unregister(flow.upstream)
+					flow.upstream.close()
+			next_eviction = now + EVICT_INTERVAL
+
+		if next_metrics is not None and (now := time.monotonic()) >= next_metrics:
+			metrics.write_json(metrics_path, channel.metrics_snapshot(now))
+			next_metrics = now + METRICS_INTERVAL
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--profile", choices=sorted(PROFILES), default="default")
+	parser.add_argument("--p-drop-client", type=float)
+	parser.add_argument("--p-drop-server", type=float)
+	parser.add_argument("--sleep-v", type=float)
+	parser.add_argument("--sleep-factor", type=float)
+	parser.add_argument("--bandwidth", type=float, help="bytes per second of the bottleneck")
+	parser.add_argument("--queue-limit", type=int, help="datagrams the bottleneck queue holds")
+	parser.add_argument("--aqm", choices=[TAIL_DROP, RED])
+	parser.add_argument("--reorder", action="store_true", default=None)
+	parser.add_argument("--p-duplicate", type=float)
+	parser.add_argument("--p-corrupt", type=float, help="probability to flip a bit of a datagram")
+	parser.add_argument("--seed", type=int, help="seed of the random drops and delays")
+	parser.add_argument("--log-level", choices=sorted(utils.LOG_LEVELS), default="warning",
+		help="log drops (info) or every delayed datagram (debug)")
+	parser.add_argument("--metrics", help=f"write the counters of the channel to this json file every {METRICS_INTERVAL:g}s")
+	parser.add_argument("--trace", help="record the datagrams received, dropped and forwarded to this file, see capture.py")
+	args = parser.parse_args()
+	utils.set_log_level(args.log_level)
+
+	options = dict(PROFILES[args.profile])
+	for name in ("p_drop_client", "p_drop_server", "sleep_v", "sleep_factor", "bandwidth",
+			"queue_limit", "aqm", "reorder", "p_duplicate", "p_corrupt"):
+		if getattr(args, name) is not None:
+			options[name] = getattr(args, name)
+
+	channel = Channel(Profile(**options), random.Random(args.seed))
+	trace = capture.Recorder(args.trace) if args.trace else None
+	try:
+		run_channel(channel, metrics_path=args.metrics, trace=trace)
+	except KeyboardInterrupt:
+		print("shutting down channel")
+		for link in (channel.to_server, channel.to_client):
+			print(link.name, link.stats)
+	finally:
+		if trace:
+			trace.close()
+
+
+if __name__ == "__main__":
+	main()
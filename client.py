@@ -1,6 +1,16 @@
 from multiprocessing import Value
+import argparse
+import bisect
+import collections
+import heapq
+import selectors
+import threading
 import time
 from utils import States
+import buffers
+import capture
+import congestion
+import metrics
 import socket
 import utils
 
@@ -10,24 +20,197 @@ UDP_IP = "127.0.0.1"
 # reference to our channel
 UDP_PORT = 5007
 
-MSS = 12  # maximum segment size
+# maximum segment size asked for in the SYN, the server may lower it in the SYNACK.
+# Anything up to utils.MAX_MSS (1396 bytes) fits a datagram without fragmentation
+MSS = utils.DEFAULT_MSS
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Internet  # UDP
+# number of segments the sender keeps in flight, a window of 1 is stop-and-wait
+WINDOW_SIZE = 1
 
-# set a timeout for our socket, this is necessary so that we can catch packets that are dropped
-sock.settimeout(0.5)
+# retransmission strategies of the windowed sender
+GO_BACK_N = "gbn"
+SELECTIVE_REPEAT = "sr"
+# cumulative acks with SACK blocks, only the holes the server reports are resent
+SACK = "sack"
 
+# retransmission timeout in seconds until the first round trip time sample is taken
+INITIAL_RTO = 1.0
 
-def send_udp(message):
+# bounds of the retransmission timeout in seconds
+MIN_RTO = 0.2
+MAX_RTO = 60.0
+
+# gains of the smoothed round trip time and of the round trip time variance,
+# the retransmission timeout is srtt + RTT_K * rttvar (RFC 6298)
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+RTT_K = 4
+
+# round trip time samples kept for plotting, the oldest are dropped so a long
+# transfer does not grow the client
+RTT_HISTORY = 10_000
+
+# duplicate acks after which the missing segment is resent without waiting
+# for the retransmission timer (fast retransmit)
+DUP_ACK_THRESHOLD = 3
+
+# seconds the client stays in TIME_WAIT, answering a resent server FIN, before closing
+TIME_WAIT = 30.0
+
+# keepalive probes sent without an answer before a connection is taken as dead
+KEEPALIVE_PROBES = 3
+
+# fast open cookies the servers issued, keyed by server address. The segment size
+# negotiated along with a cookie bounds the data sent in the next SYN
+fast_open_cookies = {}
+
+
+class Sender:
     """
-    Send a message to the server.
-    :param message: the message to be sent
-    :return: None
+    Window, congestion control and retransmission timeout of a sender, shared by
+    the blocking Client and the asyncio client in aio.py.
     """
-    sock.sendto(message, (UDP_IP, UDP_PORT))
 
+    # counters kept in the metrics of the connection, they start at 0: segments
+    # resent after duplicate acks, segments resent after the retransmission timer
+    # expired and window probes sent
+    fast_retransmits = metrics.Counter(metrics.FAST_RETRANSMITS)
+    timeout_retransmits = metrics.Counter(metrics.TIMEOUT_RETRANSMITS)
+    window_probes = metrics.Counter(metrics.WINDOW_PROBES)
+
+    def __init__(
+        self,
+        window=WINDOW_SIZE,
+        mode=GO_BACK_N,
+        congestion_control=None,
+        mss=MSS,
+        clock=time.monotonic,
+    ):
+        """
+        Initialize the sender state.
+        :param window: number of segments in flight, 1 is stop-and-wait. With
+            congestion control this is the upper bound of the congestion window
+        :param mode: retransmission strategy, GO_BACK_N or SELECTIVE_REPEAT
+        :param congestion_control: name of a congestion control algorithm from
+            congestion.ALGORITHMS, None keeps a fixed window
+        :param mss: maximum segment size to ask for, at most utils.MAX_MSS
+        :param clock: returns the current time in seconds, a virtual clock in simulations
+        """
+        if not 0 < mss <= utils.MAX_MSS:
+            raise ValueError(f"mss must be between 1 and {utils.MAX_MSS}, got {mss}")
+        self.clock = clock
+        # counters, round trip times and time per state, see metrics.py
+        self.metrics = metrics.ConnectionMetrics(States.CLOSED, clock())
+        self.window = window
+        self.mode = mode
+        # the segment size asked for until the handshake, then the negotiated one
+        self.mss = mss
+
+        self.congestion_control = None
+        if congestion_control:
+            self.congestion_control = congestion.create(congestion_control)
+
+        # round trip time estimates, srtt and rttvar stay None until the first sample
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        # (time, sample, srtt, rttvar, rto) of the latest samples, kept for plotting
+        self.rtt_history = collections.deque(maxlen=RTT_HISTORY)
 
-class Client:
+        # duplicate acks received in a row, reset by an ack of new data
+        self.dup_acks = 0
+
+        # the receive window the server advertised, in bytes. A segment is only sent
+        # once it fits, min(cwnd, rwnd) bounds what is in flight
+        self.rwnd = utils.MAX_WINDOW
+        # while the receive window is closed, seconds until the next window probe.
+        # It doubles with every probe up to MAX_RTO (the persist timer)
+        self.persist_timeout = None
+
+    def _negotiate_mss(self, synack_header):
+        """
+        Take the segment size of the SYNACK, a server that does not send
+        the option gets utils.DEFAULT_MSS sized segments.
+        :param synack_header: header of the SYNACK
+        :return: None
+        """
+        if synack_header.mss is None:
+            self.mss = utils.DEFAULT_MSS
+        else:
+            self.mss = min(self.mss, synack_header.mss)
+
+        if utils.DEBUG:
+            utils.debug("client.mss", mss=self.mss)
+
+    def _window(self):
+        """
+        Number of segments that may be in flight, the configured window
+        capped by the congestion window.
+        :return: window in segments
+        """
+        if self.congestion_control is None:
+            return self.window
+        return min(self.window, self.congestion_control.window())
+
+    def _usable(self, seq_num):
+        """
+        Whether a segment fits the receive window, the server can buffer rwnd
+        bytes past the last acknowledged one.
+        :param seq_num: sequence number of the last byte of the segment
+        :return: True if the segment may be sent
+        """
+        return seq_num - self.next_seq_num <= self.rwnd
+
+    def _update_rtt(self, sample):
+        """
+        Update the round trip time estimates and the retransmission timeout with a sample.
+        :param sample: measured round trip time in seconds
+        :return: None
+        """
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(
+                self.srtt - sample
+            )
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * sample
+
+        self._reset_rto()
+        self.rtt_history.append(
+            (self.clock(), sample, self.srtt, self.rttvar, self.rto)
+        )
+        self.metrics.rtt.observe(sample)
+
+        if utils.DEBUG:
+            utils.debug(
+                "client.rtt",
+                sample=f"{sample:.3f}",
+                srtt=f"{self.srtt:.3f}",
+                rto=f"{self.rto:.3f}",
+            )
+
+    def _reset_rto(self):
+        """
+        Compute the retransmission timeout from the current estimates, this clears
+        any backoff. Called on every ack of new data, even when the ack gives no
+        sample because the segment was resent.
+        :return: None
+        """
+        if self.srtt is None:
+            self.rto = INITIAL_RTO
+        else:
+            self.rto = min(max(self.srtt + RTT_K * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def _backoff_rto(self):
+        """
+        Double the retransmission timeout after a timeout.
+        :return: None
+        """
+        self.rto = min(self.rto * 2, MAX_RTO)
+
+
+class Client(Sender):
     """
     The client class is responsible for establishing a connection
     with the server and sending a message.
@@ -40,21 +223,96 @@ class Client:
 
     next_seq_num = 0
 
-    def __init__(self):
+    def __init__(
+        self,
+        window=WINDOW_SIZE,
+        mode=GO_BACK_N,
+        congestion_control=None,
+        address=(UDP_IP, UDP_PORT),
+        mss=MSS,
+        sock=None,
+        clock=time.monotonic,
+        nodelay=False,
+        background_time_wait=True,
+        fast_open=False,
+        cookies=None,
+        trace=None,
+    ):
         """
         Initialize the client state and start the handshake process.
+        :param window: number of segments in flight, 1 is stop-and-wait. With
+            congestion control this is the upper bound of the congestion window
+        :param mode: retransmission strategy, GO_BACK_N, SELECTIVE_REPEAT or SACK
+        :param congestion_control: name of a congestion control algorithm from
+            congestion.ALGORITHMS, None keeps a fixed window
+        :param address: (ip, port) of the server, or of the channel in front of it
+        :param mss: maximum segment size to ask for, at most utils.MAX_MSS
+        :param sock: UDP socket, or an object with the same methods in simulations.
+            A new socket by default
+        :param clock: returns the current time in seconds, a virtual clock in simulations
+        :param nodelay: write() sends at once instead of coalescing small writes
+            into full segments (TCP_NODELAY)
+        :param background_time_wait: terminate() hands the socket to a background
+            thread for TIME_WAIT instead of waiting. Simulations wait on their own clock
+        :param fast_open: ask the server for a fast open cookie. With a cookie of the
+            server the handshake is left to the first send, its SYN carries the first segment
+        :param cookies: dict of the fast open cookies, fast_open_cookies by default
+        :param trace: capture.Recorder the datagrams sent and received are recorded to
         """
+        self.address = address
+        self.trace = trace
+        # address of the socket, known once the first datagram was sent
+        self.local_address = None
+        self.background_time_wait = background_time_wait
+
+        # data written and not sent yet, see write()
+        self.send_buffer = bytearray()
+        self.nodelay = nodelay
+
+        # every client has its own socket, so the server tells connections apart by port
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Internet  # UDP
+            if trace:
+                # the port is picked now instead of on the first send, so the
+                # trace has it from the first datagram on. Bound to the address of
+                # the interface that reaches the server, a socket bound to "" has
+                # 0.0.0.0 as its address. Connecting a UDP socket sends nothing
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+                    probe.connect(address)
+                    sock.bind((probe.getsockname()[0], 0))
+        self.sock = sock
+
+        # set a timeout for our socket, this is necessary so that we can catch packets that are dropped
+        self.sock.settimeout(INITIAL_RTO)
+
+        # acks are received into this buffer, no allocation per ack.
+        # The server sends no payload, a header with options always fits
+        self.recv_buffer = bytearray(utils.max_header_size())
+
+        super().__init__(window, mode, congestion_control, mss, clock)
         self.client_state = States.CLOSED
-        self.handshake()
 
-    def handshake(self):
+        self.fast_open = fast_open
+        self.cookies = fast_open_cookies if cookies is None else cookies
+        # set until the first send when the handshake carries data
+        self.handshake_pending = fast_open and address in self.cookies
+        if not self.handshake_pending:
+            self.handshake()
+
+    def handshake(self, data=b""):
         """
         Perform the handshake process.
-        :return: None
+        :param data: payload of the first data segment to send in the SYN, only with
+            a fast open cookie of the server
+        :return: True if the server received the payload, it is resent otherwise
         """
+        # the payload of the SYN was acknowledged along with the SYN
+        received = False
         recv_header = None
         syn_header = None
         synack_header = None
+        # when the SYN was sent, the SYN-ACK gives the first round trip time sample
+        syn_sent_at = None
         # several state changes necessary in this process, open a while loop
         while True:
             # if we've sent a syn message, we need to wait for a syn_ack message
@@ -76,17 +334,38 @@ class Client:
                     # will increment when message is sent
                     self.next_seq_num = seq_num
 
-                    # Create a header
-                    syn_header = utils.Header(seq_num, 0, syn=1, ack=0)
+                    # an empty cookie asks the server for one
+                    cookie = None
+                    if self.fast_open:
+                        cookie, _ = self.cookies.get(self.address, (b"", None))
+
+                    # Create a header, selective repeat has to be requested in the
+                    # SYN so the server knows to buffer and ack segments individually.
+                    # The segment size is negotiated with the MSS option, SACK
+                    # with the SACK permitted option
+                    syn_header = utils.Header(
+                        seq_num,
+                        0,
+                        syn=1,
+                        ack=0,
+                        sr=self.mode == SELECTIVE_REPEAT,
+                        mss=self.mss,
+                        sack_permitted=self.mode == SACK,
+                        cookie=cookie,
+                    )
 
                     if utils.DEBUG:
-                        print("[DEBUG] Sending SYN")
-                        print(
-                            f"[DEBUG] SEQ: {syn_header.seq_num} | ACK: {syn_header.ack_num}"
+                        utils.debug(
+                            "client.syn",
+                            seq=syn_header.seq_num,
+                            ack=syn_header.ack_num,
+                            cookie=cookie is not None,
                         )
 
                     # send the message
-                    send_udp(syn_header.bits())
+                    payload = data if cookie else b""
+                    self.send_udp(syn_header.bits(payload), payload)
+                    syn_sent_at = self.clock()
 
                     # increment sequence number
                     self.next_seq_num += 1
@@ -94,25 +373,49 @@ class Client:
                 case States.SYN_SENT:
                     # validate incoming message is correct
                     if recv_header.syn == 1 and recv_header.ack == 1:
+                        self._update_rtt(self.clock() - syn_sent_at)
+                        self._negotiate_mss(recv_header)
+                        if self.mode == SACK and not recv_header.sack_permitted:
+                            # the server does not send SACK blocks, its acks are
+                            # plain cumulative acks
+                            self.mode = GO_BACK_N
+
+                        if recv_header.cookie:
+                            self.cookies[self.address] = (recv_header.cookie, self.mss)
+                        elif self.fast_open:
+                            # the server no longer does fast open
+                            self.cookies.pop(self.address, None)
+                        # the SYNACK acks the payload too if the cookie was valid
+                        received = (
+                            bool(data)
+                            and recv_header.ack_num > syn_header.seq_num + 1
+                        )
+
                         ack_number = self.last_received_seq + 1
                         synack_header = utils.Header(
                             self.next_seq_num, ack_number, syn=0, ack=1
                         )
 
                         if utils.DEBUG:
-                            print("[DEBUG] Sending ACK")
-                            print(
-                                f"[DEBUG] SEQ: {synack_header.seq_num} | ACK: {synack_header.ack_num}"
+                            utils.debug(
+                                "client.handshake_ack",
+                                seq=synack_header.seq_num,
+                                ack=synack_header.ack_num,
                             )
 
                         # send the message
-                        send_udp(synack_header.bits())
+                        self.send_udp(synack_header.bits())
 
                         # increment sequence number
                         self.next_seq_num += 1
 
+                        # the payload of the SYN is the first segment, the next one
+                        # follows it like after the ack of a segment
+                        if received:
+                            self.next_seq_num += len(data)
+
                 case _:
-                    return
+                    return received
 
             # update the state
             self.update_state()
@@ -126,21 +429,40 @@ class Client:
         seq_num = self.next_seq_num
         ack_num = self.last_received_seq
 
+        # set once the server's FIN has been received
+        fin_received = False
+        # the final ack, sent again if the server resends its FIN
+        final_ack = None
+
         while True:
             # initialize the message, in the case of a terminate its just a header
             header = None
 
             # if we've sent a fin message, we need to wait for a fin_ack message
-            if self.client_state in {States.FIN_WAIT_1, States.FIN_WAIT_2}:
-                
+            if self.client_state is States.FIN_WAIT_1 or (
+                self.client_state is States.FIN_WAIT_2 and not fin_received
+            ):
                 # wait for response from server, set an infinite loop until we get a response
-                # if timeout occurs, we will continue to wait until the message is received
+                # if timeout occurs, we will continue to wait until the message is received.
+                # Acks of resent data segments may still be queued, anything that is not
+                # the ack of our FIN (syn is not set on it) or the server's FIN is skipped
                 while True:
                     try:
-                        self.receive_ack()
+                        recv_header = self.receive_ack()
                     except socket.timeout:
                         continue
-                    break
+
+                    if recv_header.fin == 1:
+                        fin_received = True
+                    if self.client_state is States.FIN_WAIT_2 and fin_received:
+                        break
+                    if (
+                        self.client_state is States.FIN_WAIT_1
+                        and recv_header.ack == 1
+                        and recv_header.syn == 0
+                        and recv_header.ack_num == seq_num + 1
+                    ):
+                        break
 
             match self.client_state:
                 case States.ESTABLISHED:
@@ -150,8 +472,7 @@ class Client:
                     )
 
                     if utils.DEBUG:
-                        print("[DEBUG] Sending FIN")
-                        print(f"[DEBUG] SEQ: {header.seq_num} | ACK: {header.ack_num}")
+                        utils.debug("client.fin", seq=header.seq_num, ack=header.ack_num)
 
                 case States.FIN_WAIT_1:
                     # increments the last received ack but do not send a response
@@ -160,28 +481,58 @@ class Client:
 
                 case States.FIN_WAIT_2:
                     # send the final ack
-                    header = utils.Header(
+                    header = final_ack = utils.Header(
                         self.next_seq_num, self.last_received_seq, syn=0, ack=1
                     )
 
                     if utils.DEBUG:
-                        print("[DEBUG] Sending FINACK")
-                        print(f"[DEBUG] SEQ: {header.seq_num} | ACK: {header.ack_num}")
+                        utils.debug("client.final_ack", seq=header.seq_num, ack=header.ack_num)
 
                 case States.TIME_WAIT:
-                    # wait 30 seconds and then close
-                    time.sleep(30)
+                    if self.background_time_wait:
+                        # the reaper answers a resent FIN and closes the socket
+                        # once TIME_WAIT is over, the caller does not wait
+                        time_wait_reaper().add(self.sock, self.address, final_ack.bits())
+                        self._update_state(States.CLOSED)
+                        return
+
+                    # wait TIME_WAIT seconds and then close, a FIN arriving in the
+                    # meantime was resent because the final ack was lost
+                    deadline = self.clock() + TIME_WAIT
+                    while (remaining := deadline - self.clock()) > 0:
+                        self.sock.settimeout(remaining)
+                        try:
+                            recv_header = self.receive_ack()
+                        except socket.timeout:
+                            break
+                        if recv_header.fin == 1:
+                            self.send_udp(final_ack.bits())
 
                 case _:
+                    # the connection is over, release the socket
+                    self.sock.close()
                     return
 
             if header:
                 # send the message
-                send_udp(header.bits())
+                self.send_udp(header.bits())
                 self.next_seq_num += 1
 
             self.update_state()
 
+    def send_udp(self, message, payload=b""):
+        """
+        Send a message to the server.
+        :param message: the message to be sent, an encoded header
+        :param payload: payload following the header, it is not copied into the message
+        :return: None
+        """
+        if self.trace:
+            if self.local_address is None:
+                self.local_address = self.sock.getsockname()
+            self.trace.record(capture.SENT, self.local_address, self.address, message, payload)
+        buffers.sendto(self.sock, message, payload, self.address)
+
     def update_state(self):
         """
         Update the state of the client.
@@ -204,57 +555,626 @@ class Client:
         :param new_state: The new state of the client.
         :return: None
         """
-        if utils.DEBUG:
-            print(self.client_state, "->", new_state)
+        if utils.INFO:
+            utils.info("client.state", old=self.client_state, new=new_state)
+        self.metrics.transition(new_state, self.clock())
         self.client_state = new_state
 
+    def keepalive(self, probes=KEEPALIVE_PROBES):
+        """
+        Check that the server still has the connection. A keepalive probe is a
+        segment without payload, the server answers it with an ack. A server that
+        evicted the connection drops it.
+        :param probes: probes sent without an answer before giving up, the wait
+            for an answer doubles with every probe
+        :return: True if the server answered
+        """
+        if self.client_state is not States.ESTABLISHED:
+            return False
+
+        timeout = self.rto
+        for _ in range(probes):
+            self._send_segment(self.next_seq_num, b"")
+            deadline = self.clock() + timeout
+            while (remaining := deadline - self.clock()) > 0:
+                self.sock.settimeout(remaining)
+                try:
+                    header = self.receive_ack()
+                except socket.timeout:
+                    break
+                if header.ack == 1 and header.fin == 0:
+                    return True
+            timeout = min(timeout * 2, MAX_RTO)
+        return False
+
+    def write(self, data):
+        """
+        Queue data on the send buffer. Small writes are coalesced, once a window of
+        full segments is buffered they are sent and acknowledged before write()
+        returns, a partial segment at the end waits for more data or flush(). With
+        nodelay everything buffered is sent at once.
+        :param data: bytes-like object, a str is encoded as utf-8
+        :return: None
+        """
+        if self.client_state is not States.ESTABLISHED and not self.handshake_pending:
+            raise ConnectionError(f"write in {self.client_state}")
+
+        if isinstance(data, str):
+            data = data.encode()
+        self.send_buffer += data
+
+        if self.nodelay:
+            self.flush()
+        elif len(self.send_buffer) >= self.window * self.mss:
+            self._send_buffered(len(self.send_buffer) - len(self.send_buffer) % self.mss)
+
+    def flush(self):
+        """
+        Send everything on the send buffer, the partial segment at the end included,
+        and wait until it is acknowledged.
+        :return: None
+        """
+        if self.send_buffer:
+            self._send_buffered(len(self.send_buffer))
+
+    def close(self):
+        """
+        Send what is left on the send buffer and terminate the connection.
+        :return: None
+        """
+        if self.client_state is States.ESTABLISHED or self.handshake_pending:
+            self.flush()
+        self.terminate()
+
+    def _send_buffered(self, size):
+        """
+        Send the front of the send buffer and drop it from the buffer once acknowledged.
+        :param size: number of bytes to send
+        :return: None
+        """
+        with memoryview(self.send_buffer) as view:
+            self.send_reliable_message(view[:size])
+        del self.send_buffer[:size]
+
     def send_reliable_message(self, message):
         """
-        Send a reliable message to the server. Via stop-and-wait
-        :param message: The message to send.
+        Send a reliable message to the server. Up to self.window segments are in
+        flight, lost segments are recovered with Go-Back-N or Selective Repeat
+        depending on self.mode. A window of 1 is stop-and-wait.
+        :param message: The message to send, bytes, bytearray or memoryview. A str
+            is encoded as utf-8
         :return: None
         """
-        if self.client_state is States.ESTABLISHED:
-            # chunk message into MSS sized chunks
-            chunks = [message[i : i + MSS] for i in range(0, len(message), MSS)]
-            # create a new message for each chunk
-            for chunk in chunks:
-                while True:
-                    # get size of chunk in bytes
-                    chunk_size = len(chunk.encode())
+        if self.client_state is not States.ESTABLISHED and not self.handshake_pending:
+            return
 
-                    # next_seq_num is the sequence number of the next message
-                    # needs to account for chunk size
-                    seq_num = self.next_seq_num + chunk_size
+        if isinstance(message, str):
+            message = message.encode()
 
-                    if utils.DEBUG:
-                        print(f"[DEBUG] Chunk size: {chunk_size}")
-                        print(f"[DEBUG] Next SEQ: {self.next_seq_num}")
-                        print(f"[DEBUG] SEQ: {seq_num}")
+        # segments are views of the message, it is not copied until it is sent
+        data = memoryview(message).cast("B")
 
-                    header = utils.Header(
-                        seq_num, self.last_received_seq + 1, syn=0, ack=0
+        if self.handshake_pending:
+            # the first segment goes in the SYN, it is sized for the segment size
+            # negotiated with the cookie. The rest follows the handshake
+            self.handshake_pending = False
+            _, mss = self.cookies.get(self.address, (None, self.mss))
+            first = data[: min(self.mss, mss)]
+            if self.handshake(first):
+                data = data[len(first) :]
+
+        # chunk message into MSS sized segments, the sequence number of a segment
+        # accounts for its size so it is the sequence number of its last byte
+        segments = []
+        seq_num = self.next_seq_num
+        for i in range(0, len(data), self.mss):
+            chunk = data[i : i + self.mss]
+            seq_num += len(chunk)
+            segments.append((seq_num, chunk))
+
+        self.dup_acks = 0
+        if self.mode == SELECTIVE_REPEAT:
+            self._send_selective_repeat(segments)
+        elif self.mode == SACK:
+            self._send_sack(segments)
+        else:
+            self._send_go_back_n(segments)
+
+        self.sock.settimeout(self.rto)
+
+    def _send_go_back_n(self, segments):
+        """
+        Send segments via Go-Back-N, a single timer goes back to the oldest
+        unacknowledged segment and resends the window when it expires, or as soon
+        as DUP_ACK_THRESHOLD duplicate acks show it was lost.
+        :param segments: list of (seq_num, chunk) tuples
+        :return: None
+        """
+        # base is the oldest unacknowledged segment, next_index the next one to send
+        base = 0
+        next_index = 0
+        # deadline of the retransmission timer, None when no segment is in flight
+        timer_deadline = None
+        # when each segment was last sent and whether it was ever resent,
+        # resent segments give ambiguous round trip times (Karn's rule)
+        sent_at = [0.0] * len(segments)
+        retransmitted = [False] * len(segments)
+        # during fast recovery, the index past the segments that were in flight
+        # when it started. Fast recovery ends once they are all acknowledged
+        recover = None
+
+        while base < len(segments):
+            # fill the window
+            while (
+                next_index < len(segments)
+                and next_index < base + self._window()
+                and self._usable(segments[next_index][0])
+            ):
+                self._send_segment(
+                    *segments[next_index],
+                    push=next_index in (base, len(segments) - 1),
+                )
+                sent_at[next_index] = self.clock()
+                if timer_deadline is None:
+                    timer_deadline = sent_at[next_index] + self.rto
+                next_index += 1
+
+            if timer_deadline is None:
+                # nothing in flight, the receive window has no room for the next segment
+                self._probe_window(segments[next_index][0])
+                continue
+
+            remaining = timer_deadline - self.clock()
+            if remaining <= 0:
+                # timer expired, go back to the oldest unacknowledged segment,
+                # the window is sent again as the congestion window allows
+                if utils.DEBUG:
+                    utils.debug("client.timeout", resent=next_index - base)
+                self.timeout_retransmits += next_index - base
+                self._backoff_rto()
+                if self.congestion_control:
+                    self.congestion_control.on_timeout(
+                        next_index - base, self.clock()
+                    )
+                for i in range(base, next_index):
+                    retransmitted[i] = True
+                next_index = base
+                timer_deadline = None
+                recover = None
+                continue
+
+            try:
+                # wait for ack, no longer than the timer allows
+                self.sock.settimeout(remaining)
+                header = self.receive_ack()
+            except socket.timeout:
+                continue
+
+            # acks are cumulative, every segment below the ack number has been received
+            acked = 0
+            while base < next_index and header.ack_num > segments[base][0]:
+                # update the next sequence number past the acknowledged segment
+                self.next_seq_num = segments[base][0]
+                base += 1
+                acked += 1
+
+            if acked:
+                # the ack was triggered by the newest segment it covers
+                if not retransmitted[base - 1]:
+                    self._update_rtt(self.clock() - sent_at[base - 1])
+                else:
+                    self._reset_rto()
+
+                if recover is not None and base >= recover:
+                    recover = None
+                    if self.congestion_control:
+                        self.congestion_control.on_recovery_end(self.clock())
+                elif self.congestion_control:
+                    self.congestion_control.on_ack(acked, self.clock(), self.srtt)
+
+                # restart the timer for the remaining segments in flight
+                timer_deadline = (
+                    self.clock() + self.rto if base < next_index else None
+                )
+
+            elif (
+                self.dup_acks == DUP_ACK_THRESHOLD
+                and recover is None
+                and base < next_index
+            ):
+                # the segment after the acked data was lost and the server dropped
+                # everything after it, go back to it without waiting for the timer.
+                # The timer is not backed off, the acks show the path still works
+                if utils.DEBUG:
+                    utils.debug(
+                        "client.fast_retransmit",
+                        dup_acks=self.dup_acks,
+                        resent=next_index - base,
                     )
+                self.fast_retransmits += next_index - base
+                if self.congestion_control:
+                    self.congestion_control.on_loss(next_index - base, self.clock())
+                for i in range(base, next_index):
+                    retransmitted[i] = True
+                recover = next_index
+                next_index = base
+                timer_deadline = None
+
+            elif self.dup_acks > DUP_ACK_THRESHOLD and recover is not None:
+                # every further duplicate ack is a segment that left the network
+                if self.congestion_control:
+                    self.congestion_control.on_dup_ack(self.clock())
+
+    def _send_selective_repeat(self, segments):
+        """
+        Send segments via Selective Repeat, every segment is acked individually and
+        only the segments whose own timer expires are resent. The oldest segment is
+        resent early once DUP_ACK_THRESHOLD later segments were acked before it.
+        :param segments: list of (seq_num, chunk) tuples
+        :return: None
+        """
+        # the server acks a segment with its sequence number + 1
+        index_by_ack = {seq_num + 1: i for i, (seq_num, _) in enumerate(segments)}
+        acked = [False] * len(segments)
+
+        # base is the oldest unacknowledged segment, next_index the next one to send
+        base = 0
+        next_index = 0
+        # the per segment timers, a heap of (deadline, index). deadlines holds the
+        # live deadline of every segment, entries of segments acked or resent in
+        # the meantime are skipped when popped
+        timers = []
+        deadlines = [0.0] * len(segments)
+        # when each segment was last sent and whether it was ever resent,
+        # resent segments give ambiguous round trip times (Karn's rule)
+        sent_at = [0.0] * len(segments)
+        retransmitted = [False] * len(segments)
+        # segments acked after the oldest unacknowledged one, its duplicate acks
+        dup_acks = 0
+        # during fast recovery, the index past the segments that were in flight
+        # when it started. Fast recovery ends once they are all acknowledged
+        recover = None
 
+        while base < len(segments):
+            # fill the window
+            while (
+                next_index < len(segments)
+                and next_index < base + self._window()
+                and self._usable(segments[next_index][0])
+            ):
+                self._send_segment(
+                    *segments[next_index],
+                    push=next_index in (base, len(segments) - 1),
+                )
+                sent_at[next_index] = self.clock()
+                deadlines[next_index] = sent_at[next_index] + self.rto
+                heapq.heappush(timers, (deadlines[next_index], next_index))
+                next_index += 1
+
+            # discard the stale timers
+            while timers and (
+                acked[timers[0][1]] or timers[0][0] != deadlines[timers[0][1]]
+            ):
+                heapq.heappop(timers)
+
+            if not timers:
+                # nothing in flight, the receive window has no room for the next segment
+                self._probe_window(segments[next_index][0])
+                continue
+
+            remaining = timers[0][0] - self.clock()
+            if remaining <= 0:
+                # the timer of the oldest segment expired, resend only that segment
+                _, i = heapq.heappop(timers)
+                if utils.DEBUG:
+                    utils.debug("client.timeout", seq=segments[i][0])
+                self.timeout_retransmits += 1
+                # back off once per loss episode, when the head of the window times out
+                if i == base:
+                    self._backoff_rto()
+                    if self.congestion_control:
+                        self.congestion_control.on_timeout(
+                            next_index - base, self.clock()
+                        )
+                    recover = None
+                self._send_segment(*segments[i])
+                sent_at[i] = self.clock()
+                retransmitted[i] = True
+                deadlines[i] = sent_at[i] + self.rto
+                heapq.heappush(timers, (deadlines[i], i))
+                continue
+
+            try:
+                # wait for ack, no longer than the earliest timer allows
+                self.sock.settimeout(remaining)
+                header = self.receive_ack()
+            except socket.timeout:
+                continue
+
+            # acks are individual, only mark the segment the ack belongs to
+            i = index_by_ack.get(header.ack_num)
+            if i is None or not base <= i < next_index or acked[i]:
+                continue
+            acked[i] = True
+            if not retransmitted[i]:
+                self._update_rtt(self.clock() - sent_at[i])
+            else:
+                self._reset_rto()
+
+            if i > base and recover is not None:
+                # during fast recovery a later segment acked is a segment that left the network
+                if self.congestion_control:
+                    self.congestion_control.on_dup_ack(self.clock())
+            elif self.congestion_control:
+                self.congestion_control.on_ack(1, self.clock(), self.srtt)
+
+            if i > base:
+                dup_acks += 1
+                if dup_acks == DUP_ACK_THRESHOLD and recover is None:
+                    # later segments arrive but the oldest one does not, resend it
+                    # without waiting for its timer
                     if utils.DEBUG:
-                        print("[DEBUG] Sending message:", chunk)
-                        print(f"[DEBUG] SEQ: {header.seq_num} | ACK: {header.ack_num}")
+                        utils.debug(
+                            "client.fast_retransmit",
+                            dup_acks=dup_acks,
+                            seq=segments[base][0],
+                        )
+                    self.fast_retransmits += 1
+                    if self.congestion_control:
+                        self.congestion_control.on_loss(next_index - base, self.clock())
+                    self._send_segment(*segments[base])
+                    sent_at[base] = self.clock()
+                    retransmitted[base] = True
+                    deadlines[base] = sent_at[base] + self.rto
+                    heapq.heappush(timers, (deadlines[base], base))
+                    recover = next_index
+                continue
 
-                    # send the message
-                    send_udp(header.bits() + chunk.encode())
+            # slide the window past every acknowledged segment
+            while base < next_index and acked[base]:
+                # update the next sequence number past the acknowledged segment
+                self.next_seq_num = segments[base][0]
+                base += 1
+            dup_acks = 0
 
-                    try:
-                        # wait for ack
-                        header = self.receive_ack()
-                    except socket.timeout:
-                        # we should retry sending the message
+            if recover is not None and base >= recover:
+                recover = None
+                if self.congestion_control:
+                    self.congestion_control.on_recovery_end(self.clock())
+
+    def _send_sack(self, segments):
+        """
+        Send segments with SACK, the acks are cumulative and carry the blocks of
+        segments the server holds beyond the first gap. A scoreboard records the
+        sacked segments, a segment is taken as lost once DUP_ACK_THRESHOLD segments
+        sent after it were sacked and only lost segments are resent (RFC 6675).
+        When the retransmission timer expires every unsacked segment is resent.
+        :param segments: list of (seq_num, chunk) tuples
+        :return: None
+        """
+        # the server reports blocks by the sequence number they start at and
+        # the one of their last byte
+        ends = [seq_num for seq_num, _ in segments]
+        starts = [seq_num - len(chunk) for seq_num, chunk in segments]
+
+        # base is the oldest unacknowledged segment, next_index the next one to send
+        base = 0
+        next_index = 0
+        # deadline of the retransmission timer, None when no segment is in flight
+        timer_deadline = None
+        # when each segment was last sent and whether it was ever resent,
+        # resent segments give ambiguous round trip times (Karn's rule)
+        sent_at = [0.0] * len(segments)
+        retransmitted = [False] * len(segments)
+
+        # the scoreboard. sacked segments are held by the server, in_pipe segments
+        # are in flight and lost ones (a heap of indexes) wait to be resent
+        sacked = [False] * len(segments)
+        in_pipe = [False] * len(segments)
+        pipe = 0
+        lost = []
+        # every transmission is numbered, the numbers of the transmissions that
+        # reached the server are kept sorted. A segment is lost once enough
+        # transmissions made after its own reached the server
+        transmissions = 0
+        sent_as = [0] * len(segments)
+        delivered = []
+        # during fast recovery, the index past the segments that were in flight
+        # when it started. Fast recovery ends once they are all acknowledged
+        recover = None
+
+        while base < len(segments):
+            # resend the lost segments first, then send new ones. The congestion
+            # window bounds the segments in flight, the window bounds how far
+            # past the oldest unacknowledged segment the server has to buffer
+            while pipe < self._window() and (
+                lost
+                or (
+                    next_index < len(segments)
+                    and next_index < base + self.window
+                    and self._usable(ends[next_index])
+                )
+            ):
+                if lost:
+                    i = heapq.heappop(lost)
+                    if i < base or sacked[i]:
                         continue
+                    retransmitted[i] = True
+                else:
+                    i = next_index
+                    next_index += 1
+                self._send_segment(
+                    *segments[i],
+                    push=pipe == 0 or i + 1 == len(segments),
+                )
+                sent_at[i] = self.clock()
+                transmissions += 1
+                sent_as[i] = transmissions
+                in_pipe[i] = True
+                pipe += 1
+                if timer_deadline is None:
+                    timer_deadline = sent_at[i] + self.rto
 
-                    # is the ack valid?
-                    if header.ack_num > self.next_seq_num:
-                        # update the next sequence number and break from the loop
-                        self.next_seq_num += chunk_size
-                        break
+            if timer_deadline is None:
+                # nothing in flight, the receive window has no room for the next segment
+                self._probe_window(ends[next_index])
+                continue
+
+            remaining = timer_deadline - self.clock()
+            if remaining <= 0:
+                # timer expired, every segment that is not sacked is resent
+                # as the congestion window allows
+                if utils.DEBUG:
+                    utils.debug("client.timeout", resent=next_index - base)
+                self._backoff_rto()
+                if self.congestion_control:
+                    self.congestion_control.on_timeout(pipe, self.clock())
+                lost = []
+                for i in range(base, next_index):
+                    if not sacked[i]:
+                        in_pipe[i] = False
+                        lost.append(i)
+                self.timeout_retransmits += len(lost)
+                pipe = 0
+                timer_deadline = None
+                recover = None
+                continue
+
+            try:
+                # wait for ack, no longer than the timer allows
+                self.sock.settimeout(remaining)
+                header = self.receive_ack()
+            except socket.timeout:
+                continue
+
+            # the segment sent last among the ones this ack covers for the first
+            # time, it triggered the ack. Segments sacked before do not count,
+            # the cumulative ack reaching them says nothing about the round trip
+            newest = None
+
+            # the cumulative part, every segment below the ack number has been received
+            acked = 0
+            while base < next_index and header.ack_num > ends[base]:
+                if in_pipe[base]:
+                    in_pipe[base] = False
+                    pipe -= 1
+                if not sacked[base]:
+                    bisect.insort(delivered, sent_as[base])
+                    if newest is None or sent_as[base] > sent_as[newest]:
+                        newest = base
+                # update the next sequence number past the acknowledged segment
+                self.next_seq_num = ends[base]
+                base += 1
+                acked += 1
+
+            # the SACK blocks, mark the segments they cover
+            for start, end in header.sack or ():
+                first = max(bisect.bisect_left(starts, start), base)
+                last = min(bisect.bisect_right(ends, end), next_index)
+                for i in range(first, last):
+                    if not sacked[i]:
+                        sacked[i] = True
+                        bisect.insort(delivered, sent_as[i])
+                        if newest is None or sent_as[i] > sent_as[newest]:
+                            newest = i
+                        if in_pipe[i]:
+                            in_pipe[i] = False
+                            pipe -= 1
+
+            if newest is not None:
+                if not retransmitted[newest]:
+                    self._update_rtt(self.clock() - sent_at[newest])
+                else:
+                    self._reset_rto()
+
+            if acked:
+                if recover is not None and base >= recover:
+                    recover = None
+                    if self.congestion_control:
+                        self.congestion_control.on_recovery_end(self.clock())
+                elif self.congestion_control:
+                    self.congestion_control.on_ack(acked, self.clock(), self.srtt)
+
+                # restart the timer for the remaining segments in flight
+                timer_deadline = (
+                    self.clock() + self.rto if base < next_index else None
+                )
+
+            # a segment in flight is lost once DUP_ACK_THRESHOLD transmissions
+            # made after it reached the server
+            newly_lost = 0
+            for i in range(base, next_index):
+                if in_pipe[i] and (
+                    len(delivered) - bisect.bisect_right(delivered, sent_as[i])
+                    >= DUP_ACK_THRESHOLD
+                ):
+                    in_pipe[i] = False
+                    pipe -= 1
+                    heapq.heappush(lost, i)
+                    newly_lost += 1
+
+            if newly_lost:
+                if utils.DEBUG:
+                    utils.debug("client.fast_retransmit", resent=newly_lost)
+                self.fast_retransmits += newly_lost
+                if recover is None:
+                    # the pipe already leaves out the sacked segments, the
+                    # window is not inflated by duplicate acks
+                    if self.congestion_control:
+                        self.congestion_control.on_loss(pipe + newly_lost, self.clock())
+                    recover = next_index
+
+    def _probe_window(self, seq_num):
+        """
+        Wait for the receive window to open while nothing is in flight. No ack will
+        come by itself, so whenever the persist timer expires a window probe, a
+        segment without payload, asks the server for its window. The timer doubles
+        with every probe up to MAX_RTO.
+        :param seq_num: sequence number of the last byte of the next segment
+        :return: None, either the segment fits the window or a probe was sent
+        """
+        if self.persist_timeout is None:
+            self.persist_timeout = self.rto
+
+        deadline = self.clock() + self.persist_timeout
+        while not self._usable(seq_num):
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                if utils.DEBUG:
+                    utils.debug("client.window_probe", rwnd=self.rwnd)
+                self._send_segment(self.next_seq_num, b"")
+                self.window_probes += 1
+                self.persist_timeout = min(self.persist_timeout * 2, MAX_RTO)
+                return
+
+            try:
+                self.sock.settimeout(remaining)
+                self.receive_ack()
+            except socket.timeout:
+                continue
+
+        self.persist_timeout = None
+
+    def _send_segment(self, seq_num, chunk, push=False):
+        """
+        Send a single data segment.
+        :param seq_num: sequence number of the last byte of the segment
+        :param chunk: payload, a view of the message
+        :param push: no other segment is in flight or this is the last one, the
+            server acks it without delay
+        :return: None
+        """
+        header = utils.Header(
+            seq_num, self.last_received_seq + 1, syn=0, ack=0, psh=push
+        )
+
+        if utils.DEBUG:
+            utils.debug("client.segment", seq=header.seq_num, size=len(chunk), push=push)
+
+        self.send_udp(header.bits(chunk), chunk)
+        counters = self.metrics.counters
+        counters[metrics.SEGMENTS_SENT] += 1
+        counters[metrics.BYTES_SENT] += len(chunk)
 
     def receive_ack(self):
         """
@@ -265,14 +1185,36 @@ class Client:
         last_received_ack = self.last_received_ack
         last_received_seq = self.last_received_seq
 
-        # receive data from the server
-        recv_data, _ = sock.recvfrom(1024)
+        # receive data from the server, a corrupted datagram is dropped
+        while True:
+            nbytes, addr = self.sock.recvfrom_into(self.recv_buffer)
+            data = memoryview(self.recv_buffer)[:nbytes]
+            if self.trace:
+                self.trace.record(capture.RECEIVED, addr, self.local_address, data)
+            if utils.checksum_ok(data):
+                break
+            self.metrics.counters[metrics.CORRUPTED] += 1
 
         # convert the received data to a header
-        header = utils.bits_to_header(recv_data)
+        header = utils.bits_to_header(data)
+        self.metrics.counters[metrics.ACKS_RECEIVED] += 1
 
         if header.ack_num > last_received_ack:
             last_received_ack = header.ack_num
+            self.dup_acks = 0
+        elif (
+            header.ack_num == last_received_ack
+            and header.ack == 1
+            and header.window == self.rwnd
+        ):
+            # a cumulative ack that acknowledges nothing new, a window update is not
+            # a duplicate (RFC 5681)
+            self.dup_acks += 1
+            self.metrics.counters[metrics.DUPLICATE_ACKS] += 1
+
+        # the newest ack carries the current receive window, older ones are stale
+        if header.ack == 1 and header.ack_num == last_received_ack:
+            self.rwnd = header.window
 
         if header.seq_num > last_received_seq:
             last_received_seq = header.seq_num
@@ -284,11 +1226,170 @@ class Client:
         return header
 
 
+class TimeWaitReaper(threading.Thread):
+    """
+    Keeps the sockets of terminated connections through TIME_WAIT in the background.
+    A FIN the server sends again because the final ack was lost is answered with the
+    final ack again, the socket is closed once TIME_WAIT is over.
+    """
+
+    def __init__(self, time_wait=TIME_WAIT):
+        """
+        :param time_wait: seconds a socket is kept
+        """
+        super().__init__(name="time-wait", daemon=True)
+        self.time_wait = time_wait
+        self.selector = selectors.DefaultSelector()
+        # sockets handed over by add() and not registered yet, the
+        # socket pair wakes the thread up when one is added
+        self.lock = threading.Lock()
+        self.added = []
+        self.wakeup, self.waker = socket.socketpair()
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        # (deadline, counter, socket), the counter keeps sockets out of the comparison
+        self.deadlines = []
+        self.counter = 0
+
+    def add(self, sock, address, final_ack):
+        """
+        Hand over the socket of a connection that entered TIME_WAIT.
+        :param sock: the UDP socket of the connection, closed by the reaper
+        :param address: (ip, port) of the server
+        :param final_ack: the final ack, sent again for every FIN received
+        :return: None
+        """
+        with self.lock:
+            self.added.append((sock, address, final_ack, time.monotonic() + self.time_wait))
+        self.waker.send(b"\0")
+
+    def __len__(self):
+        return len(self.deadlines) + len(self.added)
+
+    def run(self):
+        buffer = bytearray(utils.max_header_size())
+        while True:
+            timeout = None
+            if self.deadlines:
+                timeout = max(self.deadlines[0][0] - time.monotonic(), 0)
+
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.wakeup:
+                    self.wakeup.recv(4096)
+                    continue
+                address, final_ack = key.data
+                try:
+                    nbytes, _ = key.fileobj.recvfrom_into(buffer)
+                    data = memoryview(buffer)[:nbytes]
+                    if utils.checksum_ok(data) and utils.bits_to_header(data).fin == 1:
+                        key.fileobj.sendto(final_ack, address)
+                except OSError:
+                    pass
+
+            with self.lock:
+                added, self.added = self.added, []
+            for sock, address, final_ack, deadline in added:
+                sock.setblocking(False)
+                self.selector.register(sock, selectors.EVENT_READ, (address, final_ack))
+                self.counter += 1
+                heapq.heappush(self.deadlines, (deadline, self.counter, sock))
+
+            now = time.monotonic()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, _, sock = heapq.heappop(self.deadlines)
+                self.selector.unregister(sock)
+                sock.close()
+
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def time_wait_reaper():
+    """
+    :return: the TimeWaitReaper of the process, started on first use
+    """
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = TimeWaitReaper(TIME_WAIT)
+            _reaper.start()
+        return _reaper
+
+
 # necessary for freeze_support
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=WINDOW_SIZE,
+        help="number of segments in flight, 1 is stop-and-wait",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=[GO_BACK_N, SELECTIVE_REPEAT, SACK],
+        default=GO_BACK_N,
+        help="retransmission strategy of the windowed sender",
+    )
+    parser.add_argument(
+        "--congestion-control",
+        choices=sorted(congestion.ALGORITHMS),
+        help="congestion control algorithm, --window is then the largest window",
+    )
+    parser.add_argument(
+        "--mss",
+        type=int,
+        default=MSS,
+        help=f"maximum segment size to ask for, up to {utils.MAX_MSS} bytes",
+    )
+    parser.add_argument(
+        "--file",
+        help="send the content of this file instead of the default message",
+    )
+    parser.add_argument(
+        "--cwnd-history",
+        help="write the cwnd/ssthresh time series of the connection to this csv file",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=sorted(utils.LOG_LEVELS),
+        default="warning",
+        help="log state changes (info) or every segment (debug)",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="write the counters of the connection to this json file once it is closed",
+    )
+    parser.add_argument(
+        "--trace",
+        help="record the datagrams sent and received to this file, see capture.py",
+    )
+    args = parser.parse_args()
+    utils.set_log_level(args.log_level)
+    trace = capture.Recorder(args.trace) if args.trace else None
+
     # we create a client, which establishes a connection
-    client = Client()
+    client = Client(
+        window=args.window,
+        mode=args.mode,
+        congestion_control=args.congestion_control,
+        mss=args.mss,
+        trace=trace,
+    )
     # we send a message
-    client.send_reliable_message("This message is to be received in pieces")
+    if args.file:
+        with open(args.file, "rb") as f:
+            client.send_reliable_message(f.read())
+    else:
+        client.send_reliable_message("This message is to be received in pieces")
     # we terminate the connection
     client.terminate()
+
+    if args.cwnd_history and client.congestion_control:
+        client.congestion_control.write_history(args.cwnd_history)
+
+    if args.metrics:
+        metrics.write_json(args.metrics, client.metrics.snapshot(client.clock()))
+
+    if trace:
+        trace.close()
@@ -0,0 +1,246 @@
+"""
+Congestion control for the windowed sender in client.py.
+
+The congestion window (cwnd) is kept in segments. The client never has more than
+min(window, cwnd) segments in flight and reports acks, duplicate acks and losses
+to the algorithm it was created with. Algorithms are selected by name, see ALGORITHMS.
+"""
+import abc
+import collections
+import csv
+
+# congestion window at the start of a connection, in segments
+INITIAL_WINDOW = 2
+
+# slow start threshold at the start of a connection, in segments
+INITIAL_SSTHRESH = 64
+
+# the window never shrinks below this many segments
+MIN_WINDOW = 1
+
+# window changes kept for write_history(), the oldest are dropped so a long
+# transfer does not grow the sender
+HISTORY = 100_000
+
+
+class CongestionControl(abc.ABC):
+    """
+    Base class of the congestion control algorithms. The sender calls
+    on_ack for every ack of new data, on_timeout when the retransmission timer expires
+    and, once it detects losses from duplicate acks, on_loss, on_dup_ack and
+    on_recovery_end around fast recovery.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.cwnd = INITIAL_WINDOW
+        self.ssthresh = INITIAL_SSTHRESH
+        self.in_recovery = False
+        # (time, cwnd, ssthresh) the latest HISTORY times the window changed
+        self.history = collections.deque(maxlen=HISTORY)
+
+    def window(self):
+        """
+        Number of segments the sender may have in flight.
+        :return: the congestion window rounded down, at least MIN_WINDOW
+        """
+        return max(int(self.cwnd), MIN_WINDOW)
+
+    @abc.abstractmethod
+    def on_ack(self, acked, now, rtt):
+        """
+        New data was acknowledged.
+        :param acked: number of segments the ack covers
+        :param now: current time in seconds
+        :param rtt: smoothed round trip time in seconds, None before the first sample
+        :return: None
+        """
+
+    @abc.abstractmethod
+    def on_loss(self, in_flight, now):
+        """
+        A segment was detected lost from duplicate acks, fast recovery starts.
+        :param in_flight: segments in flight when the loss was detected
+        :param now: current time in seconds
+        :return: None
+        """
+
+    def on_dup_ack(self, now):
+        """
+        A duplicate ack arrived during fast recovery, a segment has left the network.
+        :param now: current time in seconds
+        :return: None
+        """
+        if self.in_recovery:
+            self.cwnd += 1
+            self._record(now)
+
+    def on_recovery_end(self, now):
+        """
+        Everything outstanding when fast recovery started has been acknowledged.
+        :param now: current time in seconds
+        :return: None
+        """
+        self.in_recovery = False
+        self.cwnd = self.ssthresh
+        self._record(now)
+
+    def on_timeout(self, in_flight, now):
+        """
+        The retransmission timer expired, the window collapses to one segment.
+        :param in_flight: segments in flight when the timer expired
+        :param now: current time in seconds
+        :return: None
+        """
+        self.ssthresh = max(in_flight / 2, 2)
+        self.cwnd = MIN_WINDOW
+        self.in_recovery = False
+        self._record(now)
+
+    def write_history(self, path):
+        """
+        Write the cwnd and ssthresh time series as csv.
+        :param path: destination file
+        :return: None
+        """
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["time", "cwnd", "ssthresh"])
+            writer.writerows(self.history)
+
+    def _record(self, now):
+        self.history.append((now, self.cwnd, self.ssthresh))
+
+
+class NewReno(CongestionControl):
+    """
+    Slow start, additive increase in congestion avoidance and
+    halving of the window on loss with fast recovery (RFC 6582).
+    """
+
+    name = "reno"
+
+    def on_ack(self, acked, now, rtt):
+        if self.in_recovery:
+            # partial ack, deflate the window by the amount of new data acked
+            self.cwnd = max(self.cwnd - acked + 1, MIN_WINDOW)
+        elif self.cwnd < self.ssthresh:
+            # slow start, one segment per segment acked
+            self.cwnd += acked
+        else:
+            # congestion avoidance, about one segment per round trip
+            self.cwnd += acked / self.cwnd
+        self._record(now)
+
+    def on_loss(self, in_flight, now):
+        self.ssthresh = max(in_flight / 2, 2)
+        # the three duplicate acks mean three segments have left the network
+        self.cwnd = self.ssthresh + 3
+        self.in_recovery = True
+        self._record(now)
+
+
+class Cubic(CongestionControl):
+    """
+    CUBIC (RFC 8312), the window grows as a cubic function of the time since
+    the last loss, centered on the window at which that loss happened.
+    """
+
+    name = "cubic"
+
+    # scaling constant of the cubic function
+    C = 0.4
+    # multiplicative decrease factor
+    BETA = 0.7
+
+    def __init__(self):
+        super().__init__()
+        # window before the last reduction
+        self.w_max = 0.0
+        # start of the current congestion avoidance epoch, None until the first ack in it
+        self.epoch_start = None
+        # time for the cubic function to grow back to w_max
+        self.k = 0.0
+        # window of a standard Reno flow over the same epoch
+        self.w_est = 0.0
+
+    def on_ack(self, acked, now, rtt):
+        if self.in_recovery:
+            self.cwnd = max(self.cwnd - acked + 1, MIN_WINDOW)
+        elif self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self._cubic_update(acked, now, rtt)
+        self._record(now)
+
+    def on_loss(self, in_flight, now):
+        self._reduce()
+        self.cwnd = self.ssthresh + 3
+        self.in_recovery = True
+        self._record(now)
+
+    def on_timeout(self, in_flight, now):
+        self._reduce()
+        self.cwnd = MIN_WINDOW
+        self.in_recovery = False
+        self._record(now)
+
+    def _reduce(self):
+        """
+        Remember the window the loss happened at and shrink it by BETA.
+        :return: None
+        """
+        self.w_max = self.cwnd
+        self.ssthresh = max(self.cwnd * self.BETA, 2)
+        self.epoch_start = None
+
+    def _cubic_update(self, acked, now, rtt):
+        """
+        Grow the window towards the cubic target one round trip ahead.
+        :param acked: number of segments acked
+        :param now: current time in seconds
+        :param rtt: smoothed round trip time in seconds
+        :return: None
+        """
+        rtt = rtt or 0.0
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if self.cwnd < self.w_max:
+                # positive here, math.cbrt needs python 3.11
+                self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3)
+            else:
+                # no loss yet or already past w_max, start the curve here
+                self.k = 0.0
+                self.w_max = self.cwnd
+            self.w_est = self.cwnd
+
+        t = now - self.epoch_start
+        target = self.C * (t + rtt - self.k) ** 3 + self.w_max
+
+        # a Reno flow grows by 3(1 - BETA)/(1 + BETA) segments per round trip,
+        # never be slower than it (the TCP friendly region)
+        self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * acked / self.cwnd
+        target = max(target, self.w_est)
+
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked
+        else:
+            self.cwnd += 0.01 / self.cwnd * acked
+
+
+# algorithms that can be selected by name
+ALGORITHMS = {algorithm.name: algorithm for algorithm in (NewReno, Cubic)}
+
+
+def create(name):
+    """
+    Create a congestion control algorithm from its name.
+    :param name: one of the keys of ALGORITHMS
+    :return: a new CongestionControl
+    """
+    if name not in ALGORITHMS:
+        raise ValueError(
+            f"unknown congestion control {name!r}, expected one of {sorted(ALGORITHMS)}"
+        )
+    return ALGORITHMS[name]()
@@ -0,0 +1,208 @@
+"""
+Counters and histograms of the connections of the client, the server and the channel.
+
+Every connection has its counters in a preallocated array indexed by the constants
+below, counting on the hot path is an item increment and allocates nothing. Round
+trip times go to a histogram with fixed buckets, and the time spent in each state
+is accumulated on every state change. A snapshot is a plain dict, write_json()
+dumps it for a reader polling the file.
+
+    if args.metrics:
+        metrics.write_json(args.metrics, srv.metrics_snapshot(time.monotonic()))
+"""
+import array
+import bisect
+import json
+import os
+
+from utils import States
+
+# counters of a connection, each is the index of its slot in ConnectionMetrics.counters
+COUNTERS = (
+    # sender: data segments sent, resent ones included, and their payload bytes
+    "segments_sent",
+    "bytes_sent",
+    # sender: segments resent after duplicate acks or SACK blocks, and after a timeout
+    "fast_retransmits",
+    "timeout_retransmits",
+    # sender: acks received, those acknowledging nothing new, window probes sent
+    "acks_received",
+    "duplicate_acks",
+    "window_probes",
+    # receiver: data segments received, already received ones, ones buffered out
+    # of order and ones dropped for lack of room, and the bytes delivered in order
+    "segments_received",
+    "duplicates",
+    "out_of_order",
+    "window_drops",
+    "bytes_delivered",
+    # receiver: acks, SYNACKs and FINs sent
+    "acks_sent",
+    # channel: datagrams of the connection dropped at random or by the queue
+    "dropped",
+    # sender: acks dropped for a bad checksum
+    "corrupted",
+)
+(
+    SEGMENTS_SENT,
+    BYTES_SENT,
+    FAST_RETRANSMITS,
+    TIMEOUT_RETRANSMITS,
+    ACKS_RECEIVED,
+    DUPLICATE_ACKS,
+    WINDOW_PROBES,
+    SEGMENTS_RECEIVED,
+    DUPLICATES,
+    OUT_OF_ORDER,
+    WINDOW_DROPS,
+    BYTES_DELIVERED,
+    ACKS_SENT,
+    DROPPED,
+    CORRUPTED,
+) = range(len(COUNTERS))
+
+# upper bounds of the round trip time buckets in seconds, 1 ms doubling up to 65 s,
+# the last bucket takes everything longer
+RTT_BUCKETS = tuple(0.001 * 2**i for i in range(17))
+
+
+def new_counters():
+    """
+    :return: array of len(COUNTERS) zeroed counters
+    """
+    return array.array("Q", bytes(8 * len(COUNTERS)))
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, the buckets are fixed when it is created.
+    """
+
+    __slots__ = ("bounds", "counts", "total")
+
+    def __init__(self, bounds=RTT_BUCKETS):
+        """
+        :param bounds: ascending upper bounds of the buckets
+        """
+        self.bounds = bounds
+        self.counts = array.array("Q", bytes(8 * (len(bounds) + 1)))
+        self.total = 0.0
+
+    def observe(self, value):
+        """
+        Count an observation in the first bucket whose bound is not below it.
+        :param value: the observation
+        :return: None
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def snapshot(self):
+        """
+        :return: dict of the bucket bounds, the counts per bucket, and the number
+            and sum of the observations
+        """
+        return {
+            "bounds": list(self.bounds),
+            "counts": list(self.counts),
+            "count": sum(self.counts),
+            "sum": self.total,
+        }
+
+
+class ConnectionMetrics:
+    """
+    The counters of a connection, the histogram of its round trip times and the
+    time it spent in each state.
+    """
+
+    __slots__ = ("counters", "rtt", "state_times", "state", "since")
+
+    def __init__(self, state, now):
+        """
+        :param state: initial state of the connection
+        :param now: current time in seconds
+        """
+        self.counters = new_counters()
+        self.rtt = Histogram()
+        # seconds spent in each state, indexed by the value of the state
+        self.state_times = array.array("d", bytes(8 * (len(States) + 1)))
+        self.state = state
+        self.since = now
+
+    def transition(self, state, now):
+        """
+        Account the time spent in the current state and enter a new one.
+        :param state: the new state
+        :param now: current time in seconds
+        :return: None
+        """
+        self.state_times[self.state.value] += now - self.since
+        self.state = state
+        self.since = now
+
+    def snapshot(self, now):
+        """
+        :param now: current time in seconds, the current state is accounted up to it
+        :return: dict of the counters, the round trip times and the seconds per state
+        """
+        state_times = {
+            state.name: self.state_times[state.value]
+            for state in States
+            if self.state_times[state.value]
+        }
+        state_times[self.state.name] = state_times.get(self.state.name, 0.0) + now - self.since
+        return {
+            "state": self.state.name,
+            "counters": dict(zip(COUNTERS, self.counters)),
+            "rtt": self.rtt.snapshot(),
+            "state_times": state_times,
+        }
+
+
+class Counter:
+    """
+    An attribute backed by a counter of the metrics of the object, so
+    `self.fast_retransmits += 1` counts in the preallocated array.
+    """
+
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        """
+        :param index: index of the counter, one of the constants above
+        """
+        self.index = index
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj.metrics.counters[self.index]
+
+    def __set__(self, obj, value):
+        obj.metrics.counters[self.index] = value
+
+
+def add_counters(totals, counters):
+    """
+    Add the counters of a connection to running totals.
+    :param totals: array from new_counters()
+    :param counters: array from new_counters()
+    :return: None
+    """
+    for i, value in enumerate(counters):
+        totals[i] += value
+
+
+def write_json(path, snapshot):
+    """
+    Write a snapshot as JSON. The file is replaced at once, a reader never sees a
+    partial snapshot.
+    :param path: file to write
+    :param snapshot: dict of the snapshot
+    :return: None
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot, f, indent=1)
+    os.replace(tmp, path)
@@ -0,0 +1,171 @@
+"""
+Pool of established client connections, so sending another message to a server
+does not cost a handshake and a teardown.
+
+    connections = pool.ConnectionPool(window=16, mss=1396)
+    connections.send(("127.0.0.1", 5007), b"first message")
+    connections.send(("127.0.0.1", 5007), b"second message")
+    connections.close()
+
+A connection carries a stream, the server receives the messages sent over it one
+after the other. Connections idle for longer than the idle timeout are terminated,
+and a connection idle for longer than the keepalive interval is probed before it is
+handed out again, a server that evicted it in the meantime would drop its segments.
+"""
+import collections
+import contextlib
+import time
+
+import client
+import utils
+from utils import States
+
+# idle connections kept per server address, further ones are terminated on release
+MAX_IDLE = 8
+
+# seconds a connection may stay idle in the pool before it is terminated, well
+# below the idle timeout of the server (server.IDLE_TIMEOUT)
+IDLE_TIMEOUT = 60.0
+
+# seconds of idleness after which a connection is probed before it is handed out
+KEEPALIVE_INTERVAL = 15.0
+
+
+class ConnectionPool:
+    """
+    Established client.Client connections keyed by server address. acquire() hands
+    out an idle connection or opens a new one, release() puts it back.
+    """
+
+    def __init__(
+        self,
+        max_idle=MAX_IDLE,
+        idle_timeout=IDLE_TIMEOUT,
+        keepalive_interval=KEEPALIVE_INTERVAL,
+        clock=time.monotonic,
+        factory=None,
+        **kwargs,
+    ):
+        """
+        :param max_idle: idle connections kept per server address
+        :param idle_timeout: seconds an idle connection is kept
+        :param keepalive_interval: seconds of idleness after which a connection is
+            probed before reuse
+        :param clock: returns the current time in seconds
+        :param factory: called with the address to open a connection, a
+            client.Client by default. Simulations open theirs on the fabric
+        :param kwargs: arguments of client.Client for new connections (window, mode,
+            congestion_control, mss, nodelay)
+        """
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.clock = clock
+        self.factory = factory
+        self.kwargs = kwargs
+
+        # address -> deque of (time the connection was released, Client), the most
+        # recently released connection is at the right end
+        self.idle = collections.defaultdict(collections.deque)
+
+        # connections opened, reused and dropped after a failed keepalive
+        self.opened = 0
+        self.reused = 0
+        self.dead = 0
+
+    def acquire(self, address):
+        """
+        Take an idle connection to the server, or open a new one.
+        :param address: (ip, port) of the server, or of the channel in front of it
+        :return: an established client.Client
+        """
+        self.evict_idle()
+        idle = self.idle.get(address)
+        while idle:
+            released_at, connection = idle.pop()
+            if (
+                self.clock() - released_at < self.keepalive_interval
+                or connection.keepalive()
+            ):
+                self.reused += 1
+                return connection
+
+            # the server evicted the connection, it has nothing to tear down
+            if utils.INFO:
+                utils.info("pool.dead", addr=connection.sock.getsockname())
+            self.dead += 1
+            connection.sock.close()
+
+        self.opened += 1
+        return self._connect(address)
+
+    def release(self, connection):
+        """
+        Put a connection back into the pool, it is terminated if the pool is full.
+        :param connection: client.Client taken with acquire()
+        :return: None
+        """
+        if connection.client_state is not States.ESTABLISHED:
+            return
+        idle = self.idle[connection.address]
+        if len(idle) >= self.max_idle:
+            connection.close()
+            return
+        idle.append((self.clock(), connection))
+
+    @contextlib.contextmanager
+    def connection(self, address):
+        """
+        Use a connection of the pool, it is released afterwards. A connection that
+        raised is terminated instead, its state is unknown.
+        :param address: (ip, port) of the server
+        :return: context manager yielding a client.Client
+        """
+        connection = self.acquire(address)
+        try:
+            yield connection
+        except BaseException:
+            connection.sock.close()
+            raise
+        self.release(connection)
+
+    def send(self, address, message):
+        """
+        Send a message over a pooled connection and wait until it is acknowledged.
+        :param address: (ip, port) of the server
+        :param message: bytes-like object or str
+        :return: None
+        """
+        with self.connection(address) as connection:
+            connection.send_reliable_message(message)
+
+    def evict_idle(self):
+        """
+        Terminate the connections idle for longer than the idle timeout.
+        :return: number of connections terminated
+        """
+        now = self.clock()
+        evicted = 0
+        for idle in self.idle.values():
+            # the least recently released connections are at the left end
+            while idle and now - idle[0][0] >= self.idle_timeout:
+                _, connection = idle.popleft()
+                connection.close()
+                evicted += 1
+        return evicted
+
+    def close(self):
+        """
+        Terminate every idle connection.
+        :return: None
+        """
+        for idle in self.idle.values():
+            while idle:
+                _, connection = idle.popleft()
+                connection.close()
+        self.idle.clear()
+
+    def _connect(self, address):
+        if self.factory:
+            return self.factory(address)
+        return client.Client(address=address, clock=self.clock, **self.kwargs)
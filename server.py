@@ -1,4 +1,13 @@
+import argparse
+import hashlib
+import hmac
+import os
+import selectors
 import socket
+import time
+import buffers
+import capture
+import metrics
 import utils
 from utils import States
 
@@ -8,201 +17,973 @@ UDP_IP = "127.0.0.1"
 # reference to our channel
 UDP_PORT = 5008
 
-# initial server_state
-server_state = States.CLOSED
-
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Internet  # UDP
-
-sock.bind((UDP_IP, UDP_PORT))  # wait for connection
-
-# initialize the message
-message = ""
-
-# initialize the received header, body and addr
-header = None
-body = None
-addr = (
-    None,
-    None,
-)
-
-# this is used to keep track of the last received sequence number to prevent the server
-# from incrementing the sequence number when it receives a duplicate message
-# or a message is dropped/out of order
-last_received_seq_num = 0
-
-
-# Some helper functions to keep the code clean and tidy
-def _update_server_state(new_state):
+# maximum number of out of order segments buffered under selective repeat
+RECEIVE_WINDOW = 64
+
+# bytes every connection buffers, in order data the application did not read yet and
+# out of order data beyond it. The free space is advertised to the client as the
+# receive window. Holds RECEIVE_WINDOW segments of the largest segment size
+RECEIVE_BUFFER = 128 * 1024
+
+# connections without any message from their client for this many seconds are evicted.
+# Longer than the largest retransmission timeout of the client (client.MAX_RTO), a
+# client backing off after repeated losses is not idle
+IDLE_TIMEOUT = 600.0
+
+# connections that are half-open (handshake not completed) or half-closed (teardown
+# not completed) are evicted sooner, their client is most likely gone
+HALF_CLOSED_TIMEOUT = 10.0
+
+# how often, in seconds, the connection table is checked for connections to evict
+EVICT_INTERVAL = 1.0
+
+# seconds the ack of an in order full size segment is held back, waiting for a
+# second segment to ack both at once (delayed acks). 0 acks every segment
+ACK_DELAY = 0.04
+
+# bytes of a fast open cookie, a MAC of the client's ip under the server's key
+COOKIE_SIZE = 8
+
+# we need to wait for a client message in these states
+WAITING_STATES = {
+    States.LISTEN,
+    States.SYN_SENT,
+    States.ESTABLISHED,
+    States.LAST_ACK,
+}
+
+# states of half-open and half-closed connections
+HALF_CLOSED_STATES = {
+    States.SYN_RECEIVED,
+    States.SYN_SENT,
+    States.CLOSE_WAIT,
+    States.LAST_ACK,
+}
+
+ORG_STATE_TO_NEW_STATE = {
+    States.CLOSED: States.LISTEN,
+    States.LISTEN: States.SYN_RECEIVED,
+    States.SYN_RECEIVED: States.SYN_SENT,
+    States.SYN_SENT: States.ESTABLISHED,
+    States.ESTABLISHED: States.CLOSE_WAIT,
+    States.CLOSE_WAIT: States.LAST_ACK,
+    States.LAST_ACK: States.CLOSED,
+}
+
+
+class Connection:
     """
-    Update the server state and print the transition if in debug mode.
-    :param new_state: the new state
-    :return: None
+    The state of a single client connection. The server state machine runs once
+    per connection, handle() feeds it the messages of its client one at a time.
     """
-    global server_state
-
-    # print the transition if in debug mode
-    if utils.DEBUG:
-        # print the transition
-        print("[STATE CHANGE]", server_state, "->", new_state)
-
-    # update the state
-    server_state = new_state
 
+    __slots__ = (
+        "addr",
+        "server_state",
+        "next_seq_num",
+        "ack_number",
+        "last_received_seq_num",
+        "selective_repeat",
+        "sack",
+        "out_of_order",
+        "buffer",
+        "receive_buffer",
+        "message",
+        "last_active",
+        "mss",
+        "delay_acks",
+        "delayed_ack",
+        "cookie",
+        "sink",
+        "metrics",
+    )
+
+    def __init__(
+        self,
+        addr,
+        now,
+        mss=utils.MAX_MSS,
+        receive_buffer=RECEIVE_BUFFER,
+        delay_acks=True,
+        cookie=None,
+        sink=None,
+    ):
+        """
+        Initialize the state of a new connection.
+        :param addr: (ip, port) of the client
+        :param now: current time in seconds
+        :param mss: largest segment size the server accepts
+        :param receive_buffer: size of the receive buffer in bytes
+        :param delay_acks: hold back the ack of every other full size segment
+        :param cookie: fast open cookie of the client, None when fast open is off
+        :param sink: takes the payloads at their offsets in the stream instead of
+            the receive buffer, see Server
+        """
+        self.addr = addr
+        self.server_state = States.CLOSED
+        self.next_seq_num = 0
+        self.ack_number = 0
+
+        # this is used to keep track of the last received sequence number to prevent the server
+        # from incrementing the sequence number when it receives a duplicate message
+        # or a message is dropped/out of order
+        self.last_received_seq_num = 0
+
+        # set when the client asked for selective repeat in its SYN, out of order segments
+        # are then buffered instead of discarded and every segment is acked individually
+        self.selective_repeat = False
+
+        # set when the client sent the SACK permitted option in its SYN, out of order
+        # segments are then buffered and reported in SACK blocks of the cumulative acks
+        self.sack = False
+
+        # out of order segments waiting for the gap before them to be filled,
+        # keyed by the sequence number the segment starts at. With a sink they
+        # are written out on arrival and only their lengths are kept
+        self.out_of_order = {}
+
+        # the in order payloads the application did not read yet, they are appended in
+        # place as they arrive and read() takes them from the front. The client may
+        # send up to receive_buffer bytes past the last byte read
+        self.buffer = bytearray()
+        self.receive_buffer = receive_buffer
+
+        # the message, collected from the buffer when the server has no consumer
+        self.message = bytearray()
+
+        # when the client was last heard from, used to evict idle connections
+        self.last_active = now
+
+        # the largest segment size we accept until the SYN, then the negotiated one
+        self.mss = mss
+
+        # the ack held back until a second segment arrives or the server's ack
+        # timer expires, None when every segment received is acked
+        self.delay_acks = delay_acks
+        self.delayed_ack = None
+
+        # the fast open cookie the client is issued, and the one its SYN must carry
+        # for the payload to be accepted. None once the client did not ask for it
+        self.cookie = cookie
+
+        # written the payload of every segment at its offset in the stream, in order
+        # or not, nothing is buffered. None buffers the stream for the application
+        self.sink = sink
+
+        # counters and time per state, see metrics.py
+        self.metrics = metrics.ConnectionMetrics(self.server_state, now)
+
+    def _update_server_state(self, new_state):
+        """
+        Update the server state and log the transition.
+        :param new_state: the new state
+        :return: None
+        """
+        if utils.INFO:
+            utils.info("server.state", addr=self.addr, old=self.server_state, new=new_state)
+
+        # the transition happens while handling a message of the client
+        self.metrics.transition(new_state, self.last_active)
+        self.server_state = new_state
+
+    def window(self):
+        """
+        The receive window, the bytes that can still be buffered beyond the last in order byte.
+        :return: window in bytes
+        """
+        return min(max(self.receive_buffer - len(self.buffer), 0), utils.MAX_WINDOW)
+
+    def read(self, size=-1):
+        """
+        Take in order bytes from the receive buffer, this opens the receive window.
+        :param size: largest number of bytes to read, all of them if negative
+        :return: bytes, empty if nothing was received since the last read
+        """
+        if size < 0 or size >= len(self.buffer):
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        else:
+            data = bytes(memoryview(self.buffer)[:size])
+            del self.buffer[:size]
+        return data
+
+    def update_server_state(self):
+        """
+        Update the server state based on the current state.
+        :return: None
+        """
+        self._update_server_state(ORG_STATE_TO_NEW_STATE[self.server_state])
+
+    def handle(self, header, body):
+        """
+        Run the state machine on a message from the client, until the connection
+        waits for the next message.
+        :param header: header of the message
+        :param body: payload of the message
+        :return: list of response headers to send to the client
+        """
+        responses = []
+
+        # the message is consumed by the first state that waits for one,
+        # the next state that waits for a message ends this call
+        received = False
+
+        while True:
+            if self.server_state in WAITING_STATES:
+                if received:
+                    return responses
+                received = True
+
+            # initialize the response header
+            resp_header = None
+
+            match self.server_state:
+                case States.CLOSED:
+                    pass
+                case States.LISTEN:
+                    # if we receive a syn message we need to enter SYN_RECEIVED state
+                    if header.syn != 1:
+                        return responses
+
+                    # create a random sequence number
+                    seq_number = utils.rand_int()
+
+                    # will increment when header is sent
+                    self.next_seq_num = seq_number
+
+                    # increment the ack number
+                    self.ack_number = header.seq_num + 1
+
+                    # remember the retransmission strategy the client asked for
+                    self.selective_repeat = header.sr == 1
+                    self.sack = header.sack_permitted and not self.selective_repeat
+
+                    # the segment size is the smaller of the one the client asked
+                    # for and ours, a client without the option sends the default
+                    if header.mss is None:
+                        self.mss = utils.DEFAULT_MSS
+                    else:
+                        self.mss = min(header.mss, self.mss)
+
+                    # a SYN carrying a valid fast open cookie has its payload received
+                    # right away, a round trip before the handshake completes. The payload
+                    # is the first data segment, it starts after the SYN and the handshake
+                    # ack. Without a valid cookie it is dropped and the client resends it
+                    if header.cookie is None:
+                        self.cookie = None
+                    elif (
+                        self.cookie is not None
+                        and body
+                        and len(body) <= min(self.mss, self.window())
+                        and hmac.compare_digest(header.cookie, self.cookie)
+                    ):
+                        self._deliver(self.ack_number + 1, body)
+                        self.last_received_seq_num = self.ack_number + 1 + len(body)
+                        counters = self.metrics.counters
+                        counters[metrics.SEGMENTS_RECEIVED] += 1
+                        counters[metrics.BYTES_DELIVERED] += len(body)
+
+                case States.SYN_RECEIVED:
+                    # Create a header, seq number is defined above
+                    resp_header = self._synack(self.next_seq_num)
+
+                    if utils.DEBUG:
+                        utils.debug(
+                            "server.synack",
+                            addr=self.addr,
+                            seq=resp_header.seq_num,
+                            ack=resp_header.ack_num,
+                        )
+
+                case States.SYN_SENT:
+                    # a data segment acking our SYNACK completes the handshake as
+                    # well, the handshake ack was lost. It is then received below.
+                    # So does a FIN, the client only closes once established and
+                    # its FIN may overtake the handshake ack of an empty connection
+                    lost_ack = header.fin == 1 or (
+                        header.syn == 0
+                        and len(body) > 0
+                        and header.ack_num == self.next_seq_num
+                    )
+                    if header.ack == 1 or lost_ack:
+                        # update the state client is now established
+                        self.update_server_state()
+
+                        # the SYN and the handshake ack each consume a sequence
+                        # number, the first data segment starts right after them
+                        # unless it came with a fast open SYN
+                        self.last_received_seq_num = max(
+                            self.last_received_seq_num, self.ack_number + 1
+                        )
+                        received = not lost_ack
+                    elif header.syn == 1 and header.fin == 0:
+                        # the client sent its SYN again, our SYNACK was lost
+                        responses.append(self._synack(self.next_seq_num - 1))
+                    continue
+
+                case States.ESTABLISHED:
+                    if not header.fin:
+                        resp_header = self._receive_segment(header, body)
+                    else:
+                        # the ack of the FIN covers a held back ack
+                        self.delayed_ack = None
+                        self.ack_number = header.seq_num + 1
+                        resp_header = utils.Header(
+                            self.next_seq_num, self.ack_number, syn=0, ack=1
+                        )
+                        self.next_seq_num += 1
+
+                        # update the state and send message from ESTABLISHED to CLOSE_WAIT
+                        self.update_server_state()
+                    if resp_header:
+                        responses.append(resp_header)
+
+                    # our own FIN is built in CLOSE_WAIT on the next pass of the loop
+                    continue
+
+                case States.CLOSE_WAIT:
+                    resp_header = utils.Header(
+                        self.next_seq_num, self.ack_number, syn=0, ack=0, fin=1
+                    )
 
-def update_server_state():
-    """
-    Update the server state based on the current state.
-    :return: None
-    """
-    ORG_STATE_TO_NEW_STATE = {
-        States.CLOSED: States.LISTEN,
-        States.LISTEN: States.SYN_RECEIVED,
-        States.SYN_RECEIVED: States.SYN_SENT,
-        States.SYN_SENT: States.ESTABLISHED,
-        States.ESTABLISHED: States.CLOSE_WAIT,
-        States.CLOSE_WAIT: States.LAST_ACK,
-        States.LAST_ACK: States.CLOSED,
-    }
+                case States.LAST_ACK:
+                    # Check if the client replied with an ack
+                    if header.ack == 1:
+                        # update the state, the connection is over
+                        self.update_server_state()
+                    elif header.fin == 1:
+                        # the client sent its FIN again, our ack or FIN was lost
+                        responses.append(
+                            utils.Header(
+                                self.next_seq_num - 2, self.ack_number, syn=0, ack=1
+                            )
+                        )
+                        responses.append(
+                            utils.Header(
+                                self.next_seq_num - 1,
+                                self.ack_number,
+                                syn=0,
+                                ack=0,
+                                fin=1,
+                            )
+                        )
+                    return responses
+
+                case _:
+                    utils.logger.error(
+                        "server.invalid_state",
+                        extra={"fields": {"addr": self.addr, "state": self.server_state}},
+                    )
+                    exit(1)
+
+            if self.server_state in {
+                States.CLOSED,
+                States.LISTEN,
+                States.SYN_RECEIVED,
+                States.CLOSE_WAIT,
+            }:
+                self.update_server_state()
+
+            # send the response header if it exists and the server is not established
+            # established state is handled above and is unique enough to break our pattern
+            # so we handle it separately. Additionally we must increment the next_seq_num, ESTABLISHED
+            # also increments the next_seq_num
+            if resp_header:
+                responses.append(resp_header)
+                self.next_seq_num += 1
+
+    def _synack(self, seq_num):
+        """
+        The SYNACK, it also acknowledges the payload of a fast open SYN.
+        :param seq_num: sequence number of the SYNACK
+        :return: the header
+        """
+        # last_received_seq_num is only past the SYN once a fast open SYN was received
+        return utils.Header(
+            seq_num,
+            max(self.ack_number, self.last_received_seq_num + 1),
+            syn=1,
+            ack=1,
+            mss=self.mss,
+            sack_permitted=self.sack,
+            cookie=self.cookie,
+        )
+
+    def _receive_segment(self, header, body):
+        """
+        Handle a data segment in the ESTABLISHED state.
+        :param header: header of the segment
+        :param body: payload of the segment
+        :return: the ack to send, None if the segment is dropped without an ack
+        """
+        if utils.DEBUG:
+            utils.debug(
+                "server.segment",
+                addr=self.addr,
+                seq=header.seq_num,
+                size=len(body),
+                last=self.last_received_seq_num,
+            )
+
+        # a segment without payload is a window probe of a client that found the
+        # receive window closed, the ack tells it the current window
+        if not body:
+            self.delayed_ack = None
+            return utils.Header(
+                self.next_seq_num, self.last_received_seq_num + 1, syn=1, ack=1
+            )
+
+        counters = self.metrics.counters
+        counters[metrics.SEGMENTS_RECEIVED] += 1
+
+        # a segment ending beyond the receive window does not fit the buffer,
+        # it is dropped without an ack like the ones past RECEIVE_WINDOW
+        if header.seq_num - self.last_received_seq_num > self.window():
+            counters[metrics.WINDOW_DROPS] += 1
+            return None
+
+        # the sequence number of a segment is the one of its last byte,
+        # so the segment is the next in order one if it starts right
+        # after the last received sequence number. In that case we can add
+        # the body to the message and update the last received seq num.
+        segment_start = header.seq_num - len(body)
+        # an in order segment fills a gap when later segments are buffered
+        in_order = segment_start == self.last_received_seq_num
+        fills_gap = in_order and bool(self.out_of_order)
+        if in_order:
+            self.next_seq_num += 1
+            self._deliver(segment_start, body)
+            self.last_received_seq_num = header.seq_num
+            counters[metrics.BYTES_DELIVERED] += len(body)
+
+            # the segment may have filled a gap, deliver the buffered
+            # segments that are now in order
+            while self.last_received_seq_num in self.out_of_order:
+                buffered = self.out_of_order.pop(self.last_received_seq_num)
+                if self.sink is None:
+                    self.buffer += buffered
+                    buffered = len(buffered)
+                self.next_seq_num += 1
+                self.last_received_seq_num += buffered
+                counters[metrics.BYTES_DELIVERED] += buffered
+
+        # Otherwise it is a duplicate or it arrived out of order (an earlier
+        # segment was dropped). Under go-back-n it is discarded, under
+        # selective repeat or SACK a segment beyond the last received seq num
+        # is buffered as long as there is room in the receive window
+        elif (
+            (self.selective_repeat or self.sack)
+            and segment_start > self.last_received_seq_num
+            and segment_start not in self.out_of_order
+        ):
+            if len(self.out_of_order) >= RECEIVE_WINDOW:
+                # no room, do not ack so the client sends it again later
+                counters[metrics.WINDOW_DROPS] += 1
+                return None
+            if self.sink is None:
+                # the body is a view of the receive buffer, which is reused
+                # for the next datagram, keep a copy
+                self.out_of_order[segment_start] = bytes(body)
+            else:
+                self._deliver(segment_start, body)
+                self.out_of_order[segment_start] = len(body)
+            counters[metrics.OUT_OF_ORDER] += 1
+        elif (
+            segment_start < self.last_received_seq_num
+            or segment_start in self.out_of_order
+        ):
+            counters[metrics.DUPLICATES] += 1
+        else:
+            # go-back-n discards the segments after a gap
+            counters[metrics.OUT_OF_ORDER] += 1
+
+        if self.selective_repeat:
+            # acks are individual, duplicates are acked again in case
+            # the previous ack was lost
+            ack_number = header.seq_num + 1
+        else:
+            # acks are cumulative, they cover everything received in order.
+            # Duplicates and out of order segments re-ack the last in
+            # order sequence number
+            ack_number = self.last_received_seq_num + 1
+        sack = None
+        if self.sack and self.out_of_order:
+            sack = self._sack_blocks(segment_start)
+        resp_header = utils.Header(self.next_seq_num, ack_number, syn=1, ack=1, sack=sack)
+
+        # the ack of every other full size segment is held back, two segments are
+        # acked at once. Out of order segments, duplicates and segments filling a gap
+        # are acked at once, the client needs them to detect and repair losses, and so
+        # are pushed segments, no other ack would come before the client sends more.
+        # Selective repeat acks every segment individually
+        if (
+            self.delay_acks
+            and not header.psh
+            and in_order
+            and not fills_gap
+            and not self.selective_repeat
+            and len(body) == self.mss
+            and self.delayed_ack is None
+        ):
+            self.delayed_ack = resp_header
+            return None
+        self.delayed_ack = None
+        return resp_header
+
+    def _deliver(self, segment_start, body):
+        """
+        Hand over the payload of a segment, to the sink or to the receive buffer.
+        :param segment_start: sequence number the segment starts at
+        :param body: payload of the segment, in order unless there is a sink
+        :return: None
+        """
+        if self.sink is None:
+            self.buffer += body
+        else:
+            # the first data byte follows the SYN and the handshake ack, sequence
+            # numbers do not wrap (utils.MAX_SEQ_NUM)
+            self.sink.write(segment_start - self.ack_number - 1, body)
+
+    def _sack_blocks(self, segment_start):
+        """
+        The out of order segments as SACK blocks, contiguous segments are merged.
+        :param segment_start: where the segment just received starts, its block goes first
+        :return: list of at most utils.MAX_SACK_BLOCKS (start, end) tuples
+        """
+        blocks = []
+        for start in sorted(self.out_of_order):
+            buffered = self.out_of_order[start]
+            end = start + (buffered if self.sink is not None else len(buffered))
+            if blocks and blocks[-1][1] == start:
+                blocks[-1] = (blocks[-1][0], end)
+            else:
+                blocks.append((start, end))
 
-    _update_server_state(ORG_STATE_TO_NEW_STATE[server_state])
+        # the block of the latest segment tells the client the most, the
+        # others follow from the highest down since the lowest were likely
+        # reported already
+        blocks.reverse()
+        for i, (start, end) in enumerate(blocks):
+            if start <= segment_start < end:
+                blocks.insert(0, blocks.pop(i))
+                break
+        return blocks[: utils.MAX_SACK_BLOCKS]
 
 
-def recv_msg():
+class Server:
     """
-    Receive a message and return header, body and addr
-    addr is used to reply to the client
-    this call is blocking
-    :return: header, body, addr
+    The server serves any number of clients over a single UDP socket. Messages
+    are demultiplexed to a Connection by the address of the client.
     """
-    data, addr = sock.recvfrom(1024)
-    header = utils.bits_to_header(data)
-    body = utils.get_body_from_data(data)
-    return (header, body, addr)
-
-
-next_seq_num = 0
-# The server is always listening for messages
-while True:
-    # we need to wait for a client message in these states
-    if server_state in {
-        States.LISTEN,
-        States.SYN_SENT,
-        States.ESTABLISHED,
-        States.LAST_ACK,
-    }:
-        if utils.DEBUG:
-            print("[DEBUG] Server waiting for message")
-        header, body, addr = recv_msg()
-
-    # initialize the response header
-    resp_header = None
-
-    match server_state:
-        case States.CLOSED:
-            pass
-        case States.LISTEN:
-            # if we receive a syn message we need to enter SYN_RECEIVED state
-            if header.syn == 1:
-                # create a random sequence number
-                seq_number = utils.rand_int()
-
-                # will increment when header is sent
-                next_seq_num = seq_number
-
-                # increment the ack number
-                ack_number = header.seq_num + 1
-
-        case States.SYN_RECEIVED:
-            # Create a header, seq number is defined above
-            if header.syn == 1:
-                resp_header = utils.Header(next_seq_num, ack_number, syn=1, ack=1)
-
-            if utils.DEBUG:
-                print("[DEBUG] Received SYN")
-                print("[DEBUG] Sending SYNACK")
-                print(
-                    f"[DEBUG] SEQ: {resp_header.seq_num} | ACK: {resp_header.ack_num}"
-                )
-
-        case States.SYN_SENT:
-            if header.ack == 1:
-                # update the state client is now established
-                update_server_state()
-
-                last_received_seq_num = header.seq_num
-                continue
-
-        case States.ESTABLISHED:
-            if not header.fin:
-                if utils.DEBUG:
-                    print("[DEBUG] Server received message:", body)
-
-                ack_number = header.seq_num + 1
-                resp_header = utils.Header(next_seq_num, ack_number, syn=1, ack=1)
-
-                if utils.DEBUG:
-                    print(
-                        "[DEBUG] Previously received sequence number:",
-                        last_received_seq_num,
-                    )
-                    print(
-                        "[DEBUG]     Current message sequence number:", header.seq_num
-                    )
-
-                # if the seq num is greater than the last received seq num
-                # then we can add the body to the message
-                # and update the last received seq num
-                # otherwise our message was not received
-                if header.seq_num > last_received_seq_num:
-                    next_seq_num += 1
-                    message += body
-                    last_received_seq_num = header.seq_num
 
+    def __init__(
+        self,
+        sock,
+        on_message=None,
+        mss=utils.MAX_MSS,
+        on_data=None,
+        receive_buffer=RECEIVE_BUFFER,
+        ack_delay=ACK_DELAY,
+        fast_open=False,
+        metrics_path=None,
+        trace=None,
+        open_sink=None,
+    ):
+        """
+        Initialize the server.
+        :param sock: bound UDP socket
+        :param on_message: called with (addr, message) when a connection closes, the
+            message is the part of the stream on_data did not read
+        :param mss: largest segment size accepted from a client
+        :param on_data: called with (addr, connection) when in order bytes arrived, it
+            drains them with connection.read(). Until it does the receive window
+            shrinks. Without it the whole stream is collected for on_message
+        :param receive_buffer: size of the receive buffer of every connection in bytes
+        :param ack_delay: seconds an ack may be held back, 0 acks every segment at once
+        :param fast_open: issue fast open cookies, a client holding one sends its first
+            data segment in the SYN
+        :param metrics_path: file the metrics_snapshot() is written to at every
+            eviction check, None writes none
+        :param trace: capture.Recorder the datagrams received and the responses are
+            recorded to
+        :param open_sink: called with the address of a client when its connection
+            opens, returns the sink of its stream: sink.write(offset, data) takes the
+            payload of every segment as it arrives, out of order ones included, at its
+            offset in the stream, sink.close() is called once the connection closed or
+            was evicted. The stream then bypasses the receive buffer, on_data is not
+            called and on_message gets an empty message. An OSError raised by
+            open_sink refuses the connection, its SYN is not answered, one raised by
+            sink.write() drops the connection
+        """
+        self.sock = sock
+        self.on_message = on_message
+        self.on_data = on_data
+        self.mss = mss
+        self.receive_buffer = receive_buffer
+        self.ack_delay = ack_delay
+        self.open_sink = open_sink
+
+        # cookies are a MAC of the client's ip under this key, a restarted server
+        # rejects the cookies it issued before and hands out new ones
+        self.fast_open_key = os.urandom(16) if fast_open else None
+
+        # datagrams are received into preallocated buffers, sized
+        # for the largest segment a client may send
+        self.pool = buffers.BufferPool(size=utils.max_header_size() + mss)
+
+        # the connection table, keyed by the (ip, port) of the client
+        self.connections = {}
+
+        # when the connection table is next checked for connections to evict
+        self.next_eviction = 0.0
+
+        # when the held back ack of a connection is due, keyed by the address of the
+        # client. The delay is the same for every ack, so the dict is in deadline order
+        self.ack_deadlines = {}
+
+        # datagrams handled and the ones dropped for a bad checksum, and connections
+        # opened, closed by their client and evicted
+        self.stats = dict(datagrams=0, corrupted=0, opened=0, closed=0, evicted=0)
+
+        # counters of the connections closed or evicted, the connections in the
+        # table keep their own
+        self.totals = metrics.new_counters()
+        self.metrics_path = metrics_path
+
+        self.trace = trace
+        # the address of the socket in the trace, unknown without a socket
+        self.local_address = sock.getsockname() if trace and sock is not None else None
+
+    def handle_datagram(self, data, addr, now):
+        """
+        Feed a datagram to the connection of its client.
+        :param data: the datagram, bytes or a memoryview of a receive buffer
+        :param addr: (ip, port) of the client
+        :param now: current time in seconds
+        :return: list of response headers to send to the client
+        """
+        self.stats["datagrams"] += 1
+        if self.trace:
+            self.trace.record(capture.RECEIVED, addr, self.local_address, data)
+        # a corrupted datagram is dropped without an answer, the client resends it
+        if not utils.checksum_ok(data):
+            self.stats["corrupted"] += 1
+            return []
+        header = utils.bits_to_header(data)
+        body = utils.get_body_from_data(data)
+
+        connection = self.connections.get(addr)
+        if connection is None:
+            # only a SYN opens a connection, anything else belongs to
+            # a connection that was closed or evicted already
+            if header.syn != 1 or header.fin == 1:
+                return []
+            sink = None
+            if self.open_sink:
+                try:
+                    sink = self.open_sink(addr)
+                except OSError as e:
+                    # no connection without its sink, the SYN goes unanswered
+                    # and the client gives up after its retries
+                    utils.warning("server.sink_failed", addr=addr, error=e)
+                    return []
+            connection = Connection(
+                addr,
+                now,
+                self.mss,
+                self.receive_buffer,
+                self.ack_delay > 0,
+                self.cookie(addr),
+                sink,
+            )
+            self.connections[addr] = connection
+            self.stats["opened"] += 1
+
+        connection.last_active = now
+        try:
+            responses = connection.handle(header, body)
+        except OSError as e:
+            # only a sink raises, the stream of this client cannot be written any
+            # more. Its connection is dropped without an answer, the others go on
+            utils.warning("server.sink_failed", addr=addr, error=e)
+            self._drop(addr, connection)
+            return []
+
+        if connection.buffer:
+            if self.on_data:
+                self.on_data(addr, connection)
             else:
-                ack_number = header.seq_num + 1
-                resp_header = utils.Header(next_seq_num, ack_number, syn=0, ack=1)
-                next_seq_num += 1
-
-                # update the state and send message from ESTABLISHED to CLOSE_WAIT
-                update_server_state()
-            if resp_header:
-                sock.sendto(resp_header.bits(), addr)
-
-        case States.CLOSE_WAIT:
-            ack_number = header.seq_num + 1
-            resp_header = utils.Header(next_seq_num, ack_number, syn=0, ack=0, fin=1)
-
-        case States.LAST_ACK:
-            # Check if the client replied with an ack
-            if header.ack == 1:
-                # update the state
-                update_server_state()
-
-                # reset message state
-                message = ""
-
-                # reset header, body and addr
-                header = None
-                body = None
-                addr = (None, None)
-
-        case _:
-            print("Invalid state")
-            exit(1)
-
-    if server_state in {
-        States.CLOSED,
-        States.LISTEN,
-        States.SYN_RECEIVED,
-        States.CLOSE_WAIT,
-    }:
-        update_server_state()
-
-    # send the response header if it exists and the server is not established
-    # established state is handled above and is unique enough to break our pattern
-    # so we handle it separately. Additionally we must increment the next_seq_num, ESTABLISHED
-    # also increments the next_seq_num
-    if resp_header and server_state is not States.ESTABLISHED:
-        sock.sendto(resp_header.bits(), addr)
-        next_seq_num += 1
+                connection.message += connection.read()
+
+        # the acks advertise the space left once the consumer had its turn
+        window = connection.window()
+        for resp_header in responses:
+            resp_header.window = window
+        connection.metrics.counters[metrics.ACKS_SENT] += len(responses)
+        if self.trace:
+            for resp_header in responses:
+                self.trace.record(capture.SENT, self.local_address, addr, resp_header.bits())
+
+        # a held back ack is due ack_delay after the first segment it covers
+        if connection.delayed_ack is None:
+            self.ack_deadlines.pop(addr, None)
+        elif addr not in self.ack_deadlines:
+            self.ack_deadlines[addr] = now + self.ack_delay
+
+        if connection.server_state is States.CLOSED:
+            del self.connections[addr]
+            self.stats["closed"] += 1
+            metrics.add_counters(self.totals, connection.metrics.counters)
+            self._closed(addr, connection)
+
+        return responses
+
+    def cookie(self, addr):
+        """
+        The fast open cookie of a client, it does not depend on the port so every
+        connection from the same host may use it.
+        :param addr: (ip, port) of the client
+        :return: COOKIE_SIZE bytes, None when fast open is off
+        """
+        if self.fast_open_key is None:
+            return None
+        return hashlib.blake2s(
+            addr[0].encode(), digest_size=COOKIE_SIZE, key=self.fast_open_key
+        ).digest()
+
+    def next_ack_deadline(self):
+        """
+        :return: when the earliest held back ack is due, None if there is none
+        """
+        return next(iter(self.ack_deadlines.values()), None)
+
+    def delayed_acks(self, now):
+        """
+        Take the held back acks that are due.
+        :param now: current time in seconds
+        :return: list of (addr, header) of the acks to send
+        """
+        acks = []
+        while self.ack_deadlines:
+            addr, deadline = next(iter(self.ack_deadlines.items()))
+            if deadline > now:
+                break
+            del self.ack_deadlines[addr]
+            connection = self.connections.get(addr)
+            if connection is None or connection.delayed_ack is None:
+                continue
+            resp_header = connection.delayed_ack
+            connection.delayed_ack = None
+            resp_header.window = connection.window()
+            connection.metrics.counters[metrics.ACKS_SENT] += 1
+            if self.trace:
+                self.trace.record(capture.SENT, self.local_address, addr, resp_header.bits())
+            acks.append((addr, resp_header))
+        return acks
+
+    def read(self, addr, size=-1):
+        """
+        Take in order bytes from the receive buffer of a connection.
+        :param addr: (ip, port) of the client
+        :param size: largest number of bytes to read, all of them if negative
+        :return: bytes, empty if there is nothing to read or no such connection
+        """
+        connection = self.connections.get(addr)
+        if connection is None:
+            return b""
+        return connection.read(size)
+
+    def _closed(self, addr, connection):
+        """
+        Hand the end of the stream of a closed connection to on_message.
+        :param addr: (ip, port) of the client
+        :param connection: the Connection, no longer in the table
+        :return: None
+        """
+        # what the consumer did not read is the end of the message
+        connection.message += connection.read()
+        if connection.sink is not None:
+            connection.sink.close()
+        if utils.INFO:
+            utils.info("server.closed", addr=addr, size=len(connection.message))
+        if self.on_message:
+            self.on_message(addr, connection.message)
+
+    def _drop(self, addr, connection):
+        """
+        Evict a connection whose sink failed, its stream is not handed to on_message.
+        :param addr: (ip, port) of the client
+        :param connection: the Connection, still in the table
+        :return: None
+        """
+        del self.connections[addr]
+        self.ack_deadlines.pop(addr, None)
+        self.stats["evicted"] += 1
+        metrics.add_counters(self.totals, connection.metrics.counters)
+        if connection.sink is not None:
+            try:
+                connection.sink.close()
+            except OSError:
+                # the failure was logged already
+                pass
+
+    def evict(self, now):
+        """
+        Drop idle and half-closed connections.
+        :param now: current time in seconds
+        :return: number of connections evicted
+        """
+        evicted = [
+            addr
+            for addr, connection in self.connections.items()
+            if now - connection.last_active
+            > (
+                HALF_CLOSED_TIMEOUT
+                if connection.server_state in HALF_CLOSED_STATES
+                else IDLE_TIMEOUT
+            )
+        ]
+        for addr in evicted:
+            connection = self.connections.pop(addr)
+            if utils.INFO:
+                utils.info("server.evict", addr=addr, state=connection.server_state)
+            metrics.add_counters(self.totals, connection.metrics.counters)
+            # the client FIN was received, only the final ack went missing
+            # so the message is complete
+            if connection.server_state is States.LAST_ACK:
+                self._closed(addr, connection)
+            elif connection.sink is not None:
+                connection.sink.close()
+        self.stats["evicted"] += len(evicted)
+        return len(evicted)
+
+    def metrics_snapshot(self, now):
+        """
+        :param now: current time in seconds
+        :return: dict of the stats, the counters summed over every connection so
+            far and the metrics of the connections in the table keyed by ip:port
+        """
+        totals = self.totals[:]
+        for connection in self.connections.values():
+            metrics.add_counters(totals, connection.metrics.counters)
+        return {
+            "time": now,
+            "stats": dict(self.stats),
+            "totals": dict(zip(metrics.COUNTERS, totals)),
+            "connections": {
+                f"{addr[0]}:{addr[1]}": connection.metrics.snapshot(now)
+                for addr, connection in self.connections.items()
+            },
+        }
+
+    def receive(self):
+        """
+        Receive a message and answer it, raises socket.timeout if none arrives
+        within the timeout of the socket.
+        :return: None
+        """
+        buffer, data, addr = self.pool.recvfrom(self.sock)
+        try:
+            for resp_header in self.handle_datagram(data, addr, time.monotonic()):
+                self.sock.sendto(resp_header.bits(), addr)
+        finally:
+            self.pool.release(buffer)
+
+    def receive_batch(self):
+        """
+        Receive every datagram waiting on the non-blocking socket, up to
+        buffers.RECV_BATCH, then send the responses together.
+        :return: number of datagrams received
+        """
+        outbox = []
+        received = 0
+        now = time.monotonic()
+        for buffer, data, addr in self.pool.recv_batch(self.sock):
+            received += 1
+            try:
+                for resp_header in self.handle_datagram(data, addr, now):
+                    outbox.append((resp_header, addr))
+            finally:
+                self.pool.release(buffer)
+
+        for resp_header, addr in outbox:
+            try:
+                self.sock.sendto(resp_header.bits(), addr)
+            except BlockingIOError:
+                # the socket buffer is full, the ack is lost like on the network
+                pass
+        return received
+
+    def poll(self, selector):
+        """
+        Wait until datagrams arrive or a timer is due, then handle everything that
+        is waiting: the datagrams, the held back acks and the eviction check.
+        :param selector: selector the non-blocking socket is registered with
+        :return: None
+        """
+        # wake up regularly even without traffic to evict connections,
+        # and in time for the held back acks
+        now = time.monotonic()
+        deadline = self.next_eviction
+        if self.ack_deadlines:
+            deadline = min(deadline, self.next_ack_deadline())
+        if deadline > now:
+            if utils.DEBUG:
+                utils.debug("server.wait", timeout=f"{deadline - now:.3f}")
+            if selector.select(deadline - now):
+                self.receive_batch()
+            now = time.monotonic()
+
+        for addr, resp_header in self.delayed_acks(now):
+            try:
+                self.sock.sendto(resp_header.bits(), addr)
+            except BlockingIOError:
+                pass
+
+        if now >= self.next_eviction:
+            self.evict(now)
+            self.next_eviction = now + EVICT_INTERVAL
+            if self.metrics_path:
+                metrics.write_json(self.metrics_path, self.metrics_snapshot(now))
+
+    def serve_forever(self):
+        """
+        Receive messages and answer them, the server is always listening.
+        :return: None
+        """
+        self.sock.setblocking(False)
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, selectors.EVENT_READ)
+            while True:
+                self.poll(selector)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--log-level",
+        choices=sorted(utils.LOG_LEVELS),
+        default="warning",
+        help="log state changes and evictions (info) or every segment (debug)",
+    )
+    parser.add_argument(
+        "--metrics",
+        help=f"write the counters of the connections to this json file every {EVICT_INTERVAL:g}s",
+    )
+    parser.add_argument(
+        "--trace",
+        help="record the datagrams received and sent to this file, see capture.py",
+    )
+    args = parser.parse_args()
+    utils.set_log_level(args.log_level)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Internet  # UDP
+
+    sock.bind((UDP_IP, UDP_PORT))  # wait for connection
+
+    trace = capture.Recorder(args.trace) if args.trace else None
+    try:
+        Server(sock, metrics_path=args.metrics, trace=trace).serve_forever()
+    finally:
+        if trace:
+            trace.close()
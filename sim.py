@@ -0,0 +1,431 @@
+"""
+Deterministic simulation of a transfer.
+
+The Client, the server state machine and the channel run in one process against a
+virtual clock. Datagrams go through an in-memory fabric instead of sockets: the
+client's socket is a SimSocket, and whenever the client blocks on it the simulation
+delivers whatever the channel has in flight and advances the clock to the next
+delivery, server eviction or socket timeout. Nothing sleeps, minutes of network time
+take milliseconds, and a run is repeated exactly given the same seed.
+
+    python sim.py --profile lossy --size 100000 --window 16 --mode sr --runs 1000
+"""
+import argparse
+import collections
+import hashlib
+import random
+import socket
+import time
+
+import channel
+import client
+import congestion
+import server
+import utils
+
+# addresses on the fabric, only used to tell the clients apart
+SERVER_ADDR = (server.UDP_IP, server.UDP_PORT)
+CLIENT_IP = client.UDP_IP
+FIRST_CLIENT_PORT = 40000
+
+# a run is aborted once the virtual clock passes this many seconds, a
+# stop-and-wait transfer over the default channel takes hours
+MAX_TIME = 24 * 3600.0
+
+
+class SimulationTimeout(RuntimeError):
+    """
+    The virtual clock passed the time limit of the simulation, or a socket without
+    timeout waits for a datagram that can never arrive.
+    """
+
+
+class SimSocket:
+    """
+    The client end of the fabric, it has the methods of a UDP socket the Client uses.
+    """
+
+    def __init__(self, simulation, addr):
+        """
+        :param simulation: the Simulation the socket belongs to
+        :param addr: (ip, port) of the socket on the fabric
+        """
+        self.simulation = simulation
+        self.addr = addr
+        self.timeout = None
+        # datagrams delivered by the channel and not received yet
+        self.inbox = collections.deque()
+        self.closed = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def getsockname(self):
+        return self.addr
+
+    def sendto(self, data, address):
+        """
+        Hand a datagram to the channel, the fabric has a single server.
+        :param data: the datagram
+        :param address: ignored, every datagram goes to the server
+        :return: number of bytes sent
+        """
+        self.simulation.send(self, bytes(data))
+        return len(data)
+
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        """
+        Hand the gathered buffers to the channel as one datagram.
+        :param buffers: bytes-like objects, header and payload
+        :param ancdata: ignored
+        :param flags: ignored
+        :param address: ignored, every datagram goes to the server
+        :return: number of bytes sent
+        """
+        return self.sendto(b"".join(buffers), address)
+
+    def recvfrom_into(self, buffer):
+        """
+        Run the simulation until a datagram is delivered to this socket.
+        :param buffer: writable buffer the datagram is copied into
+        :return: (number of bytes, address of the server)
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = self.simulation.now + self.timeout
+        if not self.simulation.run(deadline, self.inbox):
+            raise socket.timeout("timed out")
+
+        data = self.inbox.popleft()
+        nbytes = min(len(data), len(buffer))
+        buffer[:nbytes] = data[:nbytes]
+        return nbytes, SERVER_ADDR
+
+    def close(self):
+        self.closed = True
+
+
+class Simulation:
+    """
+    A server and its clients connected by a channel, on a virtual clock.
+    """
+
+    def __init__(
+        self,
+        profile=None,
+        seed=0,
+        mss=utils.MAX_MSS,
+        max_time=MAX_TIME,
+        receive_buffer=server.RECEIVE_BUFFER,
+        read_rate=None,
+        ack_delay=server.ACK_DELAY,
+        fast_open=False,
+    ):
+        """
+        :param profile: channel.Profile of the path, the channel's defaults otherwise
+        :param seed: seed of the drops and delays of the channel and of the
+            initial sequence numbers
+        :param mss: largest segment size accepted by the server
+        :param max_time: virtual seconds after which the run is aborted
+        :param receive_buffer: size of the receive buffer of the server connections
+        :param read_rate: bytes per second the application on the server reads,
+            whenever a datagram arrives. None reads everything at once
+        :param ack_delay: seconds the server may hold back an ack, 0 acks every segment
+        :param fast_open: the server issues fast open cookies
+        """
+        self.now = 0.0
+        self.max_time = max_time
+
+        # the initial sequence numbers come from the random module
+        random.seed(seed)
+        self.channel = channel.Channel(profile, random.Random(seed))
+        for link in (self.channel.to_server, self.channel.to_client):
+            link.drop_message = None
+
+        # the server is driven through handle_datagram, it has no socket
+        self.read_rate = read_rate
+        self.server = server.Server(
+            None,
+            on_message=self._on_message,
+            mss=mss,
+            on_data=self._on_data,
+            receive_buffer=receive_buffer,
+            ack_delay=ack_delay,
+            fast_open=fast_open,
+        )
+        self.server.next_eviction = server.EVICT_INTERVAL
+
+        # messages the server delivered, keyed by the address of the client
+        self.messages = {}
+        # with a read rate, what the application read so far and the time its
+        # reading is accounted up to, keyed by the address of the client
+        self.reads = {}
+        self.sockets = {}
+        self.next_port = FIRST_CLIENT_PORT
+
+        # when each client was created and when the application on the server first
+        # read from its connection, keyed by the address of the client
+        self.opened = {}
+        self.first_byte = {}
+        # the fast open cookies of the clients, not shared with other simulations
+        self.cookies = {}
+
+    def clock(self):
+        """
+        :return: the virtual time in seconds
+        """
+        return self.now
+
+    def socket(self):
+        """
+        Open a client socket on the fabric.
+        :return: SimSocket with an address of its own
+        """
+        sock = SimSocket(self, (CLIENT_IP, self.next_port))
+        self.sockets[sock.addr] = sock
+        self.next_port += 1
+        return sock
+
+    def client(self, **kwargs):
+        """
+        Create a Client on the fabric, it completes the handshake before it is returned.
+        :param kwargs: arguments of client.Client besides the socket, the address,
+            the clock and the cookies. TIME_WAIT is spent on the virtual clock
+        :return: the Client
+        """
+        sock = self.socket()
+        self.opened[sock.addr] = self.now
+        return client.Client(
+            address=SERVER_ADDR,
+            sock=sock,
+            clock=self.clock,
+            background_time_wait=False,
+            cookies=self.cookies,
+            **kwargs,
+        )
+
+    def send(self, sock, data):
+        """
+        A datagram from a client enters the channel.
+        :param sock: SimSocket of the client
+        :param data: the datagram
+        :return: None
+        """
+        self.channel.from_client(self.now, sock.addr, data)
+
+    def deliver(self, flow, data):
+        """
+        A datagram leaves the channel at the server, the responses enter the channel.
+        :param flow: channel.Flow of the client
+        :param data: the datagram
+        :return: None
+        """
+        for header in self.server.handle_datagram(data, flow.addr, self.now):
+            self.channel.from_server(self.now, flow, header.bits())
+
+    def run(self, deadline=None, inbox=None):
+        """
+        Deliver datagrams and evict connections in time order.
+        :param deadline: virtual time to stop at, None runs until inbox has a datagram
+        :param inbox: stop as soon as this deque has a datagram
+        :return: True if inbox has a datagram, False once the deadline is reached
+        """
+        while not inbox:
+            next_delivery = self.channel.next_delivery()
+            if next_delivery is None and deadline is None:
+                raise SimulationTimeout(
+                    f"waiting without timeout at {self.now:.3f}s, nothing in flight"
+                )
+
+            # evicting is the only thing happening when nothing is in flight
+            due = self.server.next_eviction
+            if next_delivery is not None:
+                due = min(due, next_delivery)
+            next_ack = self.server.next_ack_deadline()
+            if next_ack is not None:
+                due = min(due, next_ack)
+            if deadline is not None and deadline < due:
+                due = deadline
+            if due > self.max_time:
+                raise SimulationTimeout(f"no end of the run after {self.max_time}s")
+            self.now = max(self.now, due)
+            if due is deadline:
+                return False
+
+            if self.now >= self.server.next_eviction:
+                self.server.evict(self.now)
+                self.server.next_eviction = self.now + server.EVICT_INTERVAL
+
+            for addr, header in self.server.delayed_acks(self.now):
+                self.channel.from_server(self.now, self.channel.flows[addr], header.bits())
+
+            to_server, to_client = self.channel.deliver(self.now)
+            for flow, data in to_server:
+                self.deliver(flow, data)
+            for flow, data in to_client:
+                sock = self.sockets[flow.addr]
+                if not sock.closed:
+                    sock.inbox.append(data)
+        return True
+
+    def _on_data(self, addr, connection):
+        data, since = self.reads.get(addr, (bytearray(), self.now))
+        if self.read_rate is None:
+            data += connection.read()
+        else:
+            size = int((self.now - since) * self.read_rate)
+            if size:
+                data += connection.read(size)
+                since += size / self.read_rate
+        if data:
+            self.first_byte.setdefault(addr, self.now)
+        self.reads[addr] = data, since
+
+    def _on_message(self, addr, message):
+        data, _ = self.reads.pop(addr, (b"", None))
+        self.messages[addr] = bytes(data) + bytes(message)
+
+
+def transfer(
+    message,
+    profile=None,
+    seed=0,
+    receive_buffer=server.RECEIVE_BUFFER,
+    read_rate=None,
+    ack_delay=server.ACK_DELAY,
+    write_size=None,
+    fast_open=False,
+    **kwargs,
+):
+    """
+    Send a message from one client and close the connection.
+    :param message: bytes to send
+    :param profile: channel.Profile of the path
+    :param seed: seed of the simulation
+    :param receive_buffer: size of the receive buffer of the server
+    :param read_rate: bytes per second the server application reads, None reads at once
+    :param ack_delay: seconds the server may hold back an ack, 0 acks every segment
+    :param write_size: write the message in writes of this many bytes and close()
+        the client, None sends it in one send_reliable_message()
+    :param fast_open: a first connection fetches a fast open cookie, the client
+        sending the message then puts its first segment in the SYN
+    :param kwargs: arguments of client.Client (window, mode, congestion_control, mss, nodelay)
+    :return: (Simulation, the Client, the message the server delivered or None)
+    """
+    simulation = Simulation(
+        profile,
+        seed,
+        receive_buffer=receive_buffer,
+        read_rate=read_rate,
+        ack_delay=ack_delay,
+        fast_open=fast_open,
+    )
+    if fast_open:
+        simulation.client(fast_open=True, **kwargs).terminate()
+    sender = simulation.client(fast_open=fast_open, **kwargs)
+    if write_size:
+        for i in range(0, len(message), write_size):
+            sender.write(message[i : i + write_size])
+        sender.close()
+    else:
+        sender.send_reliable_message(message)
+        sender.terminate()
+
+    # the server may still be in LAST_ACK, it delivers the message on eviction
+    addr = sender.sock.getsockname()
+    while addr not in simulation.messages and simulation.server.connections:
+        simulation.run(simulation.now + server.EVICT_INTERVAL)
+    return simulation, sender, simulation.messages.get(addr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--profile", choices=sorted(channel.PROFILES), default="default")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first run")
+    parser.add_argument("--runs", type=int, default=1, help="runs with consecutive seeds")
+    parser.add_argument("--size", type=int, default=10000, help="bytes sent per run")
+    parser.add_argument("--window", type=int, default=client.WINDOW_SIZE)
+    parser.add_argument(
+        "--mode", choices=[client.GO_BACK_N, client.SELECTIVE_REPEAT, client.SACK], default=client.GO_BACK_N
+    )
+    parser.add_argument("--congestion-control", choices=sorted(congestion.ALGORITHMS))
+    parser.add_argument("--mss", type=int, default=client.MSS)
+    parser.add_argument(
+        "--receive-buffer", type=int, default=server.RECEIVE_BUFFER, help="bytes buffered by the server"
+    )
+    parser.add_argument(
+        "--read-rate", type=float, help="bytes per second the server application reads, all at once by default"
+    )
+    parser.add_argument(
+        "--ack-delay", type=float, default=server.ACK_DELAY, help="seconds the server may hold back an ack"
+    )
+    parser.add_argument(
+        "--write-size", type=int, help="send the message in writes of this many bytes"
+    )
+    parser.add_argument(
+        "--nodelay", action="store_true", help="send every write at once instead of coalescing"
+    )
+    parser.add_argument(
+        "--fast-open", action="store_true", help="send the first segment in the SYN, with a cookie fetched first"
+    )
+    parser.add_argument(
+        "--p-corrupt", type=float, help="probability the channel flips a bit of a datagram"
+    )
+    args = parser.parse_args()
+
+    options = dict(channel.PROFILES[args.profile])
+    if args.p_corrupt is not None:
+        options["p_corrupt"] = args.p_corrupt
+    profile = channel.Profile(**options)
+    failed = 0
+    for seed in range(args.seed, args.seed + args.runs):
+        message = random.Random(seed).randbytes(args.size)
+        start = time.perf_counter()
+        try:
+            simulation, sender, delivered = transfer(
+                message,
+                profile,
+                seed,
+                window=args.window,
+                mode=args.mode,
+                congestion_control=args.congestion_control,
+                mss=args.mss,
+                receive_buffer=args.receive_buffer,
+                read_rate=args.read_rate,
+                ack_delay=args.ack_delay,
+                write_size=args.write_size,
+                nodelay=args.nodelay,
+                fast_open=args.fast_open,
+            )
+        except SimulationTimeout as e:
+            failed += 1
+            print(f"seed {seed:>6} FAILED {e}")
+            continue
+        elapsed = time.perf_counter() - start
+
+        if delivered != message:
+            failed += 1
+            print(f"seed {seed:>6} FAILED the server delivered {delivered!r:.40}")
+            continue
+        # the cookie is fetched before the transfer starts
+        addr = sender.sock.getsockname()
+        opened = simulation.opened[addr]
+        # an empty message delivers no byte
+        first_byte = simulation.first_byte.get(addr)
+        first_byte = f"{first_byte - opened:>7.3f}s" if first_byte is not None else f"{'n/a':>8}"
+        print(
+            f"seed {seed:>6} ok     virtual {simulation.now - opened:>9.3f}s "
+            f"first byte {first_byte} "
+            f"wall {elapsed * 1000:>8.1f}ms probes {sender.window_probes:>4} {hashlib.sha256(delivered).hexdigest()[:12]}"
+            + (f" corrupted {simulation.server.stats['corrupted']}" if profile.p_corrupt else "")
+        )
+
+    print(f"{args.runs - failed}/{args.runs} runs delivered the message")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Bulk file transfer. The sender maps the file and hands views of the mapping to a
+client.Client, the receiver writes the payload of every segment to the destination
+file at its offset in the stream as it arrives. Neither side holds more than a
+window of the file in memory, whatever its size up to MAX_FILE_SIZE.
+
+    python transfer.py receive --directory received
+    python transfer.py send some.bin --window 64 --mode sack --mss 1396
+
+The receiver writes every connection to its own file in the directory, named after
+the address of the client.
+"""
+import argparse
+import mmap
+import os
+import socket
+import time
+
+import client
+import congestion
+import server
+import utils
+
+# bytes of the file handed to the sender at once. The sender keeps a few entries
+# per segment of what it is given, blocks keep that bounded. A multiple of the page
+# size, the pages of a block are dropped from the mapping once it is acknowledged
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# largest file sent, sequence numbers do not wrap (utils.MAX_SEQ_NUM). Leaves room
+# for the initial sequence number and the SYN and the FIN of the connection
+MAX_FILE_SIZE = utils.MAX_SEQ_NUM - 2**16
+
+# acknowledged pages can be dropped from the mapping, not on every platform
+HAVE_MADVISE = hasattr(mmap, "MADV_DONTNEED")
+
+
+def send_file(sender, path, block_size=BLOCK_SIZE):
+    """
+    Send a file over a connection. The file is mapped and sent in blocks, every
+    segment is a view of the mapping, nothing is read into memory.
+    :param sender: established client.Client
+    :param path: file to send
+    :param block_size: bytes per send_reliable_message(), a multiple of mmap.PAGESIZE
+    :return: number of bytes sent
+    :raises ValueError: the file is larger than MAX_FILE_SIZE, nothing was sent
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > MAX_FILE_SIZE:
+            raise ValueError(f"{path} has {size} bytes, at most {MAX_FILE_SIZE} can be sent")
+        # an empty file cannot be mapped, there is nothing to send anyway
+        if not size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            if HAVE_MADVISE:
+                mapping.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapping)
+            try:
+                for offset in range(0, size, block_size):
+                    sender.send_reliable_message(view[offset : offset + block_size])
+                    if HAVE_MADVISE:
+                        mapping.madvise(mmap.MADV_DONTNEED, offset, min(block_size, size - offset))
+            finally:
+                # the mapping cannot be closed while a view of it is alive
+                view.release()
+    return size
+
+
+class FileSink:
+    """
+    Writes the stream of a connection to a file with os.pwrite, every payload at its
+    offset, so a segment arriving out of order lands in place without being buffered.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: file to write, truncated if it exists
+        """
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def write(self, offset, data):
+        """
+        Write a payload at its offset in the stream.
+        :param offset: offset of the first byte of data in the stream
+        :param data: the payload, a view of the receive buffer
+        :return: None
+        """
+        while data:
+            written = os.pwrite(self.fd, data, offset)
+            data = data[written:]
+            offset += written
+
+    def close(self):
+        """
+        Close the file, once the connection closed or was evicted.
+        :return: None
+        """
+        os.close(self.fd)
+
+
+class FileReceiver:
+    """
+    Writes the stream of every connection of a server.Server to a file of its own.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: directory the files are written to, created if missing
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def path(self, addr):
+        """
+        :param addr: (ip, port) of the client
+        :return: the file the stream of the client is written to
+        """
+        return os.path.join(self.directory, f"{addr[0]}_{addr[1]}")
+
+    def open_sink(self, addr):
+        """
+        The server.Server open_sink callback.
+        :param addr: (ip, port) of the client
+        :return: FileSink of the connection
+        """
+        return FileSink(self.path(addr))
+
+    def on_message(self, addr, message):
+        """
+        The server.Server on_message callback, the file of the client is complete.
+        :param addr: (ip, port) of the client
+        :param message: empty, the stream went to the file
+        :return: None
+        """
+        path = self.path(addr)
+        print(f"received {os.path.getsize(path)} bytes from {addr[0]}:{addr[1]} into {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="role", required=True)
+
+    receive = subparsers.add_parser("receive", help="run a server writing every stream to a file")
+    receive.add_argument("--directory", default=".", help="directory the files are written to")
+
+    send = subparsers.add_parser("send", help="send a file to the server")
+    send.add_argument("file")
+    send.add_argument(
+        "--window",
+        type=int,
+        default=client.WINDOW_SIZE,
+        help="number of segments in flight, 1 is stop-and-wait",
+    )
+    send.add_argument(
+        "--mode",
+        choices=[client.GO_BACK_N, client.SELECTIVE_REPEAT, client.SACK],
+        default=client.GO_BACK_N,
+        help="retransmission strategy of the windowed sender",
+    )
+    send.add_argument(
+        "--congestion-control",
+        choices=sorted(congestion.ALGORITHMS),
+        help="congestion control algorithm, --window is then the largest window",
+    )
+    send.add_argument(
+        "--mss",
+        type=int,
+        default=utils.MAX_MSS,
+        help=f"maximum segment size to ask for, up to {utils.MAX_MSS} bytes",
+    )
+
+    for subparser in (receive, send):
+        subparser.add_argument(
+            "--log-level",
+            choices=sorted(utils.LOG_LEVELS),
+            default="warning",
+            help="log state changes (info) or every segment (debug)",
+        )
+    args = parser.parse_args()
+    utils.set_log_level(args.log_level)
+
+    if args.role == "receive":
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((server.UDP_IP, server.UDP_PORT))
+        receiver = FileReceiver(args.directory)
+        server.Server(sock, on_message=receiver.on_message, open_sink=receiver.open_sink).serve_forever()
+    else:
+        # refused before the connection is opened
+        if os.path.getsize(args.file) > MAX_FILE_SIZE:
+            parser.error(f"{args.file} is larger than {MAX_FILE_SIZE} bytes, sequence numbers do not wrap")
+        start = time.monotonic()
+        sender = client.Client(
+            window=args.window,
+            mode=args.mode,
+            congestion_control=args.congestion_control,
+            mss=args.mss,
+        )
+        size = send_file(sender, args.file)
+        sender.terminate()
+        elapsed = time.monotonic() - start
+        print(f"sent {size} bytes in {elapsed:.2f}s, {size / elapsed / 1e6:.2f} MB/s")
@@ -1,7 +1,98 @@
 from enum import Enum
+import json
+import logging
 import random
+import struct
+import sys
+import zlib
 
+# Log levels of the structured log. A call site checks the flag of its level before
+# it builds the event, so a disabled level costs one attribute lookup:
+#     if utils.DEBUG:
+#         utils.debug("client.segment", seq=header.seq_num, size=len(chunk))
+# DEBUG logs every segment and ack, INFO state changes, drops and evictions.
+# set_log_level() sets both flags
 DEBUG = False
+INFO = False
+
+# Compatibility flag, when set headers are sent as the original 96 character
+# string of '0'/'1' characters instead of the packed 16 byte binary layout.
+# The ascii format has no checksum.
+# The client, server and channel must all agree on this value.
+ASCII_HEADER = False
+
+# sequence and ack numbers are absolute 32 bit words, they do not wrap
+MAX_SEQ_NUM = 2 ** 32 - 1
+
+# Wire layout of the header, network byte order:
+# seq_num (32 bits) | ack_num (32 bits) | flags (32 bits) | checksum (32 bits)
+HEADER_STRUCT = struct.Struct("!IIII")
+HEADER_SIZE = HEADER_STRUCT.size
+# the words before the checksum
+FIELDS_STRUCT = struct.Struct("!III")
+# the ascii format spends one character per header bit of the words before the checksum
+ASCII_HEADER_SIZE = FIELDS_STRUCT.size * 8
+
+# The checksum is the CRC-32 of the datagram without the checksum field: the words
+# before it, the options and the payload. A datagram failing it is dropped unread
+CHECKSUM_OFFSET = FIELDS_STRUCT.size
+CHECKSUM_STRUCT = struct.Struct("!I")
+# byte holding the options length, the last of the flags word
+OPTIONS_WORDS_OFFSET = CHECKSUM_OFFSET - 1
+
+# The flags live in the high bits of the third word, this is the same bit
+# order used by the ascii format so both encodings carry identical bits
+FLAG_SYN = 1 << 31
+FLAG_ACK = 1 << 30
+FLAG_FIN = 1 << 29
+# set by the client on its SYN to ask for selective repeat, the server then
+# buffers out of order segments and acks each segment individually
+FLAG_SR = 1 << 28
+# set by the client on a segment it sends with no other one in flight and on the
+# last one, the server acks it at once instead of delaying the ack
+FLAG_PSH = 1 << 27
+
+# Bits 4 to 26 of the flags word are the receive window, the bytes the sender of
+# the header can still buffer beyond the data it acknowledged
+WINDOW_SHIFT = 4
+WINDOW_MASK = 0x7FFFFF
+MAX_WINDOW = WINDOW_MASK
+
+# The low 4 bits of the flags word are the length of the options in 32 bit
+# words, the options follow the fixed header (like the TCP data offset)
+OPTIONS_WORDS_MASK = 0xF
+MAX_OPTIONS_SIZE = OPTIONS_WORDS_MASK * 4
+MAX_HEADER_SIZE = HEADER_SIZE + MAX_OPTIONS_SIZE
+
+# Options are encoded as kind (1 byte), length (1 byte, kind and length
+# included) and a value, END pads the options to a multiple of 4 bytes
+OPTION_END = 0
+OPTION_NOP = 1
+# maximum segment size, sent on the SYN and the SYNACK
+OPTION_MSS = 2
+OPTION_MSS_STRUCT = struct.Struct("!BBH")
+# sent on the SYN by a client that wants selective acknowledgments, the
+# server echoes it on the SYNACK when it agrees
+OPTION_SACK_PERMITTED = 4
+# the ranges of out of order data the receiver holds, each range is the
+# sequence number a block starts at and the sequence number of its last byte
+OPTION_SACK = 5
+SACK_BLOCK_STRUCT = struct.Struct("!II")
+# SACK blocks sent at most, 4 + 8 bytes each must fit the options area
+MAX_SACK_BLOCKS = 4
+# fast open cookie (RFC 7413), a client sends it empty on its SYN to ask for one and
+# the server returns one on the SYNACK. A SYN carrying a valid cookie carries data
+OPTION_FAST_OPEN = 34
+
+# largest datagram that fits an ethernet frame without IP fragmentation
+MAX_DATAGRAM_SIZE = 1472
+
+# largest segment size that can be negotiated, a segment with the largest
+# header still fits MAX_DATAGRAM_SIZE
+MAX_MSS = MAX_DATAGRAM_SIZE - MAX_HEADER_SIZE
+
+# segment size used with a peer that does not send the MSS option
+DEFAULT_MSS = 12
 
 # Extend the possible states based on your implementation
 # Refer TCP protocol
@@ -10,41 +101,177 @@ class States(Enum):
 	, SYN_RECEIVED, SYN_SENT, ESTABLISHED, FIN_WAIT_1, CLOSE_WAIT, FIN_WAIT_2, LAST_ACK, TIME_WAIT = range(1, 11)
 
 class Header:
-	def __init__(self, seq_num, ack_num, syn, ack, fin=0):
+	__slots__ = ("seq_num", "ack_num", "syn", "ack", "fin", "sr", "psh", "window", "mss", "sack_permitted", "sack", "cookie")
+
+	def __init__(self, seq_num, ack_num, syn, ack, fin=0, sr=0, psh=0, window=0, mss=None, sack_permitted=False, sack=None, cookie=None):
 		self.seq_num = seq_num
 		self.ack_num = ack_num
 		self.syn = syn
 		self.ack = ack
 		self.fin = fin
+		self.sr = sr
+		self.psh = psh
+		# advertised receive window in bytes, only the server receives data
+		self.window = window
+		# options, None (or False) when the option is not sent
+		self.mss = mss
+		self.sack_permitted = sack_permitted
+		# list of (start, end) blocks
+		self.sack = sack
+		# fast open cookie as bytes, empty asks the server for a cookie
+		self.cookie = cookie
 
 	def __str__(self):
-		return pretty_bits_print(self.bits().decode())
-
-	def bits(self):
-		bits = '{0:032b}'.format(self.seq_num)
-		bits += '{0:032b}'.format(self.ack_num)
-		bits += '{0:01b}'.format(self.syn)
-		bits += '{0:01b}'.format(self.ack)
-		bits += '{0:01b}'.format(self.fin)
-		bits += '{0:029b}'.format(0)
-		if (DEBUG):
-			print(pretty_bits_print(bits))
-		return bits.encode()
+		return pretty_bits_print(self.ascii_bits().decode())
+
+	def flags(self):
+		flags = 0
+		if self.syn:
+			flags |= FLAG_SYN
+		if self.ack:
+			flags |= FLAG_ACK
+		if self.fin:
+			flags |= FLAG_FIN
+		if self.sr:
+			flags |= FLAG_SR
+		if self.psh:
+			flags |= FLAG_PSH
+		return flags | min(self.window, MAX_WINDOW) << WINDOW_SHIFT
+
+	def has_options(self):
+		return self.mss is not None or self.sack_permitted or bool(self.sack) or self.cookie is not None
+
+	def options(self):
+		# encodes the options, every option is padded with NOPs to a multiple of 4 bytes
+		options = b''
+		if self.mss is not None:
+			options += OPTION_MSS_STRUCT.pack(OPTION_MSS, OPTION_MSS_STRUCT.size, self.mss)
+		if self.sack_permitted:
+			options += bytes((OPTION_NOP, OPTION_NOP, OPTION_SACK_PERMITTED, 2))
+		if self.sack:
+			blocks = self.sack[:MAX_SACK_BLOCKS]
+			options += bytes((OPTION_NOP, OPTION_NOP, OPTION_SACK, 2 + SACK_BLOCK_STRUCT.size * len(blocks)))
+			options += b''.join(SACK_BLOCK_STRUCT.pack(start, end) for start, end in blocks)
+		if self.cookie is not None:
+			options += bytes((OPTION_NOP,) * (-(2 + len(self.cookie)) % 4) + (OPTION_FAST_OPEN, 2 + len(self.cookie)))
+			options += self.cookie
+		return options
+
+	def bits(self, payload=b''):
+		# encodes the header in the wire format selected by ASCII_HEADER, the
+		# checksum covers the payload sent after it
+		if DEBUG:
+			debug("header", seq=self.seq_num, ack=self.ack_num, flags=hex(self.flags()))
+		if ASCII_HEADER:
+			return self.ascii_bits(payload)
+		if not self.has_options():
+			fields = FIELDS_STRUCT.pack(self.seq_num, self.ack_num, self.flags())
+			return fields + CHECKSUM_STRUCT.pack(zlib.crc32(payload, zlib.crc32(fields)))
+		options = self.options()
+		fields = FIELDS_STRUCT.pack(self.seq_num, self.ack_num, self.flags() | len(options) // 4)
+		crc = zlib.crc32(payload, zlib.crc32(options, zlib.crc32(fields)))
+		return fields + CHECKSUM_STRUCT.pack(crc) + options
+
+	def ascii_bits(self, payload=b''):
+		# the original encoding, one '0'/'1' character per bit and no checksum
+		if not self.has_options():
+			return '{0:032b}{1:032b}{2:032b}'.format(self.seq_num, self.ack_num, self.flags()).encode()
+		options = self.options()
+		bits = '{0:032b}{1:032b}{2:032b}'.format(self.seq_num, self.ack_num, self.flags() | len(options) // 4)
+		return (bits + ''.join('{0:08b}'.format(byte) for byte in options)).encode()
 
 def bits_to_header(bits):
-	bits = bits.decode()
+	# accepts bytes, bytearray or memoryview holding at least a full header
+	if ASCII_HEADER:
+		return ascii_bits_to_header(bits)
+	seq_num, ack_num, flags = FIELDS_STRUCT.unpack_from(bits)
+	header = Header(
+		seq_num, ack_num, (flags >> 31) & 1, (flags >> 30) & 1, (flags >> 29) & 1, (flags >> 28) & 1,
+		(flags >> 27) & 1, (flags >> WINDOW_SHIFT) & WINDOW_MASK,
+	)
+	if flags & OPTIONS_WORDS_MASK:
+		parse_options(header, bits[HEADER_SIZE:HEADER_SIZE + (flags & OPTIONS_WORDS_MASK) * 4])
+	return header
+
+def ascii_bits_to_header(bits):
+	words = int(bytes(bits[ASCII_HEADER_SIZE - 4:ASCII_HEADER_SIZE]).decode(), 2)
+	bits = bytes(bits[:ASCII_HEADER_SIZE + words * 32]).decode()
 	seq_num = int(bits[:32], 2)
 	ack_num = int(bits[32:64], 2)
 	syn = int(bits[64], 2)
 	ack = int(bits[65], 2)
 	fin = int (bits[66], 2)
-	return Header(seq_num, ack_num, syn, ack, fin)
+	sr = int(bits[67], 2)
+	psh = int(bits[68], 2)
+	window = int(bits[69:92], 2)
+	header = Header(seq_num, ack_num, syn, ack, fin, sr, psh, window)
+	if words:
+		parse_options(header, bytes(int(bits[i:i + 8], 2) for i in range(ASCII_HEADER_SIZE, len(bits), 8)))
+	return header
+
+def parse_options(header, options):
+	# sets the options found in the options area on the header,
+	# unknown options are skipped
+	i = 0
+	while i < len(options):
+		kind = options[i]
+		if kind == OPTION_END:
+			break
+		if kind == OPTION_NOP:
+			i += 1
+			continue
+		if i + 1 >= len(options) or options[i + 1] < 2:
+			# malformed, ignore the rest
+			break
+		length = options[i + 1]
+		if kind == OPTION_MSS and length == OPTION_MSS_STRUCT.size and i + length <= len(options):
+			header.mss = OPTION_MSS_STRUCT.unpack_from(options, i)[2]
+		elif kind == OPTION_SACK_PERMITTED and length == 2:
+			header.sack_permitted = True
+		elif kind == OPTION_SACK and (length - 2) % SACK_BLOCK_STRUCT.size == 0 and i + length <= len(options):
+			header.sack = [
+				SACK_BLOCK_STRUCT.unpack_from(options, j)
+				for j in range(i + 2, i + length, SACK_BLOCK_STRUCT.size)
+			]
+		elif kind == OPTION_FAST_OPEN and i + length <= len(options):
+			header.cookie = bytes(options[i + 2:i + length])
+		i += length
+
+def header_size():
+	# size in bytes of a header without options in the current wire format
+	return ASCII_HEADER_SIZE if ASCII_HEADER else HEADER_SIZE
+
+def max_header_size():
+	# size in bytes of a header with the largest options area
+	return MAX_HEADER_SIZE * 8 if ASCII_HEADER else MAX_HEADER_SIZE
 
-# Returns the bits beyond the first 12 bytes
-# If your header is 12 bytes, it returns the body of a message
+def header_length(data):
+	# size in bytes of the header of a datagram, options included
+	if ASCII_HEADER:
+		return ASCII_HEADER_SIZE + int(bytes(data[ASCII_HEADER_SIZE - 4:ASCII_HEADER_SIZE]).decode(), 2) * 32
+	return HEADER_SIZE + (data[OPTIONS_WORDS_OFFSET] & OPTIONS_WORDS_MASK) * 4
+
+# Returns the bytes beyond the header as a memoryview, the payload is not
+# copied or decoded
 def get_body_from_data(data):
-	data = data.decode()
-	return data[96:]
+	if ASCII_HEADER:
+		return memoryview(data)[header_length(data):]
+	return memoryview(data)[HEADER_SIZE + (data[OPTIONS_WORDS_OFFSET] & OPTIONS_WORDS_MASK) * 4:]
+
+def checksum(data):
+	# CRC-32 of a binary datagram without its checksum field, computed over
+	# views so nothing is copied
+	view = memoryview(data)
+	return zlib.crc32(view[HEADER_SIZE:], zlib.crc32(view[:CHECKSUM_OFFSET]))
+
+def checksum_ok(data):
+	# whether a received datagram is intact, a short or corrupted one is not.
+	# The ascii format has no checksum, only its length is checked
+	if len(data) < header_size():
+		return False
+	if ASCII_HEADER:
+		return True
+	return checksum(data) == CHECKSUM_STRUCT.unpack_from(data, CHECKSUM_OFFSET)[0]
 
 # Used for debugging
 # It pretty prints header of a message
@@ -54,10 +281,58 @@ def pretty_bits_print(bits):
 	row_3 = bits[64:]
 	output = [seq_num+" : seq_num = {0}".format(int(seq_num,2))]
 	output.append(ack_num+" : ack_num = {0}".format(int(ack_num,2)))
-	output.append(row_3+" : syn = {0}, ack = {1}, fin = {2}".format(row_3[0], row_3[1], row_3[2]))
+	output.append(row_3[:32]+" : syn = {0}, ack = {1}, fin = {2}, window = {3}".format(row_3[0], row_3[1], row_3[2], int(row_3[5:28], 2)))
+	for i in range(32, len(row_3), 32):
+		output.append(row_3[i:i + 32]+" : options")
 	return '\n'.join(output)
 
 # We rather using small values for number generation
 # to make it easier to keep track of for the assignment
 def rand_int(power=5):
 	return random.randint(0,(2 ** power)-1)
+
+# The structured log, one line of key=value pairs per event (logfmt). The level of
+# the logger lets everything through, the flags above decide what is logged
+logger = logging.getLogger("rdt")
+logger.setLevel(logging.DEBUG)
+logger.propagate = False
+
+LOG_LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING}
+
+class LogfmtFormatter(logging.Formatter):
+	def format(self, record):
+		fields = "".join(f" {key}={logfmt_value(value)}" for key, value in record.fields.items())
+		return f"time={record.created:.6f} level={record.levelname.lower()} event={record.msg}{fields}"
+
+def logfmt_value(value):
+	# states by name, addresses as ip:port, values with spaces or quotes are quoted
+	if isinstance(value, Enum):
+		value = value.name
+	elif isinstance(value, tuple):
+		value = ":".join(map(str, value))
+	else:
+		value = str(value)
+	if not value or any(c in value for c in ' ="'):
+		return json.dumps(value)
+	return value
+
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(LogfmtFormatter())
+logger.addHandler(_handler)
+
+def set_log_level(level):
+	# level is a logging level or a name of LOG_LEVELS
+	global DEBUG, INFO
+	if isinstance(level, str):
+		level = LOG_LEVELS[level]
+	DEBUG = level <= logging.DEBUG
+	INFO = level <= logging.INFO
+
+def debug(event, **fields):
+	logger.debug(event, extra={"fields": fields})
+
+def info(event, **fields):
+	logger.info(event, extra={"fields": fields})
+
+def warning(event, **fields):
+	logger.warning(event, extra={"fields": fields})
@@ -0,0 +1,201 @@
+"""
+Server spread over worker processes. Every worker binds the server port with
+SO_REUSEPORT and runs its own server.Server, the kernel hashes the address of a
+client to one of the sockets so all datagrams of a connection reach the same worker
+and the workers share nothing. The counters of the workers are gathered in shared
+memory.
+
+    python workers.py --workers 4
+
+A worker that exits changes the hash, the connections of the others may move to a
+worker that does not know them, their clients have to reconnect.
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import time
+
+import server
+import utils
+
+# counters every worker publishes, the keys of server.Server.stats
+STATS = ("datagrams", "corrupted", "opened", "closed", "evicted")
+
+# seconds between the stats lines printed by the launcher
+STATS_INTERVAL = 5.0
+
+# seconds to wait for the workers to bind the port
+START_TIMEOUT = 10.0
+
+
+def bind(address):
+    """
+    Open a UDP socket sharing its address with the other workers.
+    :param address: (ip, port) to bind
+    :return: the bound socket
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+    return sock
+
+
+class WorkerServer(server.Server):
+    """
+    A server.Server that copies its counters to its row of the shared counters
+    whenever it checks for connections to evict, every server.EVICT_INTERVAL.
+    """
+
+    def __init__(self, sock, counters, index, **kwargs):
+        """
+        :param sock: socket bound with bind()
+        :param counters: shared array of len(STATS) counters per worker
+        :param index: index of the worker, its row in counters
+        :param kwargs: arguments of server.Server
+        """
+        super().__init__(sock, **kwargs)
+        self.counters = counters
+        self.offset = index * len(STATS)
+
+    def evict(self, now):
+        evicted = super().evict(now)
+        for i, name in enumerate(STATS):
+            self.counters[self.offset + i] = self.stats[name]
+        return evicted
+
+
+def _work(index, address, counters, ready, fast_open_key, kwargs):
+    """
+    Run a worker until it is terminated.
+    :param index: index of the worker
+    :param address: (ip, port) shared by the workers
+    :param counters: shared array of the counters
+    :param ready: multiprocessing queue the bound address is put on
+    :param fast_open_key: key of the fast open cookies, the same in every worker so a
+        cookie is valid whichever worker a later connection of the client lands on
+    :param kwargs: arguments of server.Server
+    :return: None
+    """
+    srv = WorkerServer(bind(address), counters, index, **kwargs)
+    if fast_open_key:
+        srv.fast_open_key = fast_open_key
+    ready.put(srv.sock.getsockname())
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+class Workers:
+    """
+    The worker processes of a server.
+    """
+
+    def __init__(self, workers=None, address=(server.UDP_IP, server.UDP_PORT), **kwargs):
+        """
+        :param workers: number of worker processes, one per core by default
+        :param address: (ip, port) to serve on, port 0 picks a free port
+        :param kwargs: arguments of server.Server (mss, receive_buffer, ack_delay,
+            fast_open), the callbacks cannot be passed to another process
+        """
+        self.workers = workers or os.cpu_count()
+        self.address = address
+        self.kwargs = kwargs
+
+        # len(STATS) counters per worker, a worker only writes its own row
+        self.counters = multiprocessing.Array("Q", self.workers * len(STATS), lock=False)
+        self.processes = []
+
+    def start(self):
+        """
+        Start the workers and wait until every one of them has bound the port.
+        :return: the (ip, port) served
+        """
+        fast_open_key = os.urandom(16) if self.kwargs.get("fast_open") else None
+        ready = multiprocessing.Queue()
+        try:
+            for index in range(self.workers):
+                process = multiprocessing.Process(
+                    target=_work,
+                    args=(index, self.address, self.counters, ready, fast_open_key, self.kwargs),
+                    daemon=True,
+                )
+                process.start()
+                self.processes.append(process)
+                # with port 0 the first worker picks the port the others bind. A
+                # socket of our own would be inherited by the workers and take a
+                # share of the datagrams without ever reading them
+                if index == 0:
+                    self.address = ready.get(timeout=START_TIMEOUT)
+            for _ in self.processes[1:]:
+                ready.get(timeout=START_TIMEOUT)
+        except BaseException:
+            self.stop()
+            raise
+
+        if utils.INFO:
+            utils.info("workers.start", workers=self.workers, addr=self.address)
+        return self.address
+
+    def worker_stats(self):
+        """
+        :return: list of dicts of the counters of every worker, as of its last
+            eviction check
+        """
+        return [
+            {
+                name: self.counters[index * len(STATS) + i]
+                for i, name in enumerate(STATS)
+            }
+            for index in range(self.workers)
+        ]
+
+    def stats(self):
+        """
+        :return: dict of the counters summed over the workers
+        """
+        totals = dict.fromkeys(STATS, 0)
+        for stats in self.worker_stats():
+            for name, value in stats.items():
+                totals[name] += value
+        return totals
+
+    def stop(self):
+        """
+        Terminate the workers, their connections are dropped.
+        :return: None
+        """
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes.clear()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the server in SO_REUSEPORT worker processes.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--port", type=int, default=server.UDP_PORT)
+    parser.add_argument("--fast-open", action="store_true", help="issue fast open cookies")
+    args = parser.parse_args()
+
+    with Workers(args.workers, (server.UDP_IP, args.port), fast_open=args.fast_open) as workers:
+        print(f"{workers.workers} workers serving on {workers.address}")
+        try:
+            while True:
+                time.sleep(STATS_INTERVAL)
+                print(workers.stats(), [stats["datagrams"] for stats in workers.worker_stats()])
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()